@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+"""
+告警落盘缓存（spool）：告警网关不可达时把告警追加写入本地分段文件，网关恢复后按写入顺序重放
+
+- 分段文件 segment-<序号>.log，只追加；每条记录 = 长度(u32) | CRC32(u32) | JSON
+- fsync 按批：每 ALERT_SPOOL_FSYNC_EVERY 条或距上次 fsync 超过 ALERT_SPOOL_FSYNC_INTERVAL 秒执行一次，关闭时必定执行
+- 总大小超过 ALERT_SPOOL_MAX_MB 时删除最旧的分段（其中未投递的告警计入 evicted）
+- 投递位置 (分段序号, 字节偏移) 原子写入 offset.json，传感器重启后从上次位置继续（至少一次投递）
+- 读到 CRC 不匹配或截断的记录（写入中途断电）时跳过该分段剩余部分，计入 corrupt
+- 每次打开都新建一个写入分段，不在可能残缺的旧分段尾部继续追加
+
+用法：
+    python alert_spool.py [--dir alert_spool]     # 查看缓存深度
+"""
+
+import argparse
+import json
+import os
+import struct
+import threading
+import time
+import zlib
+
+from ids_common import logger, COLORS
+
+# ========== 缓存配置 ==========
+ALERT_SPOOL_ENABLED = os.environ.get("ALERT_SPOOL", "1") == "1"
+ALERT_SPOOL_DIR = os.environ.get("ALERT_SPOOL_DIR",
+                                 os.path.join(os.path.dirname(os.path.abspath(__file__)), "alert_spool"))
+ALERT_SPOOL_MAX_MB = float(os.environ.get("ALERT_SPOOL_MAX_MB", "64"))
+ALERT_SPOOL_SEGMENT_MB = float(os.environ.get("ALERT_SPOOL_SEGMENT_MB", "4"))
+ALERT_SPOOL_FSYNC_EVERY = int(os.environ.get("ALERT_SPOOL_FSYNC_EVERY", "32"))
+ALERT_SPOOL_FSYNC_INTERVAL = float(os.environ.get("ALERT_SPOOL_FSYNC_INTERVAL", "1.0"))
+ALERT_SPOOL_RETRY_MAX = float(os.environ.get("ALERT_SPOOL_RETRY_MAX", "30"))  # 重放失败后的最长退避（秒）
+
+RECORD_HEADER = struct.Struct("<II")
+MAX_RECORD_BYTES = 1 << 20
+OFFSET_FILE = "offset.json"
+
+
+def _segment_name(seq):
+    return f"segment-{seq:012d}.log"
+
+
+class AlertSpool:
+    def __init__(self, directory=ALERT_SPOOL_DIR, max_mb=ALERT_SPOOL_MAX_MB, segment_mb=ALERT_SPOOL_SEGMENT_MB,
+                 fsync_every=ALERT_SPOOL_FSYNC_EVERY, fsync_interval=ALERT_SPOOL_FSYNC_INTERVAL):
+        self.directory = directory
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.segment_bytes = int(segment_mb * 1024 * 1024)
+        self.fsync_every = max(1, fsync_every)
+        self.fsync_interval = fsync_interval
+        os.makedirs(directory, exist_ok=True)
+
+        self._cond = threading.Condition()
+        self._stop = threading.Event()
+        self._drainer = None
+        self._send = None
+        self._reader = None  # (分段序号, 文件对象)
+        self._writer = None
+        self._unsynced = 0
+        self._last_sync = time.time()
+
+        self.spooled = 0  # 本次运行写入的告警数
+        self.delivered = 0  # 本次运行重放成功（或被网关拒绝、不再重试）的告警数
+        self.evicted = 0  # 超过容量上限被删除的未投递告警数
+        self.corrupt = 0  # 校验失败而跳过的分段尾部次数
+
+        self._sizes = {}
+        for name in os.listdir(directory):
+            if name.startswith("segment-") and name.endswith(".log"):
+                self._sizes[int(name[8:-4])] = os.path.getsize(os.path.join(directory, name))
+        self.read_seq, self.read_offset = self._load_offset()
+        for seq in [seq for seq in self._sizes if seq < self.read_seq]:
+            self._remove_segment(seq)
+        if self.read_seq not in self._sizes:
+            self.read_seq, self.read_offset = (min(self._sizes), 0) if self._sizes else (0, 0)
+        self.pending_records = sum(self._count_records(seq, self.read_offset if seq == self.read_seq else 0)
+                                   for seq in self._sizes)
+        self.write_seq = max(self._sizes) + 1 if self._sizes else self.read_seq
+        self._open_writer()
+
+    # ---------- 写入 ----------
+    def append(self, payload):
+        data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        with self._cond:
+            if self._sizes[self.write_seq] >= self.segment_bytes:
+                self._rotate()
+            self._writer.write(RECORD_HEADER.pack(len(data), zlib.crc32(data)) + data)
+            self._writer.flush()
+            self._sizes[self.write_seq] += RECORD_HEADER.size + len(data)
+            self.pending_records += 1
+            self.spooled += 1
+            self._unsynced += 1
+            if self._unsynced >= self.fsync_every or time.time() - self._last_sync >= self.fsync_interval:
+                self._fsync()
+            self._enforce_limit()
+            self._cond.notify_all()
+
+    def _open_writer(self):
+        self._sizes.setdefault(self.write_seq, 0)
+        self._writer = open(os.path.join(self.directory, _segment_name(self.write_seq)), "ab")
+
+    def _rotate(self):
+        self._fsync()
+        self._writer.close()
+        self.write_seq += 1
+        self._open_writer()
+
+    def _fsync(self):
+        if self._writer is not None and self._unsynced:
+            self._writer.flush()
+            os.fsync(self._writer.fileno())
+        self._unsynced = 0
+        self._last_sync = time.time()
+
+    def _enforce_limit(self):
+        while sum(self._sizes.values()) > self.max_bytes and len(self._sizes) > 1:
+            oldest = min(self._sizes)
+            dropped = self._count_records(oldest, self.read_offset if oldest == self.read_seq else 0)
+            self.evicted += dropped
+            self.pending_records -= dropped
+            logger.warning(f"{COLORS['yellow']}⚠️ 告警缓存超过{self.max_bytes / 1024 / 1024:g}MB，"
+                           f"删除最旧分段{_segment_name(oldest)}（{dropped}条未投递）{COLORS['reset']}")
+            self._remove_segment(oldest)
+            if oldest == self.read_seq:
+                self.read_seq, self.read_offset = min(self._sizes), 0
+                self._save_offset()
+
+    # ---------- 读取/投递 ----------
+    def _peek(self):
+        """读出下一条未投递记录 (payload, 分段序号, 下一条位置)；已追上写入位置时返回 None"""
+        while True:
+            size = self._sizes.get(self.read_seq, 0)
+            if self.read_offset >= size:
+                if self.read_seq >= self.write_seq:
+                    return None
+                self._remove_segment(self.read_seq)
+                self.read_seq, self.read_offset = min(self._sizes), 0
+                self._save_offset()
+                continue
+            f = self._reader_for(self.read_seq)
+            f.seek(self.read_offset)
+            header = f.read(RECORD_HEADER.size)
+            length, crc = RECORD_HEADER.unpack(header) if len(header) == RECORD_HEADER.size else (0, 0)
+            data = f.read(length) if 0 < length <= MAX_RECORD_BYTES else b""
+            if not data or len(data) != length or zlib.crc32(data) != crc:
+                self.corrupt += 1
+                logger.warning(f"{COLORS['yellow']}⚠️ 告警缓存{_segment_name(self.read_seq)}偏移{self.read_offset}"
+                               f"处记录损坏，跳过该分段剩余部分{COLORS['reset']}")
+                if self.read_seq == self.write_seq:
+                    self._rotate()
+                self.read_offset = size
+                continue
+            try:
+                payload = json.loads(data.decode("utf-8"))
+            except ValueError:
+                payload = None
+            return payload, self.read_seq, self.read_offset + RECORD_HEADER.size + length
+
+    def _ack(self, seq, next_offset):
+        """投递完成后前移读位置；投递期间该分段已被容量上限删除（读位置已移到下一分段）时丢弃本次确认"""
+        if seq != self.read_seq:
+            return
+        self.read_offset = next_offset
+        self.pending_records = max(0, self.pending_records - 1)
+        self.delivered += 1
+        self._save_offset()
+
+    def start(self, send_fn):
+        """启动重放线程；send_fn(payload) 返回 True 表示已处理（投递成功或被拒绝），False 表示稍后重试"""
+        self._send = send_fn
+        self._drainer = threading.Thread(target=self._drain, name="alert-spool", daemon=True)
+        self._drainer.start()
+        return self
+
+    def _drain(self):
+        backoff = 1.0
+        while not self._stop.is_set():
+            with self._cond:
+                item = self._peek()
+                if item is None:
+                    if time.time() - self._last_sync >= self.fsync_interval:
+                        self._fsync()
+                    self._cond.wait(timeout=self.fsync_interval)
+                    continue
+            payload, seq, next_offset = item
+            if payload is None or self._send(payload):
+                with self._cond:
+                    self._ack(seq, next_offset)
+                backoff = 1.0
+            else:
+                self._stop.wait(backoff)
+                backoff = min(backoff * 2, ALERT_SPOOL_RETRY_MAX)
+
+    def close(self, timeout=5.0):
+        self._stop.set()
+        with self._cond:
+            self._cond.notify_all()
+        if self._drainer is not None:
+            self._drainer.join(timeout=timeout)
+        with self._cond:
+            self._fsync()
+            self._writer.close()
+            if self._reader is not None:
+                self._reader[1].close()
+                self._reader = None
+            if self._sizes.get(self.write_seq) == 0 and self.read_seq != self.write_seq:
+                self._remove_segment(self.write_seq)
+            self._save_offset()
+
+    # ---------- 状态 ----------
+    def depth_bytes(self):
+        with self._cond:
+            return sum(size for seq, size in self._sizes.items() if seq >= self.read_seq) - self.read_offset
+
+    def stats(self):
+        return {"pending_records": self.pending_records, "pending_bytes": self.depth_bytes(),
+                "spooled": self.spooled, "delivered": self.delivered, "evicted": self.evicted,
+                "corrupt": self.corrupt}
+
+    # ---------- 内部工具 ----------
+    def _reader_for(self, seq):
+        if self._reader is None or self._reader[0] != seq:
+            if self._reader is not None:
+                self._reader[1].close()
+            self._reader = (seq, open(os.path.join(self.directory, _segment_name(seq)), "rb"))
+        return self._reader[1]
+
+    def _remove_segment(self, seq):
+        if self._reader is not None and self._reader[0] == seq:
+            self._reader[1].close()
+            self._reader = None
+        self._sizes.pop(seq, None)
+        try:
+            os.remove(os.path.join(self.directory, _segment_name(seq)))
+        except OSError:
+            pass
+
+    def _count_records(self, seq, offset):
+        count = 0
+        with open(os.path.join(self.directory, _segment_name(seq)), "rb") as f:
+            f.seek(offset)
+            while True:
+                header = f.read(RECORD_HEADER.size)
+                if len(header) < RECORD_HEADER.size:
+                    break
+                length, crc = RECORD_HEADER.unpack(header)
+                data = f.read(length) if length <= MAX_RECORD_BYTES else b""
+                if len(data) != length or zlib.crc32(data) != crc:
+                    break
+                count += 1
+        return count
+
+    def _load_offset(self):
+        try:
+            with open(os.path.join(self.directory, OFFSET_FILE), "r", encoding="utf-8") as f:
+                state = json.load(f)
+            return int(state["segment"]), int(state["offset"])
+        except (OSError, ValueError, KeyError):
+            return 0, 0
+
+    def _save_offset(self):
+        path = os.path.join(self.directory, OFFSET_FILE)
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump({"segment": self.read_seq, "offset": self.read_offset}, f)
+        os.replace(path + ".tmp", path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="查看告警落盘缓存")
+    parser.add_argument("--dir", default=ALERT_SPOOL_DIR)
+    args = parser.parse_args()
+    if not os.path.isdir(args.dir):
+        logger.info(f"告警缓存目录不存在：{args.dir}")
+        return
+    spool = AlertSpool(args.dir)
+    stats = spool.stats()
+    spool.close()
+    logger.info(f"📦 告警缓存 {args.dir}：未投递{stats['pending_records']}条（{stats['pending_bytes'] / 1024:.1f}KB），"
+                f"读位置 {_segment_name(spool.read_seq)}@{spool.read_offset}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+"""
+常驻抓包会话：整个检测周期只打开一次抓包句柄，代替循环调用 sniff(timeout=3)
+
+- 每轮 sniff 都会关闭/重开抓包句柄，两轮之间到达的报文直接丢失，内核统计也随句柄清零
+- CaptureSession 通过 conf.L2listen 打开一次句柄（conf.use_pcap 时为 libpcap，否则为 AF_PACKET），
+  在调用线程里 select → recv → on_packet；每个 tick（CAPTURE_TICK 秒）调用一次 on_idle，
+  流超时清理与报文处理在同一线程执行，流表不需要加锁
+- stop() 置位停止事件，下一个 tick 内退出；句柄出错时关闭并在 1 秒后重开（计入 reopens）
+- stats() 读取内核层面的收包/丢包计数：
+    libpcap：pcap_stats（ps_recv 收到、ps_drop 缓冲区满丢弃、ps_ifdrop 网卡丢弃，句柄内累计）
+    AF_PACKET：getsockopt(SOL_PACKET, PACKET_STATISTICS)（tp_packets 收到、tp_drops 丢弃，读取后清零，这里自行累加）
+  received 与 libpcap 一致，包含被丢弃的报文；received - dropped 才是交到用户态的报文数
+  重开句柄前先把旧句柄的计数并入累计值
+"""
+
+import os
+import socket
+import struct
+import threading
+import time
+
+from scapy.config import conf
+from scapy.data import ETH_P_ALL
+
+from ids_common import logger, COLORS
+
+# ========== 抓包会话配置 ==========
+CAPTURE_TICK = float(os.environ.get("CAPTURE_TICK", "1.0"))  # select 超时，也是 on_idle 的调用间隔（秒）
+CAPTURE_REOPEN_DELAY = 1.0  # 句柄出错后重开前的等待（秒）
+
+SOL_PACKET = getattr(socket, "SOL_PACKET", 263)
+PACKET_STATISTICS = 6
+TPACKET_STATS = struct.Struct("II")  # struct tpacket_stats { tp_packets; tp_drops; }
+
+KERNEL_COUNTERS = ("received", "dropped", "if_dropped")
+
+
+class CaptureSession:
+    def __init__(self, iface, on_packet, on_idle=None, tick=CAPTURE_TICK):
+        self.iface = iface
+        self.on_packet = on_packet
+        self.on_idle = on_idle
+        self.tick = tick
+        self.stop_event = threading.Event()
+        self.backend = None  # 打开句柄后按实际的 socket 类型确定：libpcap / af_packet
+
+        self._sock = None
+        self._lock = threading.Lock()
+        self._closed_totals = dict.fromkeys(KERNEL_COUNTERS, 0)  # 已关闭句柄的累计计数
+        self._af_packet_totals = dict.fromkeys(KERNEL_COUNTERS, 0)  # 当前 AF_PACKET 句柄已读出的计数
+        self.delivered = 0  # 交给 on_packet 的报文数
+        self.reopens = 0
+
+    # ---------- 运行 ----------
+    def run(self, deadline=None):
+        """在调用线程里抓包，直到 stop() 或到达 deadline（time.time() 时间戳）"""
+        try:
+            while not self.stop_event.is_set():
+                if deadline is not None and time.time() >= deadline:
+                    break
+                try:
+                    if self._sock is None:
+                        self._open()
+                    self._poll()
+                except Exception as e:
+                    self._close()
+                    if self.stop_event.is_set():
+                        break
+                    self.reopens += 1
+                    logger.warning(f"{COLORS['yellow']}⚠️ 抓包异常：{str(e)}（{CAPTURE_REOPEN_DELAY:g}秒后重开句柄）"
+                                   f"{COLORS['reset']}")
+                    self.stop_event.wait(CAPTURE_REOPEN_DELAY)
+                if self.on_idle is not None:
+                    self.on_idle()
+        finally:
+            self._close()
+
+    def _poll(self):
+        sock = self._sock
+        # 有报文可读时连续处理，直到本 tick 用完，再交回 on_idle
+        tick_end = time.monotonic() + self.tick
+        while not self.stop_event.is_set():
+            remain = tick_end - time.monotonic()
+            if remain <= 0 or not sock.select([sock], remain):
+                return
+            packet = sock.recv()
+            if packet is not None:
+                self.delivered += 1
+                self.on_packet(packet)
+
+    def stop(self):
+        self.stop_event.set()
+
+    # ---------- 句柄 ----------
+    def _open(self):
+        sock = conf.L2listen(iface=self.iface, type=ETH_P_ALL)
+        with self._lock:
+            self._sock = sock
+        self.backend = "libpcap" if hasattr(sock, "pcap_fd") else "af_packet"
+        logger.info(f"{COLORS['green']}📡 抓包句柄已打开：{self.iface}（{self.backend}）{COLORS['reset']}")
+
+    def _close(self):
+        with self._lock:
+            sock, self._sock = self._sock, None
+            if sock is None:
+                return
+            current = self._read_kernel_counters(sock)
+            for key in KERNEL_COUNTERS:
+                self._closed_totals[key] += current.get(key, 0)
+            self._af_packet_totals = dict.fromkeys(KERNEL_COUNTERS, 0)
+        try:
+            sock.close()
+        except Exception:
+            pass
+
+    # ---------- 统计 ----------
+    def _read_kernel_counters(self, sock):
+        """当前句柄自打开以来的内核计数；读取失败时返回空字典（调用方持有 _lock）"""
+        try:
+            if hasattr(sock, "pcap_fd"):
+                from scapy.libs.winpcapy import pcap_stat, pcap_stats
+                ps = pcap_stat()
+                if pcap_stats(sock.pcap_fd.pcap, ps) != 0:
+                    return {}
+                return {"received": ps.ps_recv, "dropped": ps.ps_drop, "if_dropped": ps.ps_ifdrop}
+            packets, drops = TPACKET_STATS.unpack(
+                sock.ins.getsockopt(SOL_PACKET, PACKET_STATISTICS, TPACKET_STATS.size))
+        except (AttributeError, OSError, struct.error):
+            return {}
+        # 每次读取后内核清零
+        self._af_packet_totals["received"] += packets
+        self._af_packet_totals["dropped"] += drops
+        return dict(self._af_packet_totals)
+
+    def stats(self):
+        with self._lock:
+            current = self._read_kernel_counters(self._sock) if self._sock is not None else {}
+            totals = {key: self._closed_totals[key] + current.get(key, 0) for key in KERNEL_COUNTERS}
+        totals["delivered"] = self.delivered
+        totals["reopens"] = self.reopens
+        return totals
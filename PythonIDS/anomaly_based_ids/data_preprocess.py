@@ -103,6 +103,31 @@ def add_differential_privacy(features, epsilon=1.0, delta=1e-5):
     noise = np.random.normal(0, sigma, features.shape)
     return features + noise
 
+def build_fused_affine(scaler, pca, save_path="./preprocessed_data/"):
+    """
+    把 StandardScaler + PCA 折叠成一个仿射变换：((x - mean) / scale - pca.mean) @ components.T = x @ W + b
+    保存为 fused_affine_W.npy (FEATURE_DIM, PCA_DIM) 与 fused_affine_b.npy (PCA_DIM,)，供 ids_common.load_preprocess 使用
+    """
+    import os
+    n_features = scaler.n_features_in_
+    mean = scaler.mean_ if scaler.mean_ is not None else np.zeros(n_features)
+    scale = scaler.scale_ if scaler.scale_ is not None else np.ones(n_features)
+    components = pca.components_
+    if pca.whiten:
+        components = components / np.sqrt(pca.explained_variance_)[:, None]
+
+    W = (components / scale).T
+    b = -(mean / scale + pca.mean_) @ components.T
+    os.makedirs(save_path, exist_ok=True)
+    np.save(os.path.join(save_path, "fused_affine_W.npy"), W)
+    np.save(os.path.join(save_path, "fused_affine_b.npy"), b)
+
+    # 与 sklearn 逐步变换做一致性校验
+    probe = np.abs(mean + scale * np.random.default_rng(0).standard_normal((1000, n_features)))
+    max_diff = np.abs(probe @ W + b - pca.transform(scaler.transform(probe))).max()
+    print(f"✅ 已生成融合仿射变换：W{W.shape} b{b.shape}，与sklearn最大误差 {max_diff:.2e}")
+    return W, b
+
 def preprocess_pipeline(data_path, save_path="./preprocessed_data/"):
     """完整预处理流水线"""
     # 1. 加载数据（接收统计信息）
@@ -137,6 +162,7 @@ def preprocess_pipeline(data_path, save_path="./preprocessed_data/"):
 
     joblib.dump(scaler, os.path.join(save_path, "scaler.pkl"))
     joblib.dump(pca, os.path.join(save_path, "pca.pkl"))
+    build_fused_affine(scaler, pca, save_path)
 
     # 新增：打印数据集统计信息
     print(f"\n📊 数据集总量统计：")
@@ -157,6 +183,13 @@ def preprocess_pipeline(data_path, save_path="./preprocessed_data/"):
     return X_train, X_test, y_train, y_test, scaler, pca, le
 
 if __name__ == "__main__":
+    import sys
+    if "--fuse-only" in sys.argv:
+        # 只根据已有的 scaler.pkl / pca.pkl 生成融合仿射变换，不重新跑预处理
+        build_fused_affine(joblib.load("./preprocessed_data/scaler.pkl"),
+                           joblib.load("./preprocessed_data/pca.pkl"),
+                           "./preprocessed_data/")
+        sys.exit(0)
     preprocess_pipeline(
         data_path=r"E:\IntelliJ IDEA 2024.2.4\Network Security\PythonIDS - 副本\CICIDS2017",
         save_path="./preprocessed_data/"
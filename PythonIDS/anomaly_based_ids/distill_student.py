@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+"""
+判别器 → 轻量学生模型蒸馏
+
+思路：
+- 实时检测时每条流是同一个12维PCA向量重复 SEQ_LEN 次送入判别器；
+  这里对 X_train.npy 的每一行同样以"重复窗口"方式取判别器的软标签（softmax）和 real_score 作为教师信号
+- 学生为 12 → hidden → hidden → (NUM_CLASSES + 1) 的两层 ReLU MLP：
+  分类头用温度 T 的 KL 蒸馏，real_score 头用 MSE 回归
+- 训练完成后导出为 NumPy 权重（transec_gan_model/student_mlp.npz），运行时由 ids_common.StudentMLP 推理
+- 在 X_test.npy 上报告：与教师的一致率、按置信度门槛的升级率、"学生+升级"组合与教师的一致率、吞吐
+
+用法：
+    python distill_student.py [--epochs 15 --hidden 64 --temperature 2.0]
+"""
+
+import argparse
+import os
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from ids_common import (
+    logger, COLORS, DEVICE, PREPROCESS_DIR, SEQ_LEN, PCA_DIM, NUM_CLASSES, STUDENT_PATH,
+    STUDENT_CONFIDENCE, STUDENT_REAL_MARGIN, load_model, StudentMLP
+)
+
+
+def teacher_targets(teacher, X, batch_size=2048):
+    """对每一行（视作重复 SEQ_LEN 次的窗口）计算判别器的 real_score 与分类 logits"""
+    reals, logits = [], []
+    with torch.no_grad():
+        for start in range(0, len(X), batch_size):
+            token = torch.tensor(X[start:start + batch_size], dtype=torch.float32, device=DEVICE)[:, None, :]
+            if hasattr(teacher, "forward_repeated"):
+                real_pred, class_pred = teacher.forward_repeated(token)
+            else:
+                real_pred, class_pred = teacher(token.expand(-1, SEQ_LEN, -1))
+            reals.append(real_pred.reshape(-1).cpu().numpy())
+            logits.append(class_pred.cpu().numpy())
+    return np.concatenate(reals).astype(np.float32), np.concatenate(logits).astype(np.float32)
+
+
+def train_student(X, teacher_real, teacher_logits, hidden, epochs, temperature, lr, batch_size, seed):
+    torch.manual_seed(seed)
+    student = nn.Sequential(
+        nn.Linear(PCA_DIM, hidden), nn.ReLU(),
+        nn.Linear(hidden, hidden), nn.ReLU(),
+        nn.Linear(hidden, teacher_logits.shape[1] + 1)
+    ).to(DEVICE)
+    optimizer = torch.optim.Adam(student.parameters(), lr=lr)
+    X_t = torch.tensor(X, dtype=torch.float32, device=DEVICE)
+    real_t = torch.tensor(teacher_real, device=DEVICE)
+    soft_t = torch.softmax(torch.tensor(teacher_logits, device=DEVICE) / temperature, dim=1)
+
+    for epoch in range(epochs):
+        perm = torch.randperm(len(X_t), device=DEVICE)
+        total = 0.0
+        for start in range(0, len(X_t), batch_size):
+            idx = perm[start:start + batch_size]
+            out = student(X_t[idx])
+            kd_loss = F.kl_div(F.log_softmax(out[:, :-1] / temperature, dim=1), soft_t[idx],
+                               reduction="batchmean") * temperature ** 2
+            real_loss = F.mse_loss(out[:, -1], real_t[idx])
+            loss = kd_loss + real_loss
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            total += loss.item() * len(idx)
+        logger.info(f"   epoch {epoch + 1}/{epochs}：loss={total / len(X_t):.5f}")
+    return student.cpu().eval()
+
+
+def to_numpy_student(student, label_classes):
+    linears = [m for m in student if isinstance(m, nn.Linear)]
+    return StudentMLP([m.weight.detach().numpy().T for m in linears],
+                      [m.bias.detach().numpy() for m in linears], label_classes)
+
+
+def report(student, teacher, X_test, y_test, normal_idx):
+    teacher_real, teacher_logits = teacher_targets(teacher, X_test)
+    teacher_pred = teacher_logits.argmax(1)
+
+    started = time.perf_counter()
+    real, prob = student.predict(X_test)
+    student_seconds = time.perf_counter() - started
+    student_pred = prob.argmax(1)
+
+    confident = student.confident_mask(real, prob, normal_idx)
+    combined = np.where(confident, student_pred, teacher_pred)
+
+    started = time.perf_counter()
+    teacher_targets(teacher, X_test[:min(len(X_test), 8192)])
+    teacher_rate = min(len(X_test), 8192) / (time.perf_counter() - started)
+
+    logger.info(f"📊 学生模型评估（X_test {len(X_test)} 条，门槛 置信度>={STUDENT_CONFIDENCE} 且 real_score>{STUDENT_REAL_MARGIN}）：")
+    logger.info(f"   学生与教师argmax一致率：{np.mean(student_pred == teacher_pred):.4%}")
+    logger.info(f"   升级率：{1.0 - confident.mean():.2%}（学生直接裁决 {int(confident.sum())} 条）")
+    logger.info(f"   学生+升级组合与教师一致率：{np.mean(combined == teacher_pred):.4%}")
+    logger.info(f"   学生直接裁决部分与教师一致率：{np.mean(student_pred[confident] == teacher_pred[confident]) if confident.any() else 1.0:.4%}")
+    logger.info(f"   准确率（对 y_test）：教师 {np.mean(teacher_pred == y_test):.4%} | 组合 {np.mean(combined == y_test):.4%}")
+    logger.info(f"   real_score 平均绝对误差：{np.abs(real - teacher_real).mean():.4f}")
+    logger.info(f"   吞吐：学生 {len(X_test) / max(student_seconds, 1e-9):.0f} 流/s | 判别器 {teacher_rate:.0f} 流/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="蒸馏轻量学生模型（第一级流分类器）")
+    parser.add_argument("--hidden", type=int, default=64)
+    parser.add_argument("--epochs", type=int, default=15)
+    parser.add_argument("--temperature", type=float, default=2.0)
+    parser.add_argument("--lr", type=float, default=1e-3)
+    parser.add_argument("--batch-size", type=int, default=1024)
+    parser.add_argument("--max-train", type=int, default=500000, help="参与蒸馏的最大样本数")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", default=STUDENT_PATH)
+    args = parser.parse_args()
+
+    teacher, _, _, _, labels = load_model(backend="eager")
+    labels = [str(label) for label in labels]
+    normal_idx = next((i for i, label in enumerate(labels) if label.lower() in ("benign", "normal")), 0)
+
+    X_train = np.load(os.path.join(PREPROCESS_DIR, "X_train.npy")).astype(np.float32)[:args.max_train]
+    X_test = np.load(os.path.join(PREPROCESS_DIR, "X_test.npy")).astype(np.float32)
+    y_test = np.load(os.path.join(PREPROCESS_DIR, "y_test.npy"))
+    logger.info(f"🔧 计算教师信号：X_train {X_train.shape}")
+    teacher_real, teacher_logits = teacher_targets(teacher, X_train)
+    if teacher_logits.shape[1] != NUM_CLASSES:
+        logger.warning(f"{COLORS['yellow']}⚠️ 判别器输出 {teacher_logits.shape[1]} 类，与 NUM_CLASSES={NUM_CLASSES} 不一致{COLORS['reset']}")
+
+    logger.info(f"🔧 训练学生模型：hidden={args.hidden}, epochs={args.epochs}, T={args.temperature}")
+    student = to_numpy_student(
+        train_student(X_train, teacher_real, teacher_logits, args.hidden, args.epochs,
+                      args.temperature, args.lr, args.batch_size, args.seed),
+        labels
+    )
+    student.save(args.output)
+    logger.info(f"{COLORS['green']}✅ 学生模型已保存：{args.output}{COLORS['reset']}")
+
+    report(student, teacher, X_test, y_test, normal_idx)
+
+
+if __name__ == "__main__":
+    main()
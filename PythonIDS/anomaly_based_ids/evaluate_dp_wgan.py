@@ -26,7 +26,8 @@ from sklearn.metrics import (classification_report, confusion_matrix,
 from torch.utils.data import DataLoader
 from tqdm import tqdm
 
-from ids_common import (DEVICE, PREPROCESS_DIR, MODEL_DIR, load_model, logger, SEQ_LEN)
+from ids_common import (DEVICE, PREPROCESS_DIR, MODEL_DIR, load_model, load_preprocess, logger, SEQ_LEN,
+                        resolve_normal_label)
 
 # 全局变量：标签列表（在 load_evaluation_data 中加载）
 _labels_cache = None
@@ -47,27 +48,6 @@ def get_label_name(idx: int) -> str:
         return str(labels[idx])
     return f"Class_{idx}"
 
-def resolve_normal_label(label_list):
-    """解析正常流量标签名称"""
-    # 处理numpy数组：先转换为列表
-    if isinstance(label_list, np.ndarray):
-        label_list = label_list.tolist()
-    
-    # 检查是否为空（转换为列表后检查）
-    if not label_list or len(label_list) == 0:
-        return "Benign"
-    
-    # 查找正常标签
-    candidates = ["benign", "normal", "benign traffic", "normal traffic", "正常", "0"]
-    for cand in candidates:
-        for label in label_list:
-            label_str = label if isinstance(label, str) else str(label)
-            if label_str.lower() == cand:
-                return label
-    
-    # 如果没找到，返回第一个标签
-    return label_list[0] if len(label_list) > 0 else "Benign"
-
 # 尝试导入 seaborn（可选，用于美观的热力图）
 try:
     import seaborn as sns
@@ -121,9 +101,9 @@ def evaluate_model(model, X_test, y_test, labels, normal_label, scaler=None, pca
     
     # 自动检测数据维度：如果X_test是16维，需要预处理；如果是12维，已经是PCA降维后的数据
     if X_test.shape[1] == 16 and scaler is not None and pca is not None:
-        logger.info("   检测到16维原始特征，使用scaler和pca进行预处理...")
-        X_test_scaled = scaler.transform(X_test)
-        X_test_pca = pca.transform(X_test_scaled)
+        preprocess = load_preprocess(scaler, pca)
+        logger.info(f"   检测到16维原始特征，使用{preprocess.name}预处理...")
+        X_test_pca = preprocess.transform(X_test)
         logger.info(f"   预处理后数据形状：X_test_pca.shape={X_test_pca.shape}")
         X_test = X_test_pca
     elif X_test.shape[1] == 12:
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+"""
+判别器编译导出工具（CPU 传感器部署用）
+
+功能：
+- 用 load_model() 加载判别器（Opacus ModuleValidator.fix 后的变体同样支持），导出为 TorchScript：
+  trace（forward + forward_repeated）→ freeze → optimize_for_inference
+- 可选导出 ONNX（动态 batch 维）
+- --detector：导出精简检测模型 detector_slim.pt（判别器权重 + 标签 + 融合预处理，实时检测启动时优先加载）
+- --verify：在 X_test.npy 的滑动窗口上与 eager 模型比对（argmax 一致率、概率/真实度最大误差、准确率）
+- --benchmark：各后端在不同 batch 下的单批延迟与吞吐对比
+
+用法：
+    python export_discriminator.py                    # 导出 TorchScript
+    python export_discriminator.py --onnx --verify    # 同时导出 ONNX 并做一致性校验
+    python export_discriminator.py --skip-export --benchmark --batch-sizes 1 8 64 256
+    python export_discriminator.py --skip-export --detector   # 只导出精简检测模型
+运行时通过环境变量 IDS_BACKEND=torchscript / onnx 选择后端（见 ids_common.select_backend）。
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+
+from ids_common import (
+    logger, COLORS, SEQ_LEN, PCA_DIM, PREPROCESS_DIR, TORCHSCRIPT_PATH, ONNX_PATH, MODEL_PATH, DETECTOR_PATH,
+    load_model, select_backend, export_detector
+)
+
+# 一致性判定阈值
+MIN_ARGMAX_AGREEMENT = 0.999
+MAX_PROB_DIFF = 1e-3
+
+
+def export_torchscript(model, path=TORCHSCRIPT_PATH):
+    """trace 而不是 script：Opacus 替换后的模块不一定可 script，trace 只记录实际执行的算子"""
+    example = torch.randn(2, SEQ_LEN, PCA_DIM)
+    token = torch.randn(2, 1, PCA_DIM)
+    with torch.no_grad():
+        traced = torch.jit.trace_module(model, {"forward": example, "forward_repeated": token}, check_trace=False)
+        frozen = torch.jit.freeze(traced, preserved_attrs=["forward_repeated"])
+        try:
+            optimized = torch.jit.optimize_for_inference(frozen, other_methods=["forward_repeated"])
+        except Exception as e:
+            logger.warning(f"{COLORS['yellow']}⚠️ optimize_for_inference 失败，保存仅 freeze 的版本：{str(e)}{COLORS['reset']}")
+            optimized = frozen
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    torch.jit.save(optimized, path)
+    logger.info(f"{COLORS['green']}✅ TorchScript 已导出：{path}{COLORS['reset']}")
+
+
+def export_onnx(model, path=ONNX_PATH, opset=17):
+    example = torch.randn(1, SEQ_LEN, PCA_DIM)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with torch.no_grad():
+        torch.onnx.export(
+            model, example, path,
+            input_names=["x"], output_names=["real_pred", "class_pred"],
+            dynamic_axes={"x": {0: "batch"}, "real_pred": {0: "batch"}, "class_pred": {0: "batch"}},
+            opset_version=opset
+        )
+    logger.info(f"{COLORS['green']}✅ ONNX 已导出：{path}{COLORS['reset']}")
+
+
+def load_test_windows(max_windows):
+    """与评估/训练一致的滑动窗口：窗口 [i, i+SEQ_LEN) 的标签取最后一个样本"""
+    X_test = np.load(os.path.join(PREPROCESS_DIR, "X_test.npy")).astype(np.float32)
+    y_test = np.load(os.path.join(PREPROCESS_DIR, "y_test.npy"))
+    count = min(len(X_test) - SEQ_LEN + 1, max_windows)
+    windows = np.lib.stride_tricks.sliding_window_view(X_test[:count + SEQ_LEN - 1], SEQ_LEN, axis=0)
+    windows = np.ascontiguousarray(windows.transpose(0, 2, 1))  # (N, SEQ_LEN, PCA_DIM)
+    return windows, y_test[SEQ_LEN - 1:SEQ_LEN - 1 + count]
+
+
+def run_backend(model, windows, batch_size=256):
+    reals, probs = [], []
+    with torch.no_grad():
+        for start in range(0, len(windows), batch_size):
+            real_pred, class_pred = model(torch.from_numpy(windows[start:start + batch_size]))
+            reals.append(real_pred.cpu().numpy().reshape(-1))
+            probs.append(torch.softmax(class_pred, dim=1).cpu().numpy())
+    return np.concatenate(reals), np.concatenate(probs)
+
+
+def verify(eager, backends, max_windows):
+    windows, y_true = load_test_windows(max_windows)
+    logger.info(f"一致性校验：X_test 滑动窗口 {windows.shape}")
+    ref_real, ref_prob = run_backend(eager, windows)
+    ref_pred = ref_prob.argmax(1)
+    logger.info(f"   eager：准确率 {np.mean(ref_pred == y_true):.4%}")
+
+    all_ok = True
+    for name, model in backends.items():
+        real, prob = run_backend(model, windows)
+        pred = prob.argmax(1)
+        agreement = float(np.mean(pred == ref_pred))
+        prob_diff = float(np.abs(prob - ref_prob).max())
+        real_diff = float(np.abs(real - ref_real).max())
+        ok = agreement >= MIN_ARGMAX_AGREEMENT and prob_diff <= MAX_PROB_DIFF
+        all_ok &= ok
+        color = COLORS["green"] if ok else COLORS["red"]
+        logger.info(f"{color}   {name}：{'通过' if ok else '未通过'} | argmax一致率 {agreement:.4%} | "
+                    f"概率最大误差 {prob_diff:.2e} | 真实度最大误差 {real_diff:.2e} | "
+                    f"准确率 {np.mean(pred == y_true):.4%}{COLORS['reset']}")
+    return all_ok
+
+
+def benchmark(backends, batch_sizes, min_seconds=0.5):
+    windows, _ = load_test_windows(max(batch_sizes))
+    logger.info(f"{'后端':<12}{'batch':>8}{'单批(ms)':>12}{'单流(us)':>12}{'吞吐(流/s)':>14}")
+    for name, model in backends.items():
+        for batch_size in batch_sizes:
+            x = torch.from_numpy(np.resize(windows, (batch_size, SEQ_LEN, PCA_DIM)))
+            with torch.no_grad():
+                for _ in range(3):
+                    model(x)  # 预热
+                iters, started = 0, time.perf_counter()
+                while iters < 10 or time.perf_counter() - started < min_seconds:
+                    model(x)
+                    iters += 1
+            per_batch = (time.perf_counter() - started) / iters
+            logger.info(f"{name:<12}{batch_size:>8}{per_batch * 1000:>12.3f}{per_batch / batch_size * 1e6:>12.1f}"
+                        f"{batch_size / per_batch:>14.0f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="导出 TorchScript/ONNX 判别器并校验一致性/性能")
+    parser.add_argument("--onnx", action="store_true", help="同时导出 ONNX（需要 onnx；运行时需要 onnxruntime）")
+    parser.add_argument("--skip-export", action="store_true", help="不导出，只对已有产物做校验/性能测试")
+    parser.add_argument("--detector", action="store_true", help="导出精简检测模型（不受 --skip-export 影响）")
+    parser.add_argument("--verify", action="store_true", help="在 X_test.npy 上与 eager 模型比对")
+    parser.add_argument("--verify-samples", type=int, default=20000, help="参与校验的最大窗口数")
+    parser.add_argument("--benchmark", action="store_true", help="各后端不同 batch 的延迟/吞吐对比")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 8, 32, 64, 256])
+    args = parser.parse_args()
+
+    # 传感器无 GPU：导出与校验统一在 CPU 上进行
+    eager, _, scaler, pca, labels = load_model(backend="eager")
+    eager = eager.cpu().eval()
+
+    if not args.skip_export:
+        export_torchscript(eager)
+        if args.onnx:
+            export_onnx(eager)
+    if args.detector:
+        max_diff = export_detector(eager, scaler, pca, labels)
+        logger.info(f"{COLORS['green']}✅ 精简检测模型已导出：{DETECTOR_PATH}（{os.path.getsize(DETECTOR_PATH) / 1024 / 1024:.1f}MB，"
+                    f"完整checkpoint {os.path.getsize(MODEL_PATH) / 1024 / 1024:.1f}MB；"
+                    f"融合预处理与sklearn最大误差 {max_diff:.2e}）{COLORS['reset']}")
+
+    if not (args.verify or args.benchmark):
+        return
+
+    backends = {"eager": eager}
+    for name, path in (("torchscript", TORCHSCRIPT_PATH), ("onnx", ONNX_PATH)):
+        if os.path.exists(path):
+            compiled = select_backend(eager, name)
+            if compiled is not eager:
+                backends[name] = compiled
+
+    ok = True
+    if args.verify:
+        ok = verify(eager, {k: v for k, v in backends.items() if k != "eager"}, args.verify_samples)
+    if args.benchmark:
+        benchmark(backends, args.batch_sizes)
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
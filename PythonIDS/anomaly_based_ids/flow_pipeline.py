@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+"""
+多进程流分片检测流水线
+
+结构：
+- 抓包进程（主进程）：常驻抓包会话（capture_session.CaptureSession）→ 按 get_flow_key 的哈希把报文分配给 N 个 worker，
+  原始报文经各自的共享内存环形缓冲（ShmRing，单生产者/单消费者）传递，不经过 pickle
+- worker 进程：各自持有一份流表分片与模型副本（torch 线程数按 worker 均分 CPU），
+  复用 realtime_detection_fixed 的 packet_callback / 判定逻辑，双向同一会话总落在同一个 worker
+- 主机级草图（host_sketches）在抓包进程里逐包更新：按会话分片后同一来源/目标的流分散在各 worker，
+  只有抓包进程看得到全部报文；主机级告警也从抓包进程推送
+- 结束时各 worker 回传统计，主进程合并后输出与单进程相同格式的最终统计
+
+用法：
+    python realtime_detection_fixed.py --workers 4
+    PIPELINE_WORKERS=4 PIPELINE_TORCH_THREADS=2 python realtime_detection_fixed.py
+"""
+
+import multiprocessing as mp
+import os
+import queue
+import signal
+import struct
+import time
+import zlib
+from multiprocessing import shared_memory
+
+import numpy as np
+from scapy.config import conf
+from scapy.layers.inet import IP, TCP, UDP
+
+from ids_common import logger, COLORS, get_flow_key
+from capture_session import CaptureSession
+
+# ========== 流水线配置 ==========
+PIPELINE_RING_MB = float(os.environ.get("PIPELINE_RING_MB", "16"))  # 每个 worker 的环形缓冲大小
+PIPELINE_TORCH_THREADS = int(os.environ.get("PIPELINE_TORCH_THREADS", "0"))  # 0 表示 CPU 核数 / worker 数
+RING_POLL_INTERVAL = 0.001  # worker 环形缓冲为空时的休眠时间（秒）
+WORKER_RESULT_TIMEOUT = 30.0  # 结束时等待 worker 回传统计的最长时间（秒）
+
+
+class ShmRing:
+    """
+    共享内存环形缓冲（单生产者/单消费者）
+    控制区 4 个 uint64：写位置 | 读位置 | 关闭标志 | 数据区容量；读写位置单调递增，取模得到偏移
+    写位置只由生产者更新、读位置只由消费者更新，8 字节对齐写入，无需加锁
+    帧格式：报文长度(u32) | 链路类型(u16) | 时间戳(f64) | 原始报文
+    """
+    HEADER_SIZE = 64
+    FRAME = struct.Struct("<IHd")
+
+    def __init__(self, name=None, size=None):
+        if name is None:
+            capacity = int(size if size is not None else PIPELINE_RING_MB * 1024 * 1024)
+            self.shm = shared_memory.SharedMemory(create=True, size=self.HEADER_SIZE + capacity)
+            self.owner = True
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+            self.owner = False
+        self._ctrl = np.ndarray((4,), dtype=np.uint64, buffer=self.shm.buf[:32])
+        if self.owner:
+            self._ctrl[:] = (0, 0, 0, capacity)
+        self.capacity = int(self._ctrl[3])
+        self._data = self.shm.buf[self.HEADER_SIZE:self.HEADER_SIZE + self.capacity]
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    @property
+    def closed(self):
+        return bool(self._ctrl[2])
+
+    def put(self, payload, linktype, timestamp):
+        """写入一帧；缓冲区剩余空间不足时返回 False（调用方计为丢弃，不阻塞抓包）"""
+        frame_size = self.FRAME.size + len(payload)
+        head, tail = int(self._ctrl[0]), int(self._ctrl[1])
+        if frame_size > self.capacity - (head - tail):
+            return False
+        self._write(head, self.FRAME.pack(len(payload), linktype, timestamp))
+        self._write(head + self.FRAME.size, payload)
+        self._ctrl[0] = head + frame_size  # 数据写完后再发布写位置
+        return True
+
+    def get(self):
+        """读出一帧 (链路类型, 时间戳, 原始报文)；为空时返回 None"""
+        tail = int(self._ctrl[1])
+        if tail == int(self._ctrl[0]):
+            return None
+        length, linktype, timestamp = self.FRAME.unpack(self._read(tail, self.FRAME.size))
+        payload = self._read(tail + self.FRAME.size, length)
+        self._ctrl[1] = tail + self.FRAME.size + length
+        return linktype, timestamp, payload
+
+    def close_writer(self):
+        self._ctrl[2] = 1
+
+    def _write(self, pos, data):
+        offset = pos % self.capacity
+        first = min(len(data), self.capacity - offset)
+        self._data[offset:offset + first] = data[:first]
+        if first < len(data):
+            self._data[:len(data) - first] = data[first:]
+
+    def _read(self, pos, length):
+        offset = pos % self.capacity
+        first = min(length, self.capacity - offset)
+        if first == length:
+            return bytes(self._data[offset:offset + length])
+        return bytes(self._data[offset:]) + bytes(self._data[:length - first])
+
+    def release(self):
+        # numpy/memoryview 视图必须先释放，否则 SharedMemory.close() 会报 BufferError
+        del self._ctrl
+        self._data.release()
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+def shard_of(packet, workers):
+    """按标准化五元组分片：双向报文得到同一个 flow_key，落在同一个 worker；非 TCP/UDP 报文交给 worker0"""
+    if not packet.haslayer(IP):
+        return 0
+    ip = packet[IP]
+    if packet.haslayer(TCP):
+        layer = packet[TCP]
+    elif packet.haslayer(UDP):
+        layer = packet[UDP]
+    else:
+        return 0
+    flow_key = get_flow_key(str(ip.src), str(ip.dst), int(layer.sport), int(layer.dport), int(ip.proto))
+    return zlib.crc32(repr(flow_key).encode()) % workers
+
+
+def _worker_main(worker_id, ring_name, result_queue, torch_threads):
+    """worker 进程入口：初始化本进程的检测引擎，从环形缓冲取报文交给 packet_callback"""
+    # Ctrl+C 由主进程处理，worker 等待环形缓冲关闭后正常收尾
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    import torch
+    import realtime_detection_fixed as rt
+
+    torch.set_num_threads(torch_threads)
+    rt.start_timestamp = time.time()
+    rt.alert_spool_dir = os.path.join(rt.alert_spool_dir, f"worker{worker_id}")  # 告警缓存按 worker 分目录，互不争用
+    rt.init_detection_engine()
+    rt.host_monitor = None  # 主机级草图由抓包进程维护（见 run_pipeline）
+    ring = ShmRing(ring_name)
+    to_layer = conf.l2types.num2layer
+    decode_errors = 0
+    logger.info(f"{COLORS['green']}🧵 worker{worker_id} 就绪（pid={os.getpid()}，torch线程={torch_threads}）{COLORS['reset']}")
+
+    while True:
+        closed = ring.closed  # 先读关闭标志再取帧，避免漏掉关闭前最后写入的报文
+        frame = ring.get()
+        if frame is None:
+            if closed:
+                break
+            rt.clean_timeout_flows()
+            time.sleep(RING_POLL_INTERVAL)
+            continue
+        linktype, timestamp, payload = frame
+        try:
+            packet = to_layer.get(linktype, conf.raw_layer)(payload)
+        except Exception:
+            decode_errors += 1
+            continue
+        packet.time = timestamp
+        rt.packet_callback(packet, timestamp)
+
+    rt.shutdown_engine()
+    stats = rt.collect_stats()
+    stats["ring_decode_errors"] = decode_errors
+    ring.release()
+    result_queue.put((worker_id, stats))
+
+
+def run_pipeline(iface, workers, capture_seconds, torch_threads=PIPELINE_TORCH_THREADS):
+    import realtime_detection_fixed as rt
+    from host_sketches import HostSketchMonitor, HOST_SKETCH_ENABLED
+
+    torch_threads = torch_threads or max(1, (os.cpu_count() or 1) // workers)
+    ctx = mp.get_context("spawn")  # 与 Windows 行为一致；每个 worker 重新加载模型，不继承抓包进程状态
+    rings = [ShmRing() for _ in range(workers)]
+    result_queue = ctx.Queue()
+    procs = [
+        ctx.Process(target=_worker_main, args=(i, ring.name, result_queue, torch_threads),
+                    name=f"ids-worker{i}", daemon=True)
+        for i, ring in enumerate(rings)
+    ]
+    for proc in procs:
+        proc.start()
+    logger.info(f"{COLORS['green']}🚀 分片流水线：{workers}个worker，每个torch线程={torch_threads}，"
+                f"环形缓冲={rings[0].capacity / 1024 / 1024:.0f}MB/worker，网卡={iface}{COLORS['reset']}")
+
+    dispatched = [0] * workers
+    dropped = [0] * workers
+    layer2num = conf.l2types.layer2num
+    rt.host_monitor = HostSketchMonitor() if HOST_SKETCH_ENABLED else None
+
+    def dispatch(packet):
+        if rt.host_monitor is not None and packet.haslayer(IP):
+            # 与 packet_callback 相同：信任/已封禁来源不计入主机级草图
+            rt.reload_trusted_ips()
+            rt.reload_blocked_ips()
+            src_ip = packet[IP].src
+            if src_ip not in rt.trusted_ips and src_ip not in rt.blocked_ips:
+                rt.observe_host_packet(packet)
+        shard = shard_of(packet, workers)
+        payload = getattr(packet, "original", None) or bytes(packet)
+        if rings[shard].put(payload, layer2num.get(packet.__class__, 1), float(packet.time)):
+            dispatched[shard] += 1
+        else:
+            dropped[shard] += 1
+
+    def check_workers():
+        if not any(proc.is_alive() for proc in procs):
+            logger.error(f"{COLORS['red']}❌ 所有worker已退出，停止抓包{COLORS['reset']}")
+            session.stop()
+
+    started = time.time()
+    conf.use_pcap = True
+    conf.verb = 0
+    session = CaptureSession(iface, dispatch, on_idle=check_workers)
+    try:
+        session.run(deadline=started + capture_seconds)
+    except KeyboardInterrupt:
+        logger.info(f"{COLORS['red']}⚠️ 手动停止{COLORS['reset']}")
+    finally:
+        for ring in rings:
+            ring.close_writer()
+        results = {}
+        deadline = time.time() + WORKER_RESULT_TIMEOUT
+        while len(results) < workers and time.time() < deadline:
+            try:
+                worker_id, stats = result_queue.get(timeout=1.0)
+                results[worker_id] = stats
+            except queue.Empty:
+                if not any(proc.is_alive() for proc in procs):
+                    break
+        for proc in procs:
+            proc.join(timeout=5)
+        for ring in rings:
+            ring.release()
+        rt.alert_dispatcher.stop()  # 发完抓包进程推送的主机级告警
+
+    if not results:
+        logger.error(f"{COLORS['red']}❌ 未收到任何worker的统计{COLORS['reset']}")
+        return
+    missing = [i for i in range(workers) if i not in results]
+    if missing:
+        logger.warning(f"{COLORS['yellow']}⚠️ 未收到worker{missing}的统计，合并结果不完整{COLORS['reset']}")
+    stats = rt.merge_stats([results[i] for i in sorted(results)])
+    stats["elapsed_time"] = int(time.time() - started)
+    stats["capture_backend"] = session.backend or ""
+    stats["capture_stats"] = session.stats()
+    if rt.host_monitor is not None:
+        stats["host_sketch"] = rt.host_monitor.counters()
+        stats["host_report"] = rt.host_monitor.report_lines()
+    stats["alert_push_success"] += rt.alert_push_success
+    stats["alert_push_failed"] += rt.alert_push_failed
+    stats["pipeline_report"] = [
+        f"worker{i}：分发{dispatched[i]}包，缓冲区满丢弃{dropped[i]}包，"
+        f"解码失败{results[i]['ring_decode_errors'] if i in results else '?'}包"
+        for i in range(workers)
+    ]
+    rt.log_final_stats(stats)
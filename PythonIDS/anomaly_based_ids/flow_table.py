@@ -0,0 +1,743 @@
+#!/usr/bin/env python3
+"""
+flow_table.py - 列式（struct-of-arrays）流表
+
+与 ids_common.flows（defaultdict + FlowStats dataclass）等价的统计，
+但所有字段存放在预分配的 NumPy 列里：
+- IPv4 地址打包为 uint32，端口 uint16，协议 uint8
+- 计数/字节/包长 min/max/sum/IAT/时间戳各占一列
+- 开放寻址（线性探测）哈希索引：槽位号 -> 列下标，删除留墓碑，空闲槽位复用
+- to_feature_vectors(slots) 一次计算多条流的 16 维特征（与 FlowStats.to_feature_vector 一致），
+  feature_vector(slot) 为单条流的标量路径
+
+实时检测设置 FLOW_TABLE=1 时通过 FlowStore 使用本表（默认仍为字典：CPython 下逐包更新比字典慢，
+列式存储换来的是每条流更小的内存，适合流数很多、内存受限的部署）：
+- FlowStore 保持 flows 原有的字典接口（flows[key] / get / pop / del / len / values），键仍为 get_flow_key 五元组
+- flows[key] 返回 FlowEntry：stats 为 FlowStatsView（按槽位读列的 FlowStats 兼容属性视图），每条流各一个，逐包不分配，
+  评分状态（is_anomaly / last_detection_packet_count / next_score_at / closed）也存放在列里，
+  只有 last_scored 等少数键放在按槽位的附加字典
+- pop（流超时结束）返回脱离表的普通字典，stats 为 FlowStats 快照，槽位随即复用
+
+用法：
+    python flow_table.py --bench --flows 100000 --packets 1000000
+基准会先校验与 FlowStats 的特征一致性及 FlowStore 接口，再对比内存占用和单包更新+评分判断耗时；
+单元测试见 test_flow_table.py。
+"""
+
+import argparse
+import copy
+import socket
+import struct
+import threading
+import time
+import tracemalloc
+
+import numpy as np
+
+N_FEATURES = 16  # 与 ids_common.FEATURE_DIM（FlowStats.to_feature_vector 的维度）一致
+
+_EMPTY = -1
+_TOMBSTONE = -2
+_MISSING = object()
+
+
+def ip_to_u32(ip):
+    return struct.unpack("!I", socket.inet_aton(ip))[0]
+
+
+def u32_to_ip(value):
+    return socket.inet_ntoa(struct.pack("!I", int(value)))
+
+
+def _normalize_key(ip_a, ip_b, port_a, port_b, proto):
+    """与 ids_common.get_flow_key 相同的归一化（较小的 (ip, port) 在前），作用于整数地址"""
+    if (ip_a, port_a) > (ip_b, port_b):
+        return (ip_b, ip_a, port_b, port_a, proto)
+    return (ip_a, ip_b, port_a, port_b, proto)
+
+
+class FlowTable:
+    """预分配列存储的流表；容量不足时按 2 倍扩容并重建索引。"""
+
+    # (列名, dtype, 初始值)
+    COLUMNS = (
+        # 归一化后的流键（与 get_flow_key 一致：较小的 (ip, port) 在前）
+        ("key_ip_a", np.uint32, 0), ("key_ip_b", np.uint32, 0),
+        ("key_port_a", np.uint16, 0), ("key_port_b", np.uint16, 0), ("proto", np.uint8, 0),
+        # 首包方向（对应 FlowStats.src_*/dst_*）
+        ("src_ip", np.uint32, 0), ("dst_ip", np.uint32, 0),
+        ("src_port", np.uint16, 0), ("dst_port", np.uint16, 0),
+        ("start_time", np.float64, 0.0), ("last_time", np.float64, 0.0),
+        ("last_packet_time", np.float64, 0.0),
+        ("fwd_packets", np.uint32, 0), ("bwd_packets", np.uint32, 0),
+        ("fwd_bytes", np.float64, 0.0), ("bwd_bytes", np.float64, 0.0),
+        ("fwd_len_max", np.float32, 0.0), ("fwd_len_min", np.float32, np.inf), ("fwd_len_sum", np.float64, 0.0),
+        ("bwd_len_max", np.float32, 0.0), ("bwd_len_min", np.float32, np.inf), ("bwd_len_sum", np.float64, 0.0),
+        ("fwd_prev_time", np.float64, np.nan), ("bwd_prev_time", np.float64, np.nan),
+        ("fwd_iat_sum", np.float64, 0.0), ("bwd_iat_sum", np.float64, 0.0),
+        # 评分状态（FlowScoringPolicy），-1 表示未设置
+        ("last_detection_packet_count", np.int32, -1), ("next_score_at", np.int32, -1),
+        ("closed", np.bool_, False),
+        ("is_anomaly", np.bool_, False),
+        ("active", np.bool_, False),
+    )
+    # FlowStats 对应的统计列（reset_counters 清空这些列，对应原来把 flow["stats"] 置为 None）
+    STATS_COLUMNS = ("src_ip", "dst_ip", "src_port", "dst_port", "start_time", "last_time",
+                     "fwd_packets", "bwd_packets", "fwd_bytes", "bwd_bytes",
+                     "fwd_len_max", "fwd_len_min", "fwd_len_sum", "bwd_len_max", "bwd_len_min", "bwd_len_sum",
+                     "fwd_prev_time", "bwd_prev_time", "fwd_iat_sum", "bwd_iat_sum")
+
+    def __init__(self, capacity=1 << 16):
+        self.capacity = 0
+        self.size = 0
+        self._free = []
+        self._next_unused = 0
+        self._init = {name: init for name, _, init in self.COLUMNS}
+        self._alloc_columns(max(16, capacity))
+        self._build_index()
+
+    # ---------- 存储 ----------
+    def _alloc_columns(self, capacity):
+        for name, dtype, init in self.COLUMNS:
+            col = np.full(capacity, init, dtype=dtype)
+            if self.capacity:
+                col[:self.capacity] = getattr(self, name)
+            setattr(self, name, col)
+        self.capacity = capacity
+
+    def _build_index(self):
+        self._mask = (1 << max(4, (self.capacity * 2 - 1).bit_length())) - 1
+        self._index = np.full(self._mask + 1, _EMPTY, dtype=np.int32)
+        self._tombstones = 0
+        for slot in np.flatnonzero(self.active):
+            self._index[self._probe_insert(self._key_of(slot))] = slot
+
+    def _key_of(self, slot):
+        return (int(self.key_ip_a[slot]), int(self.key_ip_b[slot]), int(self.key_port_a[slot]),
+                int(self.key_port_b[slot]), int(self.proto[slot]))
+
+    def _probe_insert(self, key):
+        pos = hash(key) & self._mask
+        while self._index[pos] >= 0:
+            pos = (pos + 1) & self._mask
+        return pos
+
+    def _find(self, key):
+        """返回 (索引位置, 槽位)；不存在时槽位为 -1，位置为可插入处"""
+        pos = hash(key) & self._mask
+        insert_at = -1
+        while True:
+            slot = self._index[pos]
+            if slot == _EMPTY:
+                return (insert_at if insert_at >= 0 else pos), -1
+            if slot == _TOMBSTONE:
+                if insert_at < 0:
+                    insert_at = pos
+            elif (self.key_ip_a[slot] == key[0] and self.key_ip_b[slot] == key[1]
+                  and self.key_port_a[slot] == key[2] and self.key_port_b[slot] == key[3]
+                  and self.proto[slot] == key[4]):
+                return pos, int(slot)
+            pos = (pos + 1) & self._mask
+
+    def _allocate_slot(self):
+        if self._free:
+            return self._free.pop()
+        if self._next_unused >= self.capacity:
+            self._alloc_columns(self.capacity * 2)
+            self._build_index()
+        slot = self._next_unused
+        self._next_unused += 1
+        return slot
+
+    def _reset_slot(self, slot, names=None):
+        for name in names or self._init:
+            getattr(self, name)[slot] = self._init[name]
+
+    def _get_or_insert(self, key, timestamp):
+        """按归一化键查找槽位，不存在时分配新槽位并写入流键，返回 (槽位, 是否新流)"""
+        pos, slot = self._find(key)
+        if slot >= 0:
+            return slot, False
+        capacity = self.capacity
+        slot = self._allocate_slot()
+        if self.capacity != capacity:
+            pos = self._find(key)[0]  # 扩容后索引已重建，重新定位插入位置
+        if self._index[pos] == _TOMBSTONE:
+            self._tombstones -= 1
+        self._index[pos] = slot
+        self.key_ip_a[slot], self.key_ip_b[slot], self.key_port_a[slot], self.key_port_b[slot], self.proto[slot] = key
+        self.last_packet_time[slot] = timestamp
+        self.active[slot] = True
+        self.size += 1
+        if (self.size + self._tombstones) * 2 > self._mask + 1:
+            self._build_index()
+        return slot, True
+
+    # ---------- 对外接口 ----------
+    def lookup(self, src_ip, src_port, dst_ip, dst_port, proto):
+        return self._find(_normalize_key(ip_to_u32(src_ip), ip_to_u32(dst_ip), src_port, dst_port, proto))[1]
+
+    def insert(self, src_ip, src_port, dst_ip, dst_port, proto, timestamp):
+        """只建立流（不计包，等同原 flows[key] 取到的默认条目），返回槽位"""
+        key = _normalize_key(ip_to_u32(src_ip), ip_to_u32(dst_ip), src_port, dst_port, proto)
+        return self._get_or_insert(key, timestamp)[0]
+
+    def update(self, src_ip, src_port, dst_ip, dst_port, proto, pkt_len, timestamp):
+        """按包更新流统计（语义同 FlowStats.update），返回 (槽位, 是否新流)"""
+        src_u32, dst_u32 = ip_to_u32(src_ip), ip_to_u32(dst_ip)
+        slot, is_new = self._get_or_insert(_normalize_key(src_u32, dst_u32, src_port, dst_port, proto), timestamp)
+        if is_new or not (self.fwd_packets[slot] or self.bwd_packets[slot]):
+            # 流的第一个包：确定方向与起始时间（同 FlowStats 在首包时创建）
+            self.src_ip[slot], self.dst_ip[slot] = src_u32, dst_u32
+            self.src_port[slot], self.dst_port[slot] = src_port, dst_port
+            self.start_time[slot] = timestamp
+
+        self.last_time[slot] = timestamp
+        self.last_packet_time[slot] = timestamp
+        forward = src_u32 == self.src_ip[slot] and src_port == self.src_port[slot]
+        if forward:
+            self.fwd_packets[slot] += 1
+            self.fwd_bytes[slot] += pkt_len
+            self.fwd_len_sum[slot] += pkt_len
+            if pkt_len > self.fwd_len_max[slot]:
+                self.fwd_len_max[slot] = pkt_len
+            if pkt_len < self.fwd_len_min[slot]:
+                self.fwd_len_min[slot] = pkt_len
+            prev = self.fwd_prev_time[slot]
+            if prev == prev:  # 非 NaN
+                self.fwd_iat_sum[slot] += timestamp - prev
+            self.fwd_prev_time[slot] = timestamp
+        else:
+            self.bwd_packets[slot] += 1
+            self.bwd_bytes[slot] += pkt_len
+            self.bwd_len_sum[slot] += pkt_len
+            if pkt_len > self.bwd_len_max[slot]:
+                self.bwd_len_max[slot] = pkt_len
+            if pkt_len < self.bwd_len_min[slot]:
+                self.bwd_len_min[slot] = pkt_len
+            prev = self.bwd_prev_time[slot]
+            if prev == prev:
+                self.bwd_iat_sum[slot] += timestamp - prev
+            self.bwd_prev_time[slot] = timestamp
+        return slot, is_new
+
+    def reset_counters(self, slot):
+        """清空流统计（保留流键与评分状态），下一个包按首包重新确定方向"""
+        self._reset_slot(slot, self.STATS_COLUMNS)
+
+    def remove(self, slot):
+        pos, found = self._find(self._key_of(slot))
+        if found != slot:
+            return
+        self._index[pos] = _TOMBSTONE
+        self._tombstones += 1
+        self._reset_slot(slot)
+        self._free.append(slot)
+        self.size -= 1
+
+    def expire(self, now, timeout):
+        """删除 last_packet_time 早于 now - timeout 的流，返回被删除的槽位"""
+        expired = np.flatnonzero(self.active & (self.last_packet_time < now - timeout))
+        for slot in expired:
+            self.remove(int(slot))
+        return expired
+
+    def active_slots(self):
+        return np.flatnonzero(self.active)
+
+    def packets(self, slot):
+        return int(self.fwd_packets[slot]) + int(self.bwd_packets[slot])
+
+    def feature_vector(self, slot):
+        """单条流的 16 维特征（逐包路径，标量计算，与 to_feature_vectors / FlowStats.to_feature_vector 一致）"""
+        fwd_p, bwd_p = int(self.fwd_packets[slot]), int(self.bwd_packets[slot])
+        fwd_bytes, bwd_bytes = float(self.fwd_bytes[slot]), float(self.bwd_bytes[slot])
+        duration = max(float(self.last_time[slot] - self.start_time[slot]), 1e-6)
+        fwd_min, bwd_min = float(self.fwd_len_min[slot]), float(self.bwd_len_min[slot])
+        fwd_iat = float(self.fwd_iat_sum[slot]) / (fwd_p - 1) if fwd_p > 1 else 0.0
+        bwd_iat = float(self.bwd_iat_sum[slot]) / (bwd_p - 1) if bwd_p > 1 else 0.0
+        return np.array([
+            self.dst_port[slot],
+            duration * 1e6,
+            fwd_p,
+            bwd_p,
+            fwd_bytes,
+            bwd_bytes,
+            self.fwd_len_max[slot],
+            0.0 if fwd_min == np.inf else fwd_min,
+            float(self.fwd_len_sum[slot]) / (fwd_p or 1),
+            self.bwd_len_max[slot],
+            0.0 if bwd_min == np.inf else bwd_min,
+            float(self.bwd_len_sum[slot]) / (bwd_p or 1),
+            (fwd_bytes + bwd_bytes) / duration,
+            (fwd_p + bwd_p) / duration,
+            fwd_iat * 1e6,
+            bwd_iat * 1e6,
+        ], dtype=np.float32)
+
+    def to_feature_vectors(self, slots):
+        """(n,) 槽位 -> (n, N_FEATURES) float32，逐项与 FlowStats.to_feature_vector 一致"""
+        slots = np.asarray(slots, dtype=np.int64)
+        fwd_p = self.fwd_packets[slots].astype(np.float64)
+        bwd_p = self.bwd_packets[slots].astype(np.float64)
+        duration = np.maximum(self.last_time[slots] - self.start_time[slots], 1e-6)
+        total_bytes = self.fwd_bytes[slots] + self.bwd_bytes[slots]
+        fwd_min = self.fwd_len_min[slots]
+        bwd_min = self.bwd_len_min[slots]
+        fwd_iat = np.where(fwd_p > 1, self.fwd_iat_sum[slots] / np.maximum(fwd_p - 1, 1), 0.0)
+        bwd_iat = np.where(bwd_p > 1, self.bwd_iat_sum[slots] / np.maximum(bwd_p - 1, 1), 0.0)
+
+        out = np.empty((len(slots), N_FEATURES), dtype=np.float32)
+        out[:, 0] = self.dst_port[slots]
+        out[:, 1] = duration * 1e6
+        out[:, 2] = fwd_p
+        out[:, 3] = bwd_p
+        out[:, 4] = self.fwd_bytes[slots]
+        out[:, 5] = self.bwd_bytes[slots]
+        out[:, 6] = self.fwd_len_max[slots]
+        out[:, 7] = np.where(np.isinf(fwd_min), 0.0, fwd_min)
+        out[:, 8] = self.fwd_len_sum[slots] / np.where(fwd_p > 0, fwd_p, 1)
+        out[:, 9] = self.bwd_len_max[slots]
+        out[:, 10] = np.where(np.isinf(bwd_min), 0.0, bwd_min)
+        out[:, 11] = self.bwd_len_sum[slots] / np.where(bwd_p > 0, bwd_p, 1)
+        out[:, 12] = total_bytes / duration
+        out[:, 13] = (fwd_p + bwd_p) / duration
+        out[:, 14] = fwd_iat * 1e6
+        out[:, 15] = bwd_iat * 1e6
+        return out
+
+    def stats_fields(self, slot):
+        """单条流的 FlowStats 构造参数（Python 标量；prev_time 未设置时为 None）"""
+        fields = {}
+        for name in self.STATS_COLUMNS:
+            value = getattr(self, name)[slot].item()
+            if name in ("src_ip", "dst_ip"):
+                value = u32_to_ip(value)
+            elif name.endswith("_prev_time") and value != value:
+                value = None
+            fields[name] = value
+        fields["proto"] = int(self.proto[slot])
+        return fields
+
+    def memory_bytes(self):
+        cols = sum(getattr(self, name).nbytes for name, _, _ in self.COLUMNS)
+        return cols + self._index.nbytes
+
+
+def _stats_property(name, convert):
+    return property(lambda self: convert(getattr(self.store.table, name)[self.slot]),
+                    doc=f"FlowStats.{name}")
+
+
+def _optional_time(value):
+    value = float(value)
+    return None if value != value else value
+
+
+class FlowStatsView:
+    """
+    FlowStats 兼容的只读属性视图：按槽位读取 FlowTable 的列
+    判定链（verdict_rules.flow_facts）、评分策略、告警负载直接读属性；to_feature_vector 走表的标量路径
+    copy.copy() 返回 FlowStats 快照（批处理入队时固定流就绪时刻的统计）
+    """
+    __slots__ = ("store", "slot")
+
+    def __init__(self, store, slot):
+        self.store = store
+        self.slot = slot
+
+    src_ip = _stats_property("src_ip", u32_to_ip)
+    dst_ip = _stats_property("dst_ip", u32_to_ip)
+    src_port = _stats_property("src_port", int)
+    dst_port = _stats_property("dst_port", int)
+    proto = _stats_property("proto", int)
+    start_time = _stats_property("start_time", float)
+    last_time = _stats_property("last_time", float)
+    fwd_packets = _stats_property("fwd_packets", int)
+    bwd_packets = _stats_property("bwd_packets", int)
+    fwd_bytes = _stats_property("fwd_bytes", float)
+    bwd_bytes = _stats_property("bwd_bytes", float)
+    fwd_len_max = _stats_property("fwd_len_max", float)
+    fwd_len_min = _stats_property("fwd_len_min", float)
+    fwd_len_sum = _stats_property("fwd_len_sum", float)
+    bwd_len_max = _stats_property("bwd_len_max", float)
+    bwd_len_min = _stats_property("bwd_len_min", float)
+    bwd_len_sum = _stats_property("bwd_len_sum", float)
+    fwd_prev_time = _stats_property("fwd_prev_time", _optional_time)
+    bwd_prev_time = _stats_property("bwd_prev_time", _optional_time)
+    fwd_iat_sum = _stats_property("fwd_iat_sum", float)
+    bwd_iat_sum = _stats_property("bwd_iat_sum", float)
+
+    def to_feature_vector(self):
+        return self.store.table.feature_vector(self.slot)
+
+    def __copy__(self):
+        return self.store.stats_cls(**self.store.table.stats_fields(self.slot))
+
+
+class FlowEntry:
+    """
+    flows[flow_key] 的字典接口（评分策略、增量门控、判定结果按 flow["..."] 读写）
+    - stats：FlowStatsView；流还没有计过包（或被置为 None）时为 None
+    - last_packet_time / is_anomaly / closed / last_detection_packet_count / next_score_at 读写列
+    - 其余键（last_scored、delta_gate_expected）放在 FlowStore 按槽位的附加字典
+    每条流只创建一个 FlowEntry（FlowStore 按槽位缓存）和一个 FlowStatsView，逐包访问不再分配对象
+    流被删除时 FlowStore 把该流的 FlowEntry 标记为脱离，之后的读写只作用于条目自己的字典
+    （相当于原来对已删除流的字典继续写入，不影响复用该槽位的新流）
+    """
+    __slots__ = ("store", "slot", "_detached", "_view")
+
+    COLUMN_KEYS = ("last_packet_time", "is_anomaly", "closed")
+    OPTIONAL_KEYS = ("last_detection_packet_count", "next_score_at")  # 列值 -1 表示键不存在
+
+    def __init__(self, store, slot):
+        self.store = store
+        self.slot = slot
+        self._detached = None
+        self._view = FlowStatsView(store, slot)
+
+    def get(self, key, default=None):
+        if self._detached is not None:
+            return self._detached.get(key, default)
+        table = self.store.table
+        if key == "stats":
+            return self._view if table.packets(self.slot) else None
+        if key in self.COLUMN_KEYS:
+            return getattr(table, key)[self.slot].item()
+        if key in self.OPTIONAL_KEYS:
+            value = int(getattr(table, key)[self.slot])
+            return default if value < 0 else value
+        return self.store.extras(self.slot).get(key, default)
+
+    def __getitem__(self, key):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __setitem__(self, key, value):
+        with self.store.lock:
+            if self._detached is not None:
+                self._detached[key] = value
+                return
+            table = self.store.table
+            if key == "stats":
+                if value is not None:
+                    raise TypeError("flow['stats'] 由流表维护，只能置为 None（清空统计）")
+                table.reset_counters(self.slot)
+            elif key in self.COLUMN_KEYS or key in self.OPTIONAL_KEYS:
+                getattr(table, key)[self.slot] = value
+            else:
+                self.store.extras(self.slot, create=True)[key] = value
+
+    def pop(self, key, default=_MISSING):
+        with self.store.lock:
+            value = self.get(key, _MISSING)
+            if value is not _MISSING and self._detached is None:
+                if key in self.OPTIONAL_KEYS:
+                    getattr(self.store.table, key)[self.slot] = -1
+                elif key != "stats" and key not in self.COLUMN_KEYS:
+                    self.store.extras(self.slot).pop(key, None)
+            elif value is not _MISSING:
+                self._detached.pop(key, None)
+        if value is _MISSING:
+            if default is _MISSING:
+                raise KeyError(key)
+            return default
+        return value
+
+
+class FlowStore:
+    """
+    以 FlowTable 为存储的 flows，接口与原 defaultdict 一致：键为 get_flow_key 的字符串五元组，
+    flows[key] 不存在时新建（同 defaultdict），get/pop/del/len/values 与字典相同
+    pop 返回脱离表的普通字典（stats 为 stats_cls 快照），供流超时结束后评分，槽位随即可复用
+    lock：推理线程写判定结果与抓包线程更新/扩容/删除之间互斥（读不加锁）
+    """
+
+    def __init__(self, stats_cls, capacity=1 << 16):
+        self.table = FlowTable(capacity)
+        self.stats_cls = stats_cls
+        self.lock = threading.Lock()
+        self._extras = {}
+        self._entries = []  # 槽位 -> FlowEntry（首次访问时创建，流删除时清除）
+        self._last = None  # 最近一次 update 的 (flow_key, 槽位)，packet_callback 紧接着取同一条流
+
+    def extras(self, slot, create=False):
+        extras = self._extras.get(slot)
+        if extras is None:
+            extras = {}
+            if create:
+                self._extras[slot] = extras
+        return extras
+
+    def _entry(self, slot):
+        entries = self._entries
+        if slot >= len(entries):
+            entries.extend([None] * (self.table.capacity - len(entries)))
+        entry = entries[slot]
+        if entry is None:
+            entry = entries[slot] = FlowEntry(self, slot)
+        return entry
+
+    def update(self, flow_key, src_ip, src_port, dst_ip, dst_port, proto, pkt_len, timestamp):
+        """按包更新流统计，返回槽位（不创建 FlowEntry；需要时用 flows[flow_key] 取）"""
+        with self.lock:
+            slot, _ = self.table.update(src_ip, src_port, dst_ip, dst_port, proto, pkt_len, timestamp)
+        self._last = (flow_key, slot)
+        return slot
+
+    def _slot(self, flow_key):
+        last = self._last
+        if last is not None and last[0] == flow_key:
+            return last[1]
+        ip_a, ip_b, port_a, port_b, proto = flow_key
+        return self.table.lookup(ip_a, port_a, ip_b, port_b, proto)
+
+    def get(self, flow_key, default=None):
+        slot = self._slot(flow_key)
+        return default if slot < 0 else self._entry(slot)
+
+    def __getitem__(self, flow_key):
+        slot = self._slot(flow_key)
+        if slot < 0:
+            ip_a, ip_b, port_a, port_b, proto = flow_key
+            with self.lock:
+                slot = self.table.insert(ip_a, port_a, ip_b, port_b, proto, time.time())
+        return self._entry(slot)
+
+    def __contains__(self, flow_key):
+        return self._slot(flow_key) >= 0
+
+    def __len__(self):
+        return self.table.size
+
+    def values(self):
+        return [self._entry(int(slot)) for slot in self.table.active_slots()]
+
+    def _detach(self, slot):
+        """把槽位的内容复制成普通字典并释放槽位（调用方持有 lock）"""
+        table = self.table
+        flow = {
+            "stats": self.stats_cls(**table.stats_fields(slot)) if table.packets(slot) else None,
+            "last_packet_time": float(table.last_packet_time[slot]),
+            "is_anomaly": bool(table.is_anomaly[slot]),
+            "closed": bool(table.closed[slot]),
+        }
+        for key in FlowEntry.OPTIONAL_KEYS:
+            value = int(getattr(table, key)[slot])
+            if value >= 0:
+                flow[key] = value
+        flow.update(self._extras.pop(slot, {}))
+        table.remove(slot)
+        if slot < len(self._entries) and self._entries[slot] is not None:
+            # 推理队列里可能还持有该条目：标记脱离，之后的写入不会落到复用此槽位的新流
+            self._entries[slot]._detached = {}
+            self._entries[slot] = None
+        if self._last is not None and self._last[1] == slot:
+            self._last = None
+        return flow
+
+    def pop(self, flow_key, default=_MISSING):
+        with self.lock:
+            slot = self._slot(flow_key)
+            if slot >= 0:
+                return self._detach(slot)
+        if default is _MISSING:
+            raise KeyError(flow_key)
+        return default
+
+    def __delitem__(self, flow_key):
+        self.pop(flow_key)
+
+    def memory_bytes(self):
+        return self.table.memory_bytes()
+
+
+# -------------------------
+# 一致性校验与基准（需要 ids_common，按需导入，避免与 ids_common 循环导入）
+# -------------------------
+def _synthetic_packets(n_flows, n_packets, seed=0):
+    rng = np.random.default_rng(seed)
+    flow_ids = rng.integers(0, n_flows, n_packets)
+    reverse = rng.random(n_packets) < 0.4
+    lengths = rng.integers(40, 1500, n_packets)
+    times = 1_700_000_000.0 + np.cumsum(rng.exponential(1e-4, n_packets))
+    clients = [f"10.{(i >> 16) & 255}.{(i >> 8) & 255}.{i & 255}" for i in range(n_flows)]
+    ports = rng.integers(1024, 65535, n_flows)
+    for fid, rev, length, ts in zip(flow_ids.tolist(), reverse.tolist(), lengths.tolist(), times.tolist()):
+        if rev:
+            yield "192.168.1.1", 80, clients[fid], int(ports[fid]), 6, float(length), ts
+        else:
+            yield clients[fid], int(ports[fid]), "192.168.1.1", 80, 6, float(length), ts
+
+
+def _run_legacy(packets):
+    """FLOW_TABLE=0：flows 字典 + FlowStats，逐包走 extract_features 与 packet_callback 的评分判断"""
+    from collections import defaultdict
+    from ids_common import FlowStats, get_flow_key
+    flows = defaultdict(lambda: {"last_packet_time": 0.0, "is_anomaly": False, "stats": None})
+    for src, sport, dst, dport, proto, length, ts in packets:
+        flow_key = get_flow_key(src, dst, sport, dport, proto)
+        flow = flows[flow_key]
+        flow["last_packet_time"] = ts
+        if flow["stats"] is None:
+            flow["stats"] = FlowStats(src_ip=src, src_port=sport, dst_ip=dst, dst_port=dport, proto=proto,
+                                      start_time=ts, last_time=ts)
+        flow["stats"].update(src, sport, dst, dport, length, ts)  # 逐包返回特征向量
+        _bench_checkpoint(flows[flow_key], None)
+    return flows
+
+
+def _bench_checkpoint(flow, on_score):
+    """评分判断（同 FlowScoringPolicy 的包数检查点，首个 16、之后翻倍）；到达检查点时调用 on_score(stats)"""
+    stats = flow["stats"]
+    packets = stats.fwd_packets + stats.bwd_packets
+    if packets >= flow.get("next_score_at", 16):
+        if on_score is not None:
+            on_score(stats)
+        flow["next_score_at"] = packets * 2
+
+
+def _run_table(packets, capacity):
+    table = FlowTable(capacity)
+    for src, sport, dst, dport, proto, length, ts in packets:
+        table.update(src, sport, dst, dport, proto, length, ts)
+    return table
+
+
+def _run_store(packets, capacity):
+    """FLOW_TABLE=1：FlowStore.update，评分判断读 FlowEntry/FlowStatsView，只在评分时计算特征向量"""
+    from ids_common import FlowStats, get_flow_key
+    store = FlowStore(FlowStats, capacity)
+    score = FlowStatsView.to_feature_vector
+    for src, sport, dst, dport, proto, length, ts in packets:
+        flow_key = get_flow_key(src, dst, sport, dport, proto)
+        store.update(flow_key, src, sport, dst, dport, proto, length, ts)
+        _bench_checkpoint(store[flow_key], score)
+    return store
+
+
+def _check_store(legacy, packets):
+    """FlowStore 的字典接口：stats 视图、评分状态读写、pop 快照、槽位复用后旧条目脱离"""
+    store = _run_store(packets, 1024)
+    keys = list(legacy.keys())
+    ok = len(store) == len(legacy)
+    for k in keys[:200]:
+        entry, stats = store[k], legacy[k]["stats"]
+        view = entry["stats"]
+        ok &= np.allclose(view.to_feature_vector(), stats.to_feature_vector(), rtol=1e-5, atol=1e-3)
+        ok &= (view.src_ip, view.dst_ip, view.src_port, view.fwd_packets) == \
+              (stats.src_ip, stats.dst_ip, stats.src_port, stats.fwd_packets)
+        ok &= copy.copy(view) == stats
+        ok &= store[k] is entry and entry["stats"] is view  # 每条流只有一个 FlowEntry/FlowStatsView
+
+    k = keys[0]
+    entry = store[k]
+    ok &= "last_detection_packet_count" not in entry
+    entry.pop("next_score_at", None)
+    ok &= "next_score_at" not in entry and entry.get("next_score_at", 16) == 16
+    entry["last_detection_packet_count"] = 5
+    entry["last_scored"] = ("features", ("BENIGN", 0.99, 0.5))
+    entry["is_anomaly"] = True
+    ok &= entry["last_detection_packet_count"] == 5 and store[k]["is_anomaly"] is True
+    ok &= entry.pop("delta_gate_expected", None) is None
+
+    flow = store.pop(k)
+    ok &= k not in store and flow["stats"] == legacy[k]["stats"] and flow["is_anomaly"]
+    ok &= flow["last_detection_packet_count"] == 5 and flow["last_scored"][1][0] == "BENIGN"
+    # 槽位被新流复用后，旧条目的写入不影响新流
+    new_key = ("1.1.1.1", "2.2.2.2", 1, 2, 17)
+    new_slot = store.update(new_key, "1.1.1.1", 1, "2.2.2.2", 2, 17, 60.0, 1.0)
+    entry["is_anomaly"] = False
+    entry["last_scored"] = None
+    new_entry = store[new_key]
+    ok &= new_slot == entry.slot and new_entry is not entry
+    ok &= not new_entry["is_anomaly"] and "last_scored" not in new_entry and entry["last_scored"] is None
+    ok &= store.get(k) is None and store[k]["stats"] is None  # 同 defaultdict：不存在时新建空条目
+    return bool(ok)
+
+
+def check_parity(n_flows=2000, n_packets=50000):
+    packets = list(_synthetic_packets(n_flows, n_packets, seed=1))
+    legacy = _run_legacy(packets)
+    table = _run_table(packets, 1024)  # 故意从小容量开始，覆盖扩容路径
+    keys = list(legacy.keys())
+    slots = [table.lookup(k[0], k[2], k[1], k[3], k[4]) for k in keys]
+    expected = np.stack([legacy[k]["stats"].to_feature_vector() for k in keys])
+    actual = table.to_feature_vectors(slots)
+    single = np.stack([table.feature_vector(slot) for slot in slots])
+    max_diff = float(np.max(np.abs(expected - actual) / np.maximum(np.abs(expected), 1.0)))
+    ok = table.size == len(legacy) and np.allclose(expected, actual, rtol=1e-5, atol=1e-3)
+    ok &= np.allclose(expected, single, rtol=1e-5, atol=1e-3)
+
+    # 删除与槽位复用
+    for slot in slots[: len(slots) // 2]:
+        table.remove(slot)
+    reuse_ok = table.size == len(keys) - len(keys) // 2
+    k = keys[0]
+    new_slot, is_new = table.update(k[0], k[2], k[1], k[3], k[4], 100.0, 1_800_000_000.0)
+    reuse_ok &= is_new and new_slot in set(slots[: len(slots) // 2])
+    return bool(ok and reuse_ok and _check_store(legacy, packets)), max_diff
+
+
+def _measure(fn, *args):
+    """先不开 tracemalloc 计时（避免拖慢分配），再单独跑一遍测内存"""
+    started = time.perf_counter()
+    result = fn(*args)
+    elapsed = time.perf_counter() - started
+    del result
+    tracemalloc.start()
+    result = fn(*args)
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, elapsed, memory
+
+
+def benchmark(n_flows, n_packets):
+    from ids_common import logger
+    packets = list(_synthetic_packets(n_flows, n_packets))
+    legacy, legacy_time, legacy_mem = _measure(_run_legacy, packets)
+    del legacy
+    table, table_time, table_mem = _measure(_run_table, packets, n_flows)
+    store, store_time, store_mem = _measure(_run_store, packets, n_flows)
+    del store
+
+    slots = table.active_slots()
+    started = time.perf_counter()
+    table.to_feature_vectors(slots)
+    vec_time = time.perf_counter() - started
+
+    flows = max(table.size, 1)
+    logger.info(f"📊 流表基准：{table.size} 条流 / {n_packets} 个包")
+    logger.info(f"   dict+FlowStats（FLOW_TABLE=0）：内存 {legacy_mem / 1e6:.1f}MB（{legacy_mem / flows:.0f}B/流），"
+                f"更新+评分判断 {legacy_time / n_packets * 1e6:.2f}us/包")
+    logger.info(f"   FlowTable（列存储，仅更新）：内存 {table_mem / 1e6:.1f}MB（{table.memory_bytes() / flows:.0f}B/流），"
+                f"更新 {table_time / n_packets * 1e6:.2f}us/包")
+    logger.info(f"   FlowStore（FLOW_TABLE=1）：内存 {store_mem / 1e6:.1f}MB（{store_mem / flows:.0f}B/流），"
+                f"更新+评分判断 {store_time / n_packets * 1e6:.2f}us/包")
+    logger.info(f"   批量特征：{len(slots)} 条流 {vec_time * 1000:.2f}ms（{vec_time / flows * 1e6:.3f}us/流）")
+
+
+def main():
+    from ids_common import logger, COLORS
+    parser = argparse.ArgumentParser(description="列式流表：一致性校验与基准")
+    parser.add_argument("--bench", action="store_true", help="运行内存/更新耗时基准")
+    parser.add_argument("--flows", type=int, default=100000)
+    parser.add_argument("--packets", type=int, default=1000000)
+    args = parser.parse_args()
+
+    ok, max_diff = check_parity()
+    color = COLORS["green"] if ok else COLORS["red"]
+    logger.info(f"{color}{'✅' if ok else '❌'} 与 FlowStats 特征一致性 / FlowStore 接口：{'通过' if ok else '未通过'}"
+                f"（最大相对误差 {max_diff:.2e}）{COLORS['reset']}")
+    if args.bench:
+        benchmark(args.flows, args.packets)
+    raise SystemExit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,350 @@
+#!/usr/bin/env python3
+"""
+主机级流式草图：跨流聚合，检测单条流看不出来的端口扫描/主机扫描与分布式洪泛
+
+模型与判定规则一次只看一条流：端口扫描是同一来源的大量短流，分布式洪泛是大量来源打向同一目标，
+都不会形成一条可疑的流。这里逐包更新固定内存的草图，在滑动窗口上按主机判定：
+- HyperLogLog：每个来源访问的不同目的端口数 / 不同目的主机数，每个目标的不同来源数
+  （键哈希到 HOST_HLL_ROWS 行 × HOST_HLL_CELLS 个 HLL，取各行估计的最小值，碰撞只会高估）
+- Count-Min：每个目标收到的包数/字节数（洪泛速率按最近一个子窗口计，不被整个窗口平均稀释）
+- Space-Saving：包数最多的来源/目标（重流量主机），作为洪泛判定的候选并写入最终统计
+
+滑动窗口 = HOST_WINDOW_BUCKETS 个子窗口（每个 HOST_WINDOW_SECONDS / HOST_WINDOW_BUCKETS 秒），
+报文时间跨入新的子窗口时对刚结束的整个窗口判定一次，再清空最旧的子窗口复用。
+HLL 按寄存器取各子窗口的最大值合并，Count-Min / Space-Saving 按计数相加合并。
+判定候选只取本子窗口内 HLL 寄存器有增长的主机（新出现的端口/主机/来源）与重流量目标，不逐包估计。
+
+用法：
+    from host_sketches import HostSketchMonitor
+    monitor = HostSketchMonitor()
+    for alert in monitor.update(src_ip, dst_ip, dst_port, proto, length, timestamp):
+        ...  # HostAlert
+"""
+
+import array
+import functools
+import os
+from collections import OrderedDict
+from dataclasses import dataclass
+
+import numpy as np
+
+# ========== 草图配置 ==========
+HOST_SKETCH_ENABLED = os.environ.get("HOST_SKETCH", "1") == "1"
+HOST_WINDOW_SECONDS = float(os.environ.get("HOST_WINDOW_SECONDS", "60"))
+HOST_WINDOW_BUCKETS = int(os.environ.get("HOST_WINDOW_BUCKETS", "6"))
+HOST_CM_WIDTH = int(os.environ.get("HOST_CM_WIDTH", "2048"))
+HOST_CM_DEPTH = int(os.environ.get("HOST_CM_DEPTH", "4"))
+HOST_HLL_CELLS = int(os.environ.get("HOST_HLL_CELLS", "1024"))
+HOST_HLL_ROWS = int(os.environ.get("HOST_HLL_ROWS", "2"))
+HOST_HLL_PRECISION = int(os.environ.get("HOST_HLL_PRECISION", "6"))  # 每个 HLL 2^p 个寄存器，标准误差约 1.04/sqrt(2^p)
+HOST_HEAVY_HITTERS = int(os.environ.get("HOST_HEAVY_HITTERS", "64"))  # Space-Saving 每个子窗口跟踪的主机数
+HOST_MAX_CANDIDATES = int(os.environ.get("HOST_MAX_CANDIDATES", "4096"))  # 每个子窗口待判定主机数上限
+HOST_KEY_CACHE = int(os.environ.get("HOST_KEY_CACHE", "65536"))  # IP → (哈希, HLL 偏移, Count-Min 位置) 缓存条数
+
+# 判定阈值（计数按整个窗口，速率按最近一个子窗口）
+HOST_SCAN_PORTS = int(os.environ.get("HOST_SCAN_PORTS", "100"))  # 单个来源访问的不同目的端口数
+HOST_SWEEP_HOSTS = int(os.environ.get("HOST_SWEEP_HOSTS", "50"))  # 单个来源访问的不同目的主机数
+HOST_FLOOD_PPS = float(os.environ.get("HOST_FLOOD_PPS", "2000"))  # 单个目标的包速率
+HOST_FLOOD_BPS = float(os.environ.get("HOST_FLOOD_BPS", str(20 * 1024 * 1024)))  # 单个目标的字节速率
+HOST_FLOOD_SOURCES = int(os.environ.get("HOST_FLOOD_SOURCES", "50"))  # 洪泛还要求的不同来源数（排除单一来源的大流量下载）
+HOST_ALERT_COOLDOWN = float(os.environ.get("HOST_ALERT_COOLDOWN", str(HOST_WINDOW_SECONDS)))  # 同一主机同类告警的最短间隔
+
+_M64 = (1 << 64) - 1
+
+
+def _mix64(x):
+    """64 位整数终结混合（murmur3 fmix64），把 hash() 的结果打散成均匀的 64 位"""
+    x &= _M64
+    x ^= x >> 33
+    x = (x * 0xff51afd7ed558ccd) & _M64
+    x ^= x >> 33
+    x = (x * 0xc4ceb9fe1a85ec53) & _M64
+    return x ^ (x >> 33)
+
+
+def _hll_alpha(m):
+    return {16: 0.673, 32: 0.697, 64: 0.709}.get(m, 0.7213 / (1 + 1.079 / m))
+
+
+def hll_estimate(registers):
+    """registers: [..., m] uint8；返回各 HLL 的基数估计（小基数用线性计数修正）"""
+    m = registers.shape[-1]
+    raw = _hll_alpha(m) * m * m / np.exp2(-registers.astype(np.float64)).sum(axis=-1)
+    zeros = (registers == 0).sum(axis=-1)
+    linear = m * np.log(m / np.maximum(zeros, 1))
+    return np.where((raw <= 2.5 * m) & (zeros > 0), linear, raw)
+
+
+class SpaceSaving:
+    """Space-Saving 重流量统计：最多 capacity 个键，满了替换计数最小的键（新键继承其计数作为误差上界）"""
+
+    def __init__(self, capacity=HOST_HEAVY_HITTERS):
+        self.capacity = max(1, capacity)
+        self.counts = {}
+        self.errors = {}
+
+    def add(self, key, weight=1):
+        counts = self.counts
+        if key in counts:
+            counts[key] += weight
+            return
+        if len(counts) < self.capacity:
+            counts[key] = weight
+            self.errors[key] = 0
+            return
+        victim = min(counts, key=counts.get)
+        floor = counts.pop(victim)
+        self.errors.pop(victim)
+        counts[key] = floor + weight
+        self.errors[key] = floor
+
+    def clear(self):
+        self.counts.clear()
+        self.errors.clear()
+
+
+def merge_heavy_hitters(sketches, top=None):
+    """合并多个子窗口的 Space-Saving：[(键, 计数, 误差上界)]，按计数降序"""
+    counts, errors = {}, {}
+    for sketch in sketches:
+        for key, count in sketch.counts.items():
+            counts[key] = counts.get(key, 0) + count
+            errors[key] = errors.get(key, 0) + sketch.errors[key]
+    ranked = sorted(counts, key=counts.get, reverse=True)
+    return [(key, counts[key], errors[key]) for key in (ranked[:top] if top else ranked)]
+
+
+class HllCells:
+    """rows × cells 个 HLL，按子窗口分片：[buckets, rows * cells * m] uint8
+    逐包更新走 bytearray（标量读写比 numpy 下标快一个数量级），判定时用零拷贝的 numpy 视图"""
+
+    def __init__(self, buckets, rows=HOST_HLL_ROWS, cells=HOST_HLL_CELLS, precision=HOST_HLL_PRECISION):
+        self.rows, self.cells, self.precision = rows, cells, precision
+        self.m = 1 << precision
+        self.size = rows * cells * self.m
+        self._buffer = bytearray(buckets * self.size)
+        self.registers = np.frombuffer(self._buffer, dtype=np.uint8).reshape(buckets, self.size)
+
+    def offsets(self, key_hash):
+        """键在每一行对应的 HLL 起始偏移（双重哈希取行下标）"""
+        h1, h2 = key_hash & 0xffffffff, (key_hash >> 32) | 1
+        cells, m = self.cells, self.m
+        return [(row * cells + (h1 + row * h2) % cells) * m for row in range(self.rows)]
+
+    def add(self, slot, offsets, value_hash):
+        """加入一个元素；任一行寄存器变大时返回 True（出现了新的元素）"""
+        p = self.precision
+        start = slot * self.size + (value_hash & (self.m - 1))
+        rank = 64 - p - (value_hash >> p).bit_length() + 1
+        registers = self._buffer
+        grew = False
+        for base in offsets:
+            if registers[start + base] < rank:
+                registers[start + base] = rank
+                grew = True
+        return grew
+
+    def estimate(self, key_hashes):
+        """整个窗口（各子窗口寄存器取最大值）上每个键的基数估计，取各行最小值"""
+        if not key_hashes:
+            return np.zeros(0)
+        offsets = np.array([self.offsets(h) for h in key_hashes], dtype=np.int64)  # [n, rows]
+        gather = offsets[:, :, None] + np.arange(self.m)  # [n, rows, m]
+        merged = self.registers[:, gather].max(axis=0)
+        return hll_estimate(merged).min(axis=1)
+
+    def clear(self, slot):
+        self.registers[slot] = 0
+
+
+class CountMin:
+    """depth × width 的 Count-Min，按子窗口分片：[buckets, depth * width] int64（array 存储 + numpy 视图，同 HllCells）"""
+
+    def __init__(self, buckets, depth=HOST_CM_DEPTH, width=HOST_CM_WIDTH):
+        self.depth, self.width = depth, width
+        self.size = depth * width
+        self._buffer = array.array("q", bytes(8 * buckets * self.size))
+        self.counts = np.frombuffer(self._buffer, dtype=np.int64).reshape(buckets, self.size)
+
+    def positions(self, key_hash):
+        h1, h2 = key_hash & 0xffffffff, (key_hash >> 32) | 1
+        width = self.width
+        return [row * width + (h1 + row * h2) % width for row in range(self.depth)]
+
+    def add(self, slot, positions, weight=1):
+        counts, start = self._buffer, slot * self.size
+        for pos in positions:
+            counts[start + pos] += weight
+
+    def estimate(self, key_hashes, slot=None):
+        """slot 为 None 时估计整个窗口的计数，否则只估计该子窗口"""
+        if not key_hashes:
+            return np.zeros(0, dtype=np.int64)
+        positions = np.array([self.positions(h) for h in key_hashes], dtype=np.int64)
+        counts = self.counts.sum(axis=0) if slot is None else self.counts[slot]
+        return counts[positions].min(axis=1)
+
+    def clear(self, slot):
+        self.counts[slot] = 0
+
+
+@dataclass
+class HostAlert:
+    kind: str  # scan / sweep / flood
+    attack_type: str
+    src_ip: str  # 洪泛告警为 "*"（多个来源）
+    dst_ip: str  # 扫描告警为 "*"（多个目标）
+    value: float
+    threshold: float
+    confidence: float
+    severity: int
+    message: str
+
+
+class HostSketchMonitor:
+    def __init__(self, window_seconds=HOST_WINDOW_SECONDS, buckets=HOST_WINDOW_BUCKETS):
+        self.buckets = max(1, buckets)
+        self.window_seconds = window_seconds
+        self.bucket_seconds = window_seconds / self.buckets
+        self.src_ports = HllCells(self.buckets)  # 来源 → 不同目的端口
+        self.src_hosts = HllCells(self.buckets)  # 来源 → 不同目的主机
+        self.dst_sources = HllCells(self.buckets)  # 目标 → 不同来源
+        self.dst_packets = CountMin(self.buckets)
+        self.dst_bytes = CountMin(self.buckets)
+        self.top_sources = [SpaceSaving() for _ in range(self.buckets)]
+        self.top_destinations = [SpaceSaving() for _ in range(self.buckets)]
+        # 三个 HllCells 与两个 CountMin 几何相同，同一 IP 的偏移/位置只算一次；常见 IP 反复出现，按 IP 缓存
+        self._host_key = functools.lru_cache(maxsize=HOST_KEY_CACHE)(self._compute_host_key)
+
+        self._epoch = None  # 当前子窗口编号 = int(报文时间 // bucket_seconds)
+        self._epochs_seen = 0
+        self._scan_candidates = OrderedDict()  # 来源 IP → 哈希
+        self._flood_candidates = OrderedDict()  # 目标 IP → 哈希
+        self._last_alert = {}  # (类型, 主机) → 上次告警时间
+        self.packets = 0
+        self.evaluations = 0
+        self.alerts = {"scan": 0, "sweep": 0, "flood": 0}
+
+    # ---------- 逐包更新 ----------
+    def update(self, src_ip, dst_ip, dst_port, proto, length, timestamp):
+        """记录一个报文；跨入新的子窗口时先判定刚结束的窗口，返回触发的 HostAlert 列表"""
+        epoch = int(timestamp // self.bucket_seconds)
+        alerts = []
+        if self._epoch is None or epoch > self._epoch:
+            alerts = self._advance(epoch, timestamp)
+        slot = self._epoch % self.buckets  # 乱序到达、时间更早的报文计入当前子窗口
+        self.packets += 1
+
+        src_hash, src_offsets, _ = self._host_key(src_ip)
+        dst_hash, dst_offsets, positions = self._host_key(dst_ip)
+        scan_grew = self.src_ports.add(slot, src_offsets, _mix64(dst_port | proto << 16))
+        scan_grew = self.src_hosts.add(slot, src_offsets, dst_hash) or scan_grew
+        if scan_grew:
+            self._remember(self._scan_candidates, src_ip, src_hash)
+        if self.dst_sources.add(slot, dst_offsets, src_hash):
+            self._remember(self._flood_candidates, dst_ip, dst_hash)
+        self.dst_packets.add(slot, positions)
+        self.dst_bytes.add(slot, positions, int(length))
+        self.top_sources[slot].add(src_ip)
+        self.top_destinations[slot].add(dst_ip)
+        return alerts
+
+    def _compute_host_key(self, ip):
+        key_hash = _mix64(hash(ip))
+        return key_hash, self.src_ports.offsets(key_hash), self.dst_packets.positions(key_hash)
+
+    @staticmethod
+    def _remember(candidates, ip, key_hash):
+        candidates[ip] = key_hash
+        candidates.move_to_end(ip)
+        if len(candidates) > HOST_MAX_CANDIDATES:
+            candidates.popitem(last=False)
+
+    def _advance(self, epoch, now):
+        if self._epoch is None:
+            self._epoch, self._epochs_seen = epoch, 1
+            return []
+        alerts = self.evaluate(now)
+        # 清空要复用的子窗口；报文时间跳过整个窗口时全部清空
+        steps = min(epoch - self._epoch, self.buckets)
+        for i in range(steps):
+            slot = (epoch - i) % self.buckets
+            for sketch in (self.src_ports, self.src_hosts, self.dst_sources, self.dst_packets, self.dst_bytes):
+                sketch.clear(slot)
+            self.top_sources[slot].clear()
+            self.top_destinations[slot].clear()
+        self._epoch = epoch
+        self._epochs_seen = min(self._epochs_seen + steps, self.buckets)
+        return alerts
+
+    # ---------- 窗口判定 ----------
+    def evaluate(self, now):
+        """对当前窗口判定一次：扫描看候选来源的不同端口/主机数，洪泛看候选目标的包/字节速率与来源数"""
+        self.evaluations += 1
+        span = self._epochs_seen * self.bucket_seconds  # 启动后第一个窗口未满时按实际覆盖时长算速率
+        alerts = []
+
+        sources = list(self._scan_candidates.items())
+        if sources:
+            hashes = [h for _, h in sources]
+            ports, hosts = self.src_ports.estimate(hashes), self.src_hosts.estimate(hashes)
+            for (ip, _), n_ports, n_hosts in zip(sources, ports, hosts):
+                if n_ports >= HOST_SCAN_PORTS:
+                    alerts.append(self._alert("scan", "PortScan", ip, "*", n_ports, HOST_SCAN_PORTS, 3,
+                                              f"主机级检测：{ip} 在{span:.0f}s内访问约{n_ports:.0f}个不同目的端口", now))
+                if n_hosts >= HOST_SWEEP_HOSTS:
+                    alerts.append(self._alert("sweep", "PortScan (HostSweep)", ip, "*", n_hosts, HOST_SWEEP_HOSTS, 3,
+                                              f"主机级检测：{ip} 在{span:.0f}s内访问约{n_hosts:.0f}个不同目的主机", now))
+
+        # 重流量目标也进入洪泛候选：来源数早已超过阈值、本子窗口寄存器不再增长的持续洪泛不会漏判
+        destinations = dict(self._flood_candidates)
+        for ip, _, _ in merge_heavy_hitters(self.top_destinations, top=HOST_HEAVY_HITTERS):
+            destinations.setdefault(ip, self._host_key(ip)[0])
+        if destinations:
+            # 速率按刚结束的子窗口计（洪泛开始后一个子窗口内即可告警，不被整个窗口平均稀释），来源数按整个窗口计
+            hashes, latest = list(destinations.values()), self._epoch % self.buckets
+            packets = self.dst_packets.estimate(hashes, slot=latest) / self.bucket_seconds
+            byte_rates = self.dst_bytes.estimate(hashes, slot=latest) / self.bucket_seconds
+            senders = self.dst_sources.estimate(hashes)
+            for ip, pps, bps, n_sources in zip(destinations, packets, byte_rates, senders):
+                if n_sources < HOST_FLOOD_SOURCES or (pps < HOST_FLOOD_PPS and bps < HOST_FLOOD_BPS):
+                    continue
+                ratio = max(pps / HOST_FLOOD_PPS, bps / HOST_FLOOD_BPS)
+                alerts.append(self._alert("flood", "DDoS", "*", ip, ratio, 1.0, 5 if ratio >= 2 else 4,
+                                          f"主机级检测：{ip} 在{span:.0f}s内来自约{n_sources:.0f}个来源，"
+                                          f"最近{self.bucket_seconds:g}s平均{pps:.0f}包/s、{bps / 1024:.0f}KB/s", now))
+
+        self._scan_candidates.clear()
+        self._flood_candidates.clear()
+        for key in [key for key, last in self._last_alert.items() if now - last >= HOST_ALERT_COOLDOWN]:
+            del self._last_alert[key]
+        return [alert for alert in alerts if alert is not None]
+
+    def _alert(self, kind, attack_type, src_ip, dst_ip, value, threshold, severity, message, now):
+        host = dst_ip if kind == "flood" else src_ip
+        if (kind, host) in self._last_alert:
+            return None
+        self._last_alert[(kind, host)] = now
+        self.alerts[kind] += 1
+        confidence = min(0.99, float(value) / (2.0 * threshold))  # 刚到阈值为 0.5，超过两倍阈值封顶
+        return HostAlert(kind, attack_type, src_ip, dst_ip, float(value), float(threshold), confidence, severity,
+                         message)
+
+    # ---------- 统计 ----------
+    def memory_bytes(self):
+        return sum(sketch.nbytes for sketch in (self.src_ports.registers, self.src_hosts.registers,
+                                                self.dst_sources.registers, self.dst_packets.counts,
+                                                self.dst_bytes.counts))
+
+    def counters(self):
+        return {"packets": self.packets, "evaluations": self.evaluations, **self.alerts}
+
+    def report_lines(self, top=5):
+        lines = []
+        for name, sketches in (("来源", self.top_sources), ("目标", self.top_destinations)):
+            ranked = merge_heavy_hitters(sketches, top=top)
+            if ranked:
+                lines.append(f"最近窗口包数最多的{name}：" + ", ".join(
+                    f"{ip}={count}" + (f"(±{error})" if error else "") for ip, count, error in ranked))
+        return lines
@@ -1,26 +1,58 @@
+import atexit
+import bisect
 import logging
+import logging.handlers
 import os
 import torch
 import torch.nn as nn
 import numpy as np
 import warnings
 import joblib
+import heapq
+import inspect
+import queue
+import threading
 from scapy.layers.inet import IP, TCP, UDP
-from collections import defaultdict, deque
+from collections import Counter, defaultdict, deque
 import time
 from dataclasses import dataclass
 from typing import Protocol, Union
 
+from flow_table import FlowStore
+
 # ========== 全局配置（与训练/检测对齐） ==========
 SEQ_LEN = 32  # 时序窗口长度
 PCA_DIM = 12  # PCA降维维度
 FEATURE_DIM = 16  # 原始特征维度
 FLOW_TIMEOUT = 60
+FLOW_EXPIRY_TICK = float(os.environ.get("FLOW_EXPIRY_TICK", "1.0"))  # 超时检查周期（秒）
+# 流存储：0（默认）= defaultdict + FlowStats；1 = 列式流表 flow_table.FlowStore
+# 列式流表每条流内存约为字典的一半，但 CPython 下逐包更新更慢（见 python flow_table.py --bench），适合流数很多、内存受限的部署
+FLOW_TABLE = os.environ.get("FLOW_TABLE", "0") == "1"
+FLOW_TABLE_CAPACITY = int(os.environ.get("FLOW_TABLE_CAPACITY", "65536"))  # 初始槽位数，不足时按 2 倍扩容
 
 ANOMALY_THRESHOLD = 0.7  # OOD检测阈值
 NUM_CLASSES = 6  # 攻击类型数（0=正常，1-5=攻击）
 LATENT_DIM = 128  # 生成器噪声维度
 
+# 批量推理配置：攒够 INFER_BATCH_SIZE 条就绪流或最早一条等待超过 INFER_MAX_LATENCY_MS 就跑一次前向
+# INFER_BATCH_SIZE<=1 时关闭批处理，回到抓包线程内逐流推理
+INFER_BATCH_SIZE = int(os.environ.get("INFER_BATCH_SIZE", "64"))
+INFER_MAX_LATENCY_MS = float(os.environ.get("INFER_MAX_LATENCY_MS", "10"))
+INFER_QUEUE_SIZE = int(os.environ.get("INFER_QUEUE_SIZE", "4096"))
+
+# 评分时机：event（默认）= TCP FIN/RST、空闲超时、长流按包数检查点；legacy = 满 SEQ_LEN//2 包后每 SEQ_LEN//2 包评分一次
+SCORING_MODE = os.environ.get("SCORING_MODE", "event").lower()
+SCORE_CHECKPOINTS = tuple(sorted(int(x) for x in os.environ.get("SCORE_CHECKPOINTS", "16,64,256,1024").split(",") if x.strip()))
+SCORE_MIN_PACKETS = int(os.environ.get("SCORE_MIN_PACKETS", "1"))  # 流结束（超时）评分所需的最少包数
+SHORT_FLOW_BATCH = int(os.environ.get("SHORT_FLOW_BATCH", "256"))  # 同一次超时检查中结束的流按此大小成批评分
+
+# 特征增量门控：再次评分时特征（模型输入空间）变化小于 FEATURE_DELTA_EPS 且上次置信度足够高，则复用上次模型输出
+# FEATURE_DELTA_EPS<=0 关闭；FEATURE_DELTA_EVAL=1 时照常推理，只统计复用结果与实际结果的不一致率
+FEATURE_DELTA_EPS = float(os.environ.get("FEATURE_DELTA_EPS", "0.05"))
+FEATURE_DELTA_MIN_CONFIDENCE = float(os.environ.get("FEATURE_DELTA_MIN_CONFIDENCE", "0.9"))
+FEATURE_DELTA_EVAL = os.environ.get("FEATURE_DELTA_EVAL", "0") == "1"
+
 # 路径配置（基于当前文件位置，确保无论从哪里运行都能找到文件）
 _BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 MODEL_DIR = os.path.join(_BASE_DIR, "transec_gan_model")
@@ -28,7 +60,32 @@ PREPROCESS_DIR = os.path.join(_BASE_DIR, "preprocessed_data")
 MODEL_PATH = os.path.join(MODEL_DIR, "best_model_4x5880_max.pth")
 SCALER_PATH = os.path.join(PREPROCESS_DIR, "scaler.pkl")
 PCA_PATH = os.path.join(PREPROCESS_DIR, "pca.pkl")
+# scaler+PCA 折叠后的仿射变换（data_preprocess.py 生成）：x @ W + b
+FUSED_W_PATH = os.path.join(PREPROCESS_DIR, "fused_affine_W.npy")
+FUSED_B_PATH = os.path.join(PREPROCESS_DIR, "fused_affine_b.npy")
+USE_FUSED_AFFINE = os.environ.get("USE_FUSED_AFFINE", "1") == "1"
 LOG_FILE = os.path.join(_BASE_DIR, "ids_detection.log")
+LOG_ASYNC = os.environ.get("LOG_ASYNC", "1") == "1"  # 日志经队列交给监听线程写文件/控制台，检测线程不做磁盘 I/O
+BENIGN_LOG_RATE = float(os.environ.get("BENIGN_LOG_RATE", "5"))  # 每秒最多输出的正常流量日志条数，0 不输出，<0 不限
+
+# 精简检测模型（export_discriminator.py --detector 生成）：只含判别器权重、标签与融合后的预处理，
+# 全部为张量/基本类型，weights_only=True 加载并按 mmap 映射，不需要生成器、优化器状态和 scaler/pca.pkl
+DETECTOR_PATH = os.path.join(MODEL_DIR, "detector_slim.pt")
+USE_SLIM_DETECTOR = os.environ.get("USE_SLIM_DETECTOR", "1") == "1"
+
+# 推理后端：eager（默认，PyTorch 动态图）/ torchscript / onnx / int8
+# torchscript/onnx 由 export_discriminator.py 生成，int8 由 quantize_model.py 生成
+IDS_BACKEND = os.environ.get("IDS_BACKEND", "eager").lower()
+TORCHSCRIPT_PATH = os.path.join(MODEL_DIR, "discriminator_ts.pt")
+ONNX_PATH = os.path.join(MODEL_DIR, "discriminator.onnx")
+# int8 动态量化的判别器（quantize_model.py 通过精度门槛后才会生成），IDS_BACKEND=int8 时使用
+QUANTIZED_MODEL_PATH = os.path.join(MODEL_DIR, "discriminator_int8.pth")
+
+# 蒸馏学生模型（distill_student.py 生成）：先由学生分类，不确定的流再交给 Transformer 判别器
+STUDENT_PATH = os.path.join(MODEL_DIR, "student_mlp.npz")
+USE_STUDENT = os.environ.get("USE_STUDENT", "1") == "1"
+STUDENT_CONFIDENCE = float(os.environ.get("STUDENT_CONFIDENCE", "0.9"))  # 学生判为正常的最低概率
+STUDENT_REAL_MARGIN = float(os.environ.get("STUDENT_REAL_MARGIN", "0.0"))  # 学生 real_score 低于该值则升级
 
 # 颜色常量
 COLORS = {
@@ -39,30 +96,86 @@ COLORS = {
     "default": "\033[0m"
 }
 
-# 日志过滤器
-class LogFilter:
+# ========== 指标计数 ==========
+CONFIDENCE_BUCKETS = (0.3, 0.5, 0.7, 0.9, 0.99)
+
+
+class MetricsRegistry:
+    """进程内指标：计数器 + 固定分桶直方图；热路径只做加锁累加，最终统计直接读取，不再从日志文本匹配计数"""
+
     def __init__(self):
-        self.normal_count = 0
-        self.known_anomaly_count = 0
-        self.unknown_anomaly_count = 0
-
-    def filter(self, record):
-        msg = record.getMessage()
-        # 【关键修复】匹配更灵活的格式，支持"【🔴 高危告警 - 已知攻击】"等格式
-        # 使用更宽松的匹配，只要包含关键字符串就计数
-        if "已知攻击" in msg or "【🔴 高危告警 - 已知攻击】" in msg:
-            self.known_anomaly_count += 1
-        elif "未知攻击" in msg or "【🔴 高危告警 - 未知攻击】" in msg or "Unknown Attack" in msg:
-            self.unknown_anomaly_count += 1
-        elif "【正常流量】" in msg or "正常流量" in msg:
-            self.normal_count += 1
-        elif "【模拟攻击】" in msg or "模拟攻击" in msg:
-            self.known_anomaly_count += 1
-        elif "📊 最终统计：" in msg:
-            record.msg = record.msg.replace("正常流量总数=", f"正常流量总数={self.normal_count}")
-            record.msg = record.msg.replace("已知异常流量数=", f"已知异常流量数={self.known_anomaly_count}")
-            record.msg = record.msg.replace("未知异常流量数=", f"未知异常流量数={self.unknown_anomaly_count}")
-        return True
+        self._lock = threading.Lock()
+        self._counters = Counter()
+        self._histograms = {}  # 名称 -> (分桶上界, 各桶计数)
+
+    def inc(self, name, n=1):
+        with self._lock:
+            self._counters[name] += n
+
+    def value(self, name):
+        return self._counters[name]
+
+    def observe(self, name, value, buckets=CONFIDENCE_BUCKETS):
+        with self._lock:
+            hist = self._histograms.get(name)
+            if hist is None:
+                hist = self._histograms[name] = (buckets, [0] * (len(buckets) + 1))
+            hist[1][bisect.bisect_left(hist[0], value)] += 1
+
+    def histogram(self, name):
+        """{"<=上界": 计数, ..., ">最大上界": 计数}；未记录过时返回空字典"""
+        with self._lock:
+            hist = self._histograms.get(name)
+            if hist is None:
+                return {}
+            buckets, counts = hist
+            result = {f"<={bound:g}": count for bound, count in zip(buckets, counts)}
+            result[f">{buckets[-1]:g}"] = counts[-1]
+            return result
+
+
+metrics = MetricsRegistry()
+
+
+class LogRateLimiter:
+    """令牌桶限流：每秒最多 rate 条（rate<0 不限，0 全部省略）；输出/省略条数记入 metrics 的 <name>_logged/<name>_suppressed"""
+
+    def __init__(self, rate, name):
+        self.rate = rate
+        self.name = name
+        self._tokens = max(rate, 0.0)
+        self._last = time.monotonic()
+
+    def allow(self):
+        if self.rate < 0:
+            metrics.inc(f"{self.name}_logged")
+            return True
+        now = time.monotonic()
+        self._tokens = min(max(self.rate, 1.0), self._tokens + (now - self._last) * self.rate)
+        self._last = now
+        if self._tokens >= 1.0:
+            self._tokens -= 1.0
+            metrics.inc(f"{self.name}_logged")
+            return True
+        metrics.inc(f"{self.name}_suppressed")
+        return False
+
+
+class VerdictCountView:
+    """兼容旧接口 logger.log_filter.*_count，数值取自 metrics（判定计数由检测流程直接累加）"""
+
+    @property
+    def normal_count(self):
+        return metrics.value("verdict_normal")
+
+    @property
+    def known_anomaly_count(self):
+        return metrics.value("verdict_known")
+
+    @property
+    def unknown_anomaly_count(self):
+        return metrics.value("verdict_unknown")
+
 
 # 日志初始化
 logger = logging.getLogger(__name__)
@@ -70,17 +183,24 @@ logger.setLevel(logging.INFO)
 logger.handlers.clear()
 file_handler = logging.FileHandler(LOG_FILE, encoding="utf-8", mode="a")
 file_handler.setLevel(logging.INFO)
-log_filter = LogFilter()
-file_handler.addFilter(log_filter)
 file_formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
 file_handler.setFormatter(file_formatter)
 console_handler = logging.StreamHandler()
 console_handler.setLevel(logging.INFO)
 console_formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
 console_handler.setFormatter(console_formatter)
-logger.addHandler(file_handler)
-logger.addHandler(console_handler)
-logger.log_filter = log_filter
+log_listener = None
+if LOG_ASYNC:
+    # 检测线程只把日志记录放入队列（不阻塞），由监听线程写文件和控制台；进程退出时先写完队列
+    log_queue = queue.SimpleQueue()
+    log_listener = logging.handlers.QueueListener(log_queue, file_handler, console_handler, respect_handler_level=True)
+    log_listener.start()
+    atexit.register(log_listener.stop)
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+else:
+    logger.addHandler(file_handler)
+    logger.addHandler(console_handler)
+logger.log_filter = VerdictCountView()
 
 warnings.filterwarnings("ignore")
 
@@ -185,12 +305,15 @@ class FlowStats:
         ], dtype=np.float32)
 
 
-flows = defaultdict(lambda: {
-    "feature_window": deque(maxlen=SEQ_LEN),
-    "last_packet_time": time.time(),
-    "is_anomaly": False,
-    "stats": None
-})
+if FLOW_TABLE:
+    # flows[key] 返回 FlowEntry，stats 为按槽位读列的 FlowStats 兼容视图；流结束 pop 出的是 FlowStats 快照
+    flows = FlowStore(FlowStats, FLOW_TABLE_CAPACITY)
+else:
+    flows = defaultdict(lambda: {
+        "last_packet_time": time.time(),
+        "is_anomaly": False,
+        "stats": None
+    })
 
 # ========== 模型定义（TransEC-GAN核心） ==========
 class TransformerEncoder(nn.Module):
@@ -211,6 +334,25 @@ class TransformerEncoder(nn.Module):
         x = x + self.pos_encoder(pos)
         return self.transformer(x).mean(dim=1)
 
+    def forward_repeated(self, token, seq_len=SEQ_LEN):
+        """
+        输入为同一向量重复 seq_len 次的序列时的快速路径
+        token: (batch, 1, input_dim)，线性层只算一次，再与缓存的位置编码广播相加
+        """
+        x = self.linear(token)
+        return self.transformer(x + self._position_table(seq_len, x.device)).mean(dim=1)
+
+    def _position_table(self, seq_len, device):
+        # 位置编码只依赖位置，推理期间缓存 (1, seq_len, d_model)；训练模式下权重会变，不缓存
+        cache = getattr(self, "_pos_cache", None)
+        if self.training or cache is None or cache.shape[1] != seq_len or cache.device != device:
+            with torch.no_grad():
+                cache = self.pos_encoder(torch.arange(seq_len, device=device)).unsqueeze(0)
+            if self.training:
+                return cache
+            self._pos_cache = cache
+        return cache
+
 class Generator(nn.Module):
     def __init__(self):
         super().__init__()
@@ -238,6 +380,11 @@ class Discriminator(nn.Module):
         class_pred = self.class_fc(x)
         return real_pred, class_pred
 
+    def forward_repeated(self, token):
+        """token: (batch, 1, PCA_DIM)，等价于 forward(token.repeat(1, SEQ_LEN, 1))"""
+        x = self.transformer.forward_repeated(token)
+        return self.real_fc(x), self.class_fc(x)
+
 # ========== 工具函数 ==========
 def get_wlan_interface():
     try:
@@ -257,43 +404,130 @@ def get_wlan_interface():
         logger.error(f"{COLORS['red']}❌ 网卡识别失败：{str(e)}{COLORS['reset']}")
         raise SystemExit(1)
 
-def load_model():
+def resolve_normal_label(label_list):
+    """解析正常流量标签名称（检测、评估与评分服务共用）"""
+    if isinstance(label_list, np.ndarray):
+        label_list = label_list.tolist()
+    if not label_list:
+        return "Benign"
+    candidates = ["benign", "normal", "benign traffic", "normal traffic", "正常", "0"]
+    for cand in candidates:
+        for label in label_list:
+            label_str = label if isinstance(label, str) else str(label)
+            if label_str.lower() == cand:
+                return label
+    return label_list[0]
+
+def is_opacus_state_dict(state_dict):
+    return any("qlinear" in k or "klinear" in k or "vlinear" in k for k in state_dict.keys())
+
+
+def build_discriminator(opacus_fixed=False):
+    """构造判别器结构；Opacus训练的模型需要先应用ModuleValidator.fix()来匹配模型结构"""
+    if opacus_fixed:
+        try:
+            from opacus.validators import ModuleValidator
+            discriminator = ModuleValidator.fix(Discriminator().to(DEVICE)).to(DEVICE)
+            logger.info("🔧 检测到 Opacus DP 模型，已应用 ModuleValidator.fix()")
+            return discriminator
+        except ImportError:
+            logger.warning("⚠️  检测到 Opacus 模型但无法导入 opacus，尝试直接加载...")
+    # 标准PyTorch模型
+    return Discriminator().to(DEVICE)
+
+
+def quantize_discriminator(discriminator):
+    """对判别器中的 nn.Linear 做动态 int8 量化（仅 CPU）"""
+    # 动态量化后的 Linear 没有 .weight 张量，需关闭 TransformerEncoderLayer 的原生 fast path
+    if hasattr(torch.backends, "mha"):
+        torch.backends.mha.set_fastpath_enabled(False)
+    return torch.ao.quantization.quantize_dynamic(discriminator.cpu().eval(), {nn.Linear}, dtype=torch.qint8)
+
+
+def load_quantized_discriminator(path=None):
+    """加载 quantize_model.py 生成的 int8 判别器：重建结构 -> 动态量化 -> 加载量化后的 state_dict"""
+    checkpoint = torch.load(path or QUANTIZED_MODEL_PATH, map_location="cpu", weights_only=False)
+    quantized = quantize_discriminator(build_discriminator(checkpoint.get("opacus_fixed", False)))
+    quantized.load_state_dict(checkpoint["quantized_state_dict"])
+    return quantized.eval()
+
+
+class OnnxDiscriminator:
+    """onnxruntime 会话的薄封装，调用方式与 Discriminator 一致（输入/输出均为 torch.Tensor）"""
+
+    def __init__(self, path):
+        import onnxruntime as ort
+        self.session = ort.InferenceSession(path, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def eval(self):
+        return self
+
+    def __call__(self, x):
+        real_pred, class_pred = self.session.run(None, {self.input_name: x.detach().cpu().numpy().astype(np.float32)})
+        return torch.from_numpy(real_pred), torch.from_numpy(class_pred)
+
+    def forward_repeated(self, token):
+        return self(token.expand(-1, SEQ_LEN, -1))
+
+
+def select_backend(discriminator, backend=IDS_BACKEND):
+    """
+    按 backend 加载编译后的判别器；产物缺失、比 checkpoint 旧或加载失败时回退 eager
+    """
+    if backend == "eager":
+        return discriminator
+    path = {"torchscript": TORCHSCRIPT_PATH, "onnx": ONNX_PATH, "int8": QUANTIZED_MODEL_PATH}.get(backend)
+    if path is None:
+        logger.warning(f"{COLORS['yellow']}⚠️ 未知推理后端 {backend}，使用 eager{COLORS['reset']}")
+        return discriminator
+    if not os.path.exists(path):
+        tool = "quantize_model.py" if backend == "int8" else "export_discriminator.py"
+        logger.warning(f"{COLORS['yellow']}⚠️ 未找到 {path}，请先运行 {tool}，使用 eager{COLORS['reset']}")
+        return discriminator
+    if os.path.exists(MODEL_PATH) and os.path.getmtime(path) < os.path.getmtime(MODEL_PATH):
+        logger.warning(f"{COLORS['yellow']}⚠️ {path} 早于模型权重，可能已过期，请重新导出；使用 eager{COLORS['reset']}")
+        return discriminator
+    try:
+        if backend == "torchscript":
+            compiled = torch.jit.load(path, map_location=DEVICE).eval()
+        elif backend == "int8":
+            if DEVICE != "cpu":
+                logger.warning(f"{COLORS['yellow']}⚠️ int8 动态量化仅支持 CPU（当前 {DEVICE}），使用 eager{COLORS['reset']}")
+                return discriminator
+            compiled = load_quantized_discriminator(path)
+        else:
+            compiled = OnnxDiscriminator(path)
+        logger.info(f"{COLORS['green']}✅ 推理后端：{backend}（{path}）{COLORS['reset']}")
+        return compiled
+    except Exception as e:
+        logger.warning(f"{COLORS['yellow']}⚠️ 加载 {backend} 后端失败，使用 eager：{str(e)}{COLORS['reset']}")
+        return discriminator
+
+
+def _strip_module_prefix(state_dict):
+    # 处理DataParallel的module前缀
+    if next(iter(state_dict.keys())).startswith("module."):
+        return {k.replace("module.", ""): v for k, v in state_dict.items()}
+    return state_dict
+
+
+def load_model(backend=IDS_BACKEND, with_generator=False):
+    """
+    从完整训练 checkpoint 加载判别器 + scaler/pca/标签
+    生成器只在 with_generator=True 时构建（训练/模拟用），否则返回 None
+    """
     try:
         # 加载模型权重
         checkpoint = torch.load(MODEL_PATH, map_location=DEVICE, weights_only=False)
 
         # 初始化判别器（实时检测用）
-        disc_state_dict = checkpoint["discriminator_state_dict"]
-        # 处理DataParallel的module前缀
-        if next(iter(disc_state_dict.keys())).startswith("module."):
-            disc_state_dict = {k.replace("module.", ""): v for k, v in disc_state_dict.items()}
-        
+        disc_state_dict = _strip_module_prefix(checkpoint["discriminator_state_dict"])
         # 检查是否为Opacus训练的模型（通过检查state_dict中的键）
-        has_opacus_keys = any("qlinear" in k or "klinear" in k or "vlinear" in k for k in disc_state_dict.keys())
-        
-        if has_opacus_keys:
-            # 如果是Opacus模型，需要先应用ModuleValidator.fix()来匹配模型结构
-            try:
-                from opacus.validators import ModuleValidator
-                discriminator = Discriminator().to(DEVICE)
-                discriminator = ModuleValidator.fix(discriminator)
-                discriminator = discriminator.to(DEVICE)
-                logger.info("🔧 检测到 Opacus DP 模型，已应用 ModuleValidator.fix()")
-            except ImportError:
-                logger.warning("⚠️  检测到 Opacus 模型但无法导入 opacus，尝试直接加载...")
-                discriminator = Discriminator().to(DEVICE)
-        else:
-            # 标准PyTorch模型
-            discriminator = Discriminator().to(DEVICE)
-        
+        discriminator = build_discriminator(is_opacus_state_dict(disc_state_dict))
         discriminator.load_state_dict(disc_state_dict, strict=True)
 
-        # 初始化生成器（可选，训练/模拟用）
-        generator = Generator().to(DEVICE)
-        gen_state_dict = checkpoint["generator_state_dict"]
-        if next(iter(gen_state_dict.keys())).startswith("module."):
-            gen_state_dict = {k.replace("module.", ""): v for k, v in gen_state_dict.items()}
-        generator.load_state_dict(gen_state_dict, strict=True)
+        generator = _build_generator(checkpoint) if with_generator else None
 
         # 加载预处理组件
         scaler = joblib.load(SCALER_PATH)
@@ -301,13 +535,102 @@ def load_model():
         labels = checkpoint["label_classes"]
 
         logger.info(f"{COLORS['green']}✅ 成功加载TransEC-GAN模型（支持检测：{', '.join(labels)}）{COLORS['reset']}")
-        return discriminator.eval(), generator.eval(), scaler, pca, labels
+        return select_backend(discriminator.eval(), backend), generator, scaler, pca, labels
     except Exception as e:
         logger.error(f"{COLORS['red']}❌ 模型加载失败：{str(e)}{COLORS['reset']}")
         raise SystemExit(1)
 
-def extract_features(packet) -> Union[tuple[tuple, np.ndarray], None]:
+
+def _build_generator(checkpoint):
+    generator = Generator().to(DEVICE)
+    generator.load_state_dict(_strip_module_prefix(checkpoint["generator_state_dict"]), strict=True)
+    return generator.eval()
+
+
+def load_generator():
+    """单独加载生成器（只在启用异常流量模拟时调用）"""
+    return _build_generator(torch.load(MODEL_PATH, map_location=DEVICE, weights_only=False))
+
+
+class FeatureStats:
+    """原始特征的均值/标准差（与 StandardScaler 的 mean_/scale_ 同名），精简模型中用于 synthetic_flow_rows"""
+
+    def __init__(self, mean, scale):
+        self.mean_ = np.asarray(mean, dtype=np.float64)
+        self.scale_ = np.asarray(scale, dtype=np.float64)
+
+
+def fuse_scaler_pca(scaler, pca):
+    """StandardScaler + PCA 折叠为 x @ W + b（与 data_preprocess.build_fused_affine 相同）"""
+    n_features = scaler.n_features_in_
+    mean = scaler.mean_ if scaler.mean_ is not None else np.zeros(n_features)
+    scale = scaler.scale_ if scaler.scale_ is not None else np.ones(n_features)
+    components = pca.components_
+    if pca.whiten:
+        components = components / np.sqrt(pca.explained_variance_)[:, None]
+    return (components / scale).T, -(mean / scale + pca.mean_) @ components.T
+
+
+def export_detector(discriminator, scaler, pca, labels, path=DETECTOR_PATH):
+    """写出精简检测模型；融合预处理先与 sklearn 逐步变换做一致性校验"""
+    fused = FusedAffinePreprocess(*fuse_scaler_pca(scaler, pca))
+    max_diff = check_affine_parity(fused, scaler, pca)
+    n_features = scaler.n_features_in_
+    state = {
+        "format": 1,
+        "discriminator_state_dict": {k: v.detach().cpu().contiguous()
+                                     for k, v in discriminator.state_dict().items()},
+        "opacus_fixed": is_opacus_state_dict(discriminator.state_dict()),
+        "label_classes": [str(label) for label in labels],
+        "affine_W": torch.from_numpy(fused.W),
+        "affine_b": torch.from_numpy(fused.b),
+        "feature_mean": torch.from_numpy(np.asarray(
+            scaler.mean_ if scaler.mean_ is not None else np.zeros(n_features), dtype=np.float64)),
+        "feature_scale": torch.from_numpy(np.asarray(
+            scaler.scale_ if scaler.scale_ is not None else np.ones(n_features), dtype=np.float64)),
+    }
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    torch.save(state, path)
+    return max_diff
+
+
+def load_detector(backend=IDS_BACKEND, path=DETECTOR_PATH):
+    """
+    加载精简检测模型：返回 (判别器, 预处理, 标签, 特征统计)；未启用、不存在、早于训练产物或加载失败时返回 None
+    （调用方回退 load_model）
+    """
+    if not (USE_SLIM_DETECTOR and os.path.exists(path)):
+        return None
+    sources = [p for p in (MODEL_PATH, SCALER_PATH, PCA_PATH) if os.path.exists(p)]
+    if any(os.path.getmtime(path) < os.path.getmtime(p) for p in sources):
+        logger.warning(f"{COLORS['yellow']}⚠️ {path} 早于模型权重/预处理文件，可能已过期，"
+                       f"请重新运行 export_discriminator.py --detector；使用完整 checkpoint{COLORS['reset']}")
+        return None
+    try:
+        # mmap：权重按需从页缓存读入，多个 worker 进程共享同一份物理内存（torch<2.1 不支持时整体读入）
+        mmap = "mmap" in inspect.signature(torch.load).parameters
+        state = torch.load(path, map_location="cpu", weights_only=True, **({"mmap": True} if mmap else {}))
+        discriminator = build_discriminator(state["opacus_fixed"])
+        if mmap and DEVICE == "cpu":
+            discriminator.load_state_dict(state["discriminator_state_dict"], strict=True, assign=True)
+        else:
+            discriminator.load_state_dict(state["discriminator_state_dict"], strict=True)
+        preprocess = FusedAffinePreprocess(state["affine_W"].numpy(), state["affine_b"].numpy())
+        stats = FeatureStats(state["feature_mean"].numpy(), state["feature_scale"].numpy())
+        labels = list(state["label_classes"])
+    except Exception as e:
+        logger.warning(f"{COLORS['yellow']}⚠️ 精简检测模型加载失败，使用完整 checkpoint：{str(e)}{COLORS['reset']}")
+        return None
+    logger.info(f"{COLORS['green']}✅ 已加载精简检测模型（{path}，支持检测：{', '.join(labels)}）{COLORS['reset']}")
+    return select_backend(discriminator.eval(), backend), preprocess, labels, stats
+
+def extract_features(packet, timestamp=None) -> Union[tuple[tuple, np.ndarray], None]:
+    """
+    timestamp：报文时间（pcap 回放传 packet.time）；None 表示实时抓包，使用当前时间
+    返回 (flow_key, features)；FLOW_TABLE=1 时 features 为 None，评分时再由 flow["stats"].to_feature_vector() 计算
+    """
     try:
+        now = time.time() if timestamp is None else float(timestamp)
         if not packet.haslayer(IP):
             return None
 
@@ -329,11 +652,16 @@ def extract_features(packet) -> Union[tuple[tuple, np.ndarray], None]:
             return None
 
         flow_key = get_flow_key(src_ip, dst_ip, src_port, dst_port, proto)
+        if FLOW_TABLE:
+            flows.update(flow_key, src_ip, src_port, dst_ip, dst_port, proto, len(packet), now)
+            flow_expiry.touch(flow_key, now)
+            return flow_key, None
+
         flow = flows[flow_key]
-        flow["last_packet_time"] = time.time()
+        flow["last_packet_time"] = now
+        flow_expiry.touch(flow_key, flow["last_packet_time"])
 
         if flow["stats"] is None:
-            now = time.time()
             flow["stats"] = FlowStats(
                 src_ip=src_ip,
                 src_port=src_port,
@@ -351,24 +679,531 @@ def extract_features(packet) -> Union[tuple[tuple, np.ndarray], None]:
             dst_ip=dst_ip,
             dst_port=dst_port,
             pkt_len=pkt_len,
-            timestamp=time.time()
+            timestamp=now
         )
-
-        flow["feature_window"].append(features)
         return flow_key, features
     except Exception as e:
         logger.debug(f"特征提取警告：{str(e)}（包摘要：{packet.summary()}）")
         return None
 
-def clean_timeout_flows():
-    now = time.time()
-    timeout_count = 0
-    for key, flow in list(flows.items()):
-        if now - flow["last_packet_time"] > FLOW_TIMEOUT:
-            del flows[key]
-            timeout_count += 1
-    if timeout_count > 0:
-        logger.debug(f"清理超时会话：{timeout_count} 个")
+TCP_FIN = 0x01
+TCP_RST = 0x04
+
+
+class FlowScoringPolicy:
+    """
+    决定一条流何时评分（状态记在 flows 的字典里：last_detection_packet_count / next_score_at / closed）
+    - event：TCP FIN/RST 立即评分；包数到达检查点时评分（超过最后一个检查点后按其间隔重复）；
+      空闲超时时从未评分或评分后又有新包的流补评分，短流因此也会在结束时被评分
+    - legacy：满 SEQ_LEN//2 包后每增加 SEQ_LEN//2 包评分一次，超时补评分同样要求满 SEQ_LEN//2 包
+    """
+
+    def __init__(self, mode=SCORING_MODE, checkpoints=SCORE_CHECKPOINTS, min_packets=SCORE_MIN_PACKETS):
+        self.mode = mode
+        self.checkpoints = checkpoints or (SEQ_LEN // 2,)
+        self.min_packets = max(1, min_packets) if mode == "event" else SEQ_LEN // 2
+        self.reasons = Counter()
+
+    @staticmethod
+    def _packets(flow):
+        return flow["stats"].fwd_packets + flow["stats"].bwd_packets
+
+    def next_checkpoint(self, packets):
+        for checkpoint in self.checkpoints:
+            if checkpoint > packets:
+                return checkpoint
+        step = self.checkpoints[-1]
+        return (packets // step + 1) * step
+
+    def on_packet(self, flow, tcp_flags=0):
+        """每个报文更新流统计后调用：返回评分原因（fin/rst/checkpoint/window），不需要评分时返回 None"""
+        packets = self._packets(flow)
+        if self.mode == "legacy":
+            if packets < SEQ_LEN // 2:
+                return None
+            if "last_detection_packet_count" in flow and packets - flow["last_detection_packet_count"] < SEQ_LEN // 2:
+                return None
+            return "window"
+        if tcp_flags & (TCP_FIN | TCP_RST) and not flow.get("closed"):
+            flow["closed"] = True
+            return "rst" if tcp_flags & TCP_RST else "fin"
+        if packets >= flow.get("next_score_at", self.checkpoints[0]):
+            return "checkpoint"
+        return None
+
+    def on_expire(self, flow):
+        """流超时结束时调用：需要补评分返回 "timeout"，否则 None（已在 FIN/RST 时评分的流不再重复）"""
+        if flow["stats"] is None or (self.mode == "event" and flow.get("closed")):
+            return None
+        packets = self._packets(flow)
+        if packets < self.min_packets or packets == flow.get("last_detection_packet_count"):
+            return None
+        return "timeout"
+
+    def mark_scored(self, flow, reason):
+        packets = self._packets(flow)
+        flow["last_detection_packet_count"] = packets
+        flow["next_score_at"] = self.next_checkpoint(packets)
+        self.reasons[reason] += 1
+
+
+class FeatureDeltaGate:
+    """
+    特征增量门控：flow["last_scored"] 记录上次实际推理时的 (特征, (attack_type, confidence, real_score))
+    新特征与之在 scaler+PCA 之后的 L2 距离小于 eps、且上次置信度不低于 min_confidence 时复用上次模型输出；
+    复用不更新 last_scored，缓慢漂移累积到 eps 后仍会重新推理
+    evaluate=True：满足条件时仍然推理，比较复用结果与实际结果的类别是否一致
+    """
+
+    def __init__(self, preprocess, eps=FEATURE_DELTA_EPS, min_confidence=FEATURE_DELTA_MIN_CONFIDENCE,
+                 evaluate=FEATURE_DELTA_EVAL):
+        self.preprocess = preprocess
+        self.eps = eps
+        self.min_confidence = min_confidence
+        self.evaluate = evaluate
+        self.scored = 0  # 经过门控的评分次数
+        self.checked = 0  # 有可复用的高置信度结果、计算了距离的次数
+        self.skipped = 0  # 满足门控条件的次数（评估模式下为"本可跳过"的次数）
+        self.evaluated = 0
+        self.mismatched = 0
+
+    def check(self, flow, features):
+        """返回可复用的 (attack_type, confidence, real_score)；需要推理时返回 None"""
+        self.scored += 1
+        last = flow.get("last_scored")
+        if self.eps <= 0 or last is None or last[1][1] < self.min_confidence:
+            return None
+        self.checked += 1
+        z = self.preprocess.transform(np.stack([last[0], features]).astype(np.float32))
+        if float(np.linalg.norm(z[1] - z[0])) >= self.eps:
+            return None
+        self.skipped += 1
+        if self.evaluate:
+            flow["delta_gate_expected"] = last[1]
+            return None
+        return last[1]
+
+    def record(self, flow, features, verdict):
+        """实际推理完成后调用：更新 last_scored，评估模式下比较复用结果"""
+        expected = flow.pop("delta_gate_expected", None)
+        if expected is not None:
+            self.evaluated += 1
+            self.mismatched += int(expected[0] != verdict[0])
+        flow["last_scored"] = (features, verdict)
+
+    def counters(self):
+        return {"scored": self.scored, "checked": self.checked, "skipped": self.skipped,
+                "evaluated": self.evaluated, "mismatched": self.mismatched, "evaluate": int(self.evaluate)}
+
+
+class FlowExpiryHeap:
+    """
+    流超时堆（惰性删除）：每条流在堆中最多一个条目 (到期时间, flow_key)
+    - touch：只在流首次出现时入堆，之后的包只更新 flow["last_packet_time"]，无堆操作
+    - expire_due：弹出已到期条目时再核对 last_packet_time，期间有新包则按新的到期时间重新入堆，否则判定流结束
+    每次只处理到期的条目，代价与到期流数相关，与活跃流总数无关
+    """
+    def __init__(self, flow_table, timeout=FLOW_TIMEOUT, tick_interval=FLOW_EXPIRY_TICK):
+        self.flows = flow_table
+        self.timeout = timeout
+        self.tick_interval = tick_interval
+        self.on_expire = None  # 流结束事件回调 on_expire([(flow_key, flow), ...])，同一次检查中结束的流一起交出，已从 flows 中移除
+        self._heap = []
+        self._scheduled = set()
+        self._next_tick = 0.0
+        self.expired_total = 0
+        self.requeued_total = 0
+
+    def touch(self, flow_key, last_time):
+        if flow_key not in self._scheduled:
+            self._scheduled.add(flow_key)
+            heapq.heappush(self._heap, (last_time + self.timeout, flow_key))
+
+    def expire_due(self, now):
+        expired = []
+        heap = self._heap
+        while heap and heap[0][0] < now:
+            _, flow_key = heapq.heappop(heap)
+            flow = self.flows.get(flow_key)
+            if flow is None:
+                # 流已被其他逻辑删除，丢弃旧条目
+                self._scheduled.discard(flow_key)
+                continue
+            deadline = flow["last_packet_time"] + self.timeout
+            if deadline >= now:
+                heapq.heappush(heap, (deadline, flow_key))
+                self.requeued_total += 1
+                continue
+            self._scheduled.discard(flow_key)
+            # 用 pop 的返回值：列式流表 pop 出的是脱离表的快照，槽位随即复用
+            expired.append((flow_key, self.flows.pop(flow_key)))
+        self.expired_total += len(expired)
+        return expired
+
+    def tick(self, now):
+        """周期检查：距上次检查不足 tick_interval 时直接返回"""
+        if now < self._next_tick:
+            return []
+        self._next_tick = now + self.tick_interval
+        return self.expire_due(now)
+
+    def drain(self):
+        """取出全部剩余流（pcap 回放结束时当作流结束处理），按到期时间顺序返回"""
+        remaining = []
+        while self._heap:
+            _, flow_key = heapq.heappop(self._heap)
+            flow = self.flows.pop(flow_key, None)
+            if flow is not None:
+                remaining.append((flow_key, flow))
+        self._scheduled.clear()
+        self.expired_total += len(remaining)
+        return remaining
+
+    def __len__(self):
+        return len(self._heap)
+
+
+flow_expiry = FlowExpiryHeap(flows)
+
+
+def clean_timeout_flows(now=None):
+    now = time.time() if now is None else now
+    expired = flow_expiry.tick(now)
+    if not expired:
+        return 0
+    if flow_expiry.on_expire is not None:
+        try:
+            flow_expiry.on_expire(expired)
+        except Exception as e:
+            logger.warning(f"{COLORS['yellow']}⚠️ 流结束事件处理失败：{str(e)}{COLORS['reset']}")
+    logger.debug(f"清理超时会话：{len(expired)} 个")
+    return len(expired)
+
+# ========== 单向量快速路径 ==========
+# 实时检测把同一条流特征重复 SEQ_LEN 次作为时序窗口；快速路径只对该向量做一次 scaler/PCA/线性层，
+# 启动时与完整路径逐位比对，不一致则回退完整路径
+SINGLE_VECTOR_FASTPATH = os.environ.get("SINGLE_VECTOR_FASTPATH", "1") == "1"
+
+
+def preprocess_repeated(rows, preprocess):
+    """完整路径：(batch, FEATURE_DIM) -> 每条重复 SEQ_LEN 次 -> (batch, SEQ_LEN, PCA_DIM)"""
+    rows = np.asarray(rows, dtype=np.float32)
+    feat_seq = np.repeat(rows[:, None, :], SEQ_LEN, axis=1)
+    return preprocess.transform(feat_seq.reshape(len(rows) * SEQ_LEN, -1)).reshape(len(rows), SEQ_LEN, -1)
+
+
+def preprocess_single(rows, preprocess):
+    """快速路径：(batch, FEATURE_DIM) -> (batch, 1, PCA_DIM)，序列维由模型内广播"""
+    rows = np.asarray(rows, dtype=np.float32)
+    return preprocess.transform(rows)[:, None, :]
+
+
+def discriminator_outputs(model, rows, preprocess, fast=False):
+    """返回 (real_scores (batch,), class_prob (batch, NUM_CLASSES))，均为 numpy"""
+    if fast:
+        tensor_input = torch.tensor(preprocess_single(rows, preprocess), dtype=torch.float32).to(DEVICE)
+    else:
+        tensor_input = torch.tensor(preprocess_repeated(rows, preprocess), dtype=torch.float32).to(DEVICE)
+    with torch.no_grad():
+        if fast:
+            real_pred, class_pred = model.forward_repeated(tensor_input)
+        else:
+            real_pred, class_pred = model(tensor_input)
+        class_prob = torch.softmax(class_pred, dim=1)
+    return real_pred.cpu().numpy().reshape(-1), class_prob.cpu().numpy()
+
+
+def synthetic_flow_rows(scaler, count, seed=0):
+    """按 scaler 的均值/标准差生成非负的原始流特征样本，用于启动自检"""
+    rng = np.random.default_rng(seed)
+    mean = getattr(scaler, "mean_", None)
+    scale = getattr(scaler, "scale_", None)
+    mean = np.zeros(FEATURE_DIM) if mean is None else mean
+    scale = np.ones(len(mean)) if scale is None else scale
+    return np.abs(mean + scale * rng.standard_normal((count, len(mean)))).astype(np.float32)
+
+
+def verify_fast_path(model, preprocess, sample_rows, batch_sizes=(1, 8, 64), timing_rounds=20):
+    """
+    启动自检：用 sample_rows 比较快速路径与完整路径，要求输出逐位相同
+    返回 (是否一致, 完整路径单次耗时ms, 快速路径单次耗时ms)
+    """
+    if not hasattr(model, "forward_repeated"):
+        logger.warning(f"{COLORS['yellow']}⚠️ 当前推理后端不支持单向量快速路径，使用完整路径{COLORS['reset']}")
+        return False, 0.0, 0.0
+    for batch_size in batch_sizes:
+        rows = np.resize(sample_rows, (batch_size, sample_rows.shape[1]))
+        full = discriminator_outputs(model, rows, preprocess, fast=False)
+        fast = discriminator_outputs(model, rows, preprocess, fast=True)
+        if not (np.array_equal(full[0], fast[0]) and np.array_equal(full[1], fast[1])):
+            diff = max(np.abs(full[0] - fast[0]).max(), np.abs(full[1] - fast[1]).max())
+            logger.warning(f"{COLORS['yellow']}⚠️ 单向量快速路径与完整路径不一致（batch={batch_size}，最大差异{diff:.3e}），"
+                           f"回退完整路径{COLORS['reset']}")
+            return False, 0.0, 0.0
+
+    timings = []
+    rows = sample_rows[:1]
+    for fast in (False, True):
+        discriminator_outputs(model, rows, preprocess, fast=fast)  # 预热
+        started = time.perf_counter()
+        for _ in range(timing_rounds):
+            discriminator_outputs(model, rows, preprocess, fast=fast)
+        timings.append((time.perf_counter() - started) * 1000.0 / timing_rounds)
+    return True, timings[0], timings[1]
+
+
+# ========== 预处理：sklearn 参照实现 / 折叠后的仿射变换 ==========
+class SklearnPreprocess:
+    """逐步调用 scaler.pkl + pca.pkl（参照实现，带 sklearn 的输入校验开销）"""
+
+    name = "sklearn"
+
+    def __init__(self, scaler, pca):
+        self.scaler = scaler
+        self.pca = pca
+
+    def transform(self, X):
+        return self.pca.transform(self.scaler.transform(X))
+
+
+class FusedAffinePreprocess:
+    """scaler+PCA 折叠成一次 x @ W + b（float64 计算，与 sklearn 输出 dtype 一致）"""
+
+    name = "fused_affine"
+
+    def __init__(self, W, b):
+        self.W = np.asarray(W, dtype=np.float64)
+        self.b = np.asarray(b, dtype=np.float64)
+
+    def transform(self, X):
+        return np.asarray(X, dtype=np.float64) @ self.W + self.b
+
+
+def check_affine_parity(fused, scaler, pca, samples=1000, atol=1e-4, rtol=1e-4):
+    """与 sklearn 逐步变换比较，返回最大绝对误差；超出容差时抛出 ValueError"""
+    rows = synthetic_flow_rows(scaler, samples)
+    ref = SklearnPreprocess(scaler, pca).transform(rows)
+    out = fused.transform(rows)
+    max_diff = float(np.abs(out - ref).max())
+    if not np.allclose(out, ref, atol=atol, rtol=rtol):
+        raise ValueError(f"fused affine 与 sklearn 输出不一致（最大误差 {max_diff:.3e}）")
+    return max_diff
+
+
+def load_preprocess(scaler, pca):
+    """优先使用折叠后的仿射变换（存在且通过一致性校验），否则回退 sklearn 逐步变换"""
+    if USE_FUSED_AFFINE and os.path.exists(FUSED_W_PATH) and os.path.exists(FUSED_B_PATH):
+        try:
+            fused = FusedAffinePreprocess(np.load(FUSED_W_PATH), np.load(FUSED_B_PATH))
+            max_diff = check_affine_parity(fused, scaler, pca)
+            logger.info(f"{COLORS['green']}✅ 使用融合仿射预处理 {fused.W.shape}（与sklearn最大误差 {max_diff:.2e}）{COLORS['reset']}")
+            return fused
+        except Exception as e:
+            logger.warning(f"{COLORS['yellow']}⚠️ 融合仿射预处理不可用，回退 sklearn：{str(e)}{COLORS['reset']}")
+    return SklearnPreprocess(scaler, pca)
+
+
+# ========== 蒸馏学生模型（NumPy 推理） ==========
+class StudentMLP:
+    """
+    12维PCA特征上的两层MLP（ReLU），输出 NUM_CLASSES 个分类logit + 1 个 real_score
+    权重由 distill_student.py 训练后导出为 npz，运行时只依赖 NumPy
+    """
+
+    def __init__(self, weights, biases, label_classes):
+        self.weights = [np.asarray(w, dtype=np.float32) for w in weights]
+        self.biases = [np.asarray(b, dtype=np.float32) for b in biases]
+        self.label_classes = [str(label) for label in label_classes]
+
+    @classmethod
+    def load(cls, path=STUDENT_PATH):
+        data = np.load(path, allow_pickle=False)
+        layers = int(data["num_layers"])
+        return cls([data[f"W{i}"] for i in range(layers)], [data[f"b{i}"] for i in range(layers)],
+                   data["label_classes"])
+
+    def save(self, path=STUDENT_PATH):
+        arrays = {f"W{i}": w for i, w in enumerate(self.weights)}
+        arrays.update({f"b{i}": b for i, b in enumerate(self.biases)})
+        np.savez(path, num_layers=len(self.weights), label_classes=np.array(self.label_classes), **arrays)
+
+    def predict(self, X):
+        """X: (batch, PCA_DIM) -> (real_scores (batch,), class_prob (batch, NUM_CLASSES))"""
+        h = np.asarray(X, dtype=np.float32)
+        for W, b in zip(self.weights[:-1], self.biases[:-1]):
+            h = np.maximum(h @ W + b, 0.0)
+        out = h @ self.weights[-1] + self.biases[-1]
+        logits = out[:, :-1]
+        logits = logits - logits.max(axis=1, keepdims=True)
+        prob = np.exp(logits)
+        prob /= prob.sum(axis=1, keepdims=True)
+        return out[:, -1], prob
+
+    def confident_mask(self, real_scores, class_prob, normal_idx,
+                       min_confidence=STUDENT_CONFIDENCE, real_margin=STUDENT_REAL_MARGIN):
+        """学生可直接裁决的流：高置信度判为正常且 real_score 未落入 OOD 区间；其余升级给判别器"""
+        return ((class_prob.argmax(axis=1) == normal_idx)
+                & (class_prob.max(axis=1) >= min_confidence)
+                & (real_scores > real_margin))
+
+
+def load_student():
+    if not (USE_STUDENT and os.path.exists(STUDENT_PATH)):
+        return None
+    try:
+        student = StudentMLP.load(STUDENT_PATH)
+        logger.info(f"{COLORS['green']}✅ 已加载蒸馏学生模型（{STUDENT_PATH}，置信度门槛 {STUDENT_CONFIDENCE}）{COLORS['reset']}")
+        return student
+    except Exception as e:
+        logger.warning(f"{COLORS['yellow']}⚠️ 学生模型加载失败，全部流使用判别器：{str(e)}{COLORS['reset']}")
+        return None
+
+
+# ========== 批量推理调度 ==========
+class LatencyRecorder:
+    """保留最近 N 个耗时样本（秒），报告时给出 p50/p95/p99/max（毫秒）。"""
+
+    def __init__(self, maxlen=10000):
+        self.samples = deque(maxlen=maxlen)
+        self.count = 0
+
+    def add(self, seconds):
+        self.samples.append(seconds)
+        self.count += 1
+
+    def summary(self):
+        if not self.samples:
+            return "无样本"
+        arr = np.asarray(self.samples) * 1000.0
+        p50, p95, p99 = np.percentile(arr, [50, 95, 99])
+        return f"p50={p50:.2f}ms p95={p95:.2f}ms p99={p99:.2f}ms max={arr.max():.2f}ms (n={self.count})"
+
+
+class BatchInferenceScheduler:
+    """
+    把就绪的流攒成批再推理：
+    - 抓包线程 submit() 只入队，不做 scaler/PCA/前向
+    - 工作线程在 max_batch 条或最早一条等待超过 max_latency_ms 时调用一次 infer_fn(items)
+    - infer_fn 返回与 items 等长的结果列表，逐条交给 on_result(item, result) 回到判定逻辑；
+      给定 on_batch 时改为整批调用一次 on_batch(items, results)（判定逻辑可按批向量化）
+    队列满时丢弃新提交的流并计数（不阻塞抓包线程）。
+    """
+
+    def __init__(self, infer_fn, on_result, max_batch=INFER_BATCH_SIZE,
+                 max_latency_ms=INFER_MAX_LATENCY_MS, max_queue=INFER_QUEUE_SIZE, on_batch=None):
+        self.infer_fn = infer_fn
+        self.on_result = on_result
+        self.on_batch = on_batch
+        self.max_batch = max(1, max_batch)
+        self.max_latency = max(0.0, max_latency_ms) / 1000.0
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="infer-batcher", daemon=True)
+
+        self.batch_sizes = Counter()
+        self.queue_wait = LatencyRecorder()
+        self.end_to_end = LatencyRecorder()
+        self.batches = 0
+        self.submitted = 0
+        self.dropped = 0
+        self.errors = 0
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def submit(self, item, arrived_at=None, block=False):
+        """
+        arrived_at：触发检测的报文进入回调时的 time.perf_counter()，用于端到端延迟。
+        block=True 时队列满则等待（pcap 回放不能丢流），否则丢弃并计数。
+        """
+        now = time.perf_counter()
+        try:
+            self._queue.put((item, arrived_at or now, now), block=block)
+            self.submitted += 1
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def stop(self, timeout=5.0):
+        """停止并尽量处理完队列中剩余的流。"""
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join(timeout=timeout)
+
+    def _collect(self):
+        try:
+            first = self._queue.get(timeout=0.2)
+        except queue.Empty:
+            return []
+        batch = [first]
+        deadline = first[2] + self.max_latency
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.perf_counter()
+            try:
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while not (self._stop.is_set() and self._queue.empty()):
+            batch = self._collect()
+            if not batch:
+                continue
+            started = time.perf_counter()
+            for _, _, enqueued_at in batch:
+                self.queue_wait.add(started - enqueued_at)
+            self.batches += 1
+            self.batch_sizes[len(batch)] += 1
+            try:
+                results = self.infer_fn([entry[0] for entry in batch])
+            except Exception as e:
+                self.errors += len(batch)
+                logger.error(f"{COLORS['red']}❌ 批量推理失败（{len(batch)}条流）：{str(e)}{COLORS['reset']}")
+                continue
+            if self.on_batch is not None:
+                try:
+                    self.on_batch([entry[0] for entry in batch], results)
+                except Exception as e:
+                    self.errors += len(batch)
+                    logger.error(f"{COLORS['red']}❌ 检测流程错误（{len(batch)}条流）：{str(e)}{COLORS['reset']}")
+                finished = time.perf_counter()
+                for _, arrived_at, _ in batch:
+                    self.end_to_end.add(finished - arrived_at)
+                continue
+            for (item, arrived_at, _), result in zip(batch, results):
+                try:
+                    self.on_result(item, result)
+                except Exception as e:
+                    self.errors += 1
+                    logger.error(f"{COLORS['red']}❌ 检测流程错误：{str(e)}{COLORS['reset']}")
+                self.end_to_end.add(time.perf_counter() - arrived_at)
+
+    def batch_size_distribution(self):
+        """按 1 / 2 / 3-4 / 5-8 / ... 分桶统计批大小。"""
+        buckets = Counter()
+        for size, count in self.batch_sizes.items():
+            upper = 1
+            while upper < size:
+                upper *= 2
+            label = str(upper) if upper <= 2 else f"{upper // 2 + 1}-{upper}"
+            buckets[(upper, label)] += count
+        return ", ".join(f"{label}:{count}" for (_, label), count in sorted(buckets.items())) or "无"
+
+    def report_lines(self):
+        flows_done = sum(size * count for size, count in self.batch_sizes.items())
+        avg = flows_done / self.batches if self.batches else 0.0
+        return [
+            f"批次数={self.batches}，推理流数={flows_done}，平均批大小={avg:.1f}，队列满丢弃={self.dropped}，失败={self.errors}",
+            f"批大小分布：{self.batch_size_distribution()}",
+            f"排队等待：{self.queue_wait.summary()}",
+            f"端到端检测延迟：{self.end_to_end.summary()}",
+        ]
 
 if __name__ == "__main__":
     logger.info(f"{COLORS['green']}✅ ids_common.py 核心模块加载成功{COLORS['reset']}")
\ No newline at end of file
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+判别器 int8 动态量化 + 精度门槛
+
+流程：
+1. load_model() 加载 fp32 判别器（Opacus 变体同样支持）
+2. torch.ao.quantization.quantize_dynamic 量化所有 nn.Linear（Transformer 的 QKV/前馈层与输出头）
+3. 用 evaluate_dp_wgan.evaluate_model 分别评估 fp32 / int8（准确率、ROC AUC、混淆矩阵）
+4. 准确率下降不超过 --max-accuracy-drop 才写出 transec_gan_model/discriminator_int8.pth，否则拒绝发布
+
+用法：
+    python quantize_model.py [--max-accuracy-drop 0.01]
+运行时通过 IDS_BACKEND=int8 让 load_model 使用量化模型（仅 CPU）。
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+# 动态量化只在 CPU 上执行，评估也统一放在 CPU（须在导入 ids_common 之前设置）
+os.environ.setdefault("USE_CUDA", "0")
+
+import torch
+
+from ids_common import (
+    logger, COLORS, DEVICE, MODEL_PATH, QUANTIZED_MODEL_PATH, SEQ_LEN, PCA_DIM,
+    load_model, is_opacus_state_dict, quantize_discriminator
+)
+from evaluate_dp_wgan import evaluate_model, load_evaluation_data, resolve_normal_label
+
+DEFAULT_MAX_ACCURACY_DROP = float(os.environ.get("QUANT_MAX_ACCURACY_DROP", "0.01"))
+
+
+def summarize(name, metrics):
+    accuracy = metrics["classification_report"]["accuracy"]
+    logger.info(f"   {name}：准确率 {accuracy:.4%} | ROC AUC {metrics['roc_auc']:.4f}")
+    logger.info(f"   {name} 混淆矩阵（行=真实，列=预测）：\n{metrics['confusion_matrix']}")
+    return accuracy
+
+
+def model_size_bytes(model):
+    path = os.path.join(os.path.dirname(QUANTIZED_MODEL_PATH), ".size_probe.pth")
+    torch.save(model.state_dict(), path)
+    size = os.path.getsize(path)
+    os.remove(path)
+    return size
+
+
+def latency_ms(model, batch_size=1, rounds=50):
+    x = torch.randn(batch_size, SEQ_LEN, PCA_DIM)
+    with torch.no_grad():
+        model(x)
+        started = time.perf_counter()
+        for _ in range(rounds):
+            model(x)
+    return (time.perf_counter() - started) * 1000.0 / rounds
+
+
+def main():
+    parser = argparse.ArgumentParser(description="判别器 int8 动态量化（带精度门槛）")
+    parser.add_argument("--max-accuracy-drop", type=float, default=DEFAULT_MAX_ACCURACY_DROP,
+                        help="允许的最大准确率下降（绝对值，0.01 表示 1 个百分点）")
+    parser.add_argument("--output", default=QUANTIZED_MODEL_PATH, help="量化模型输出路径")
+    args = parser.parse_args()
+
+    if DEVICE != "cpu":
+        logger.error(f"{COLORS['red']}❌ 动态量化仅支持 CPU，请设置 USE_CUDA=0{COLORS['reset']}")
+        sys.exit(1)
+
+    fp32, _, scaler, pca, model_labels = load_model(backend="eager")
+    checkpoint = torch.load(MODEL_PATH, map_location="cpu", weights_only=False)
+    disc_state_dict = checkpoint["discriminator_state_dict"]
+    int8 = quantize_discriminator(fp32)
+
+    X_test, y_test, labels = load_evaluation_data()
+    normal_label = resolve_normal_label(labels)
+
+    logger.info("📊 评估 fp32 判别器...")
+    fp32_acc = summarize("fp32", evaluate_model(fp32, X_test, y_test, model_labels, normal_label, scaler, pca))
+    logger.info("📊 评估 int8 判别器...")
+    int8_metrics = evaluate_model(int8, X_test, y_test, model_labels, normal_label, scaler, pca)
+    int8_acc = summarize("int8", int8_metrics)
+
+    drop = fp32_acc - int8_acc
+    report = {
+        "source_checkpoint": MODEL_PATH,
+        "fp32_accuracy": fp32_acc,
+        "int8_accuracy": int8_acc,
+        "accuracy_drop": drop,
+        "max_accuracy_drop": args.max_accuracy_drop,
+        "int8_roc_auc": float(int8_metrics["roc_auc"]),
+        "fp32_size_bytes": model_size_bytes(fp32),
+        "int8_size_bytes": model_size_bytes(int8),
+        "fp32_latency_ms_b1": latency_ms(fp32),
+        "int8_latency_ms_b1": latency_ms(int8),
+    }
+    logger.info(f"   体积：{report['fp32_size_bytes'] / 1024:.0f}KB → {report['int8_size_bytes'] / 1024:.0f}KB | "
+                f"单流延迟：{report['fp32_latency_ms_b1']:.2f}ms → {report['int8_latency_ms_b1']:.2f}ms")
+
+    if drop > args.max_accuracy_drop:
+        logger.error(f"{COLORS['red']}❌ int8 准确率下降 {drop:.4%} 超过门槛 {args.max_accuracy_drop:.4%}，拒绝发布量化模型{COLORS['reset']}")
+        sys.exit(1)
+
+    torch.save({
+        "quantized_state_dict": int8.state_dict(),
+        "opacus_fixed": is_opacus_state_dict(disc_state_dict),
+        "label_classes": checkpoint["label_classes"],
+        "quant_dtype": "qint8",
+        "report": report,
+    }, args.output)
+    with open(os.path.splitext(args.output)[0] + "_report.json", "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    logger.info(f"{COLORS['green']}✅ int8 判别器已通过精度门槛（下降 {drop:.4%}），已保存：{args.output}{COLORS['reset']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,13 @@
+import argparse
+import copy
+import logging
 import os
 import random
 import threading
 import time
 import json
 import socket
+from collections import Counter, defaultdict, deque
 from datetime import datetime, timedelta, timezone
 
 import numpy as np
@@ -13,12 +17,19 @@ from scapy.layers.inet import IP, TCP, UDP
 from scapy.layers.inet6 import IPv6
 from scapy.layers.l2 import ARP
 from scapy.config import conf
-from scapy.all import sniff
+from scapy.all import PcapReader
 from ids_common import (
     logger, COLORS, flows, DEVICE, LOG_FILE, ANOMALY_THRESHOLD,
     get_wlan_interface, load_model, extract_features, clean_timeout_flows,
-    get_flow_key, SEQ_LEN, PCA_DIM
+    get_flow_key, SEQ_LEN, PCA_DIM, INFER_BATCH_SIZE, INFER_MAX_LATENCY_MS, BatchInferenceScheduler,
+    SINGLE_VECTOR_FASTPATH, discriminator_outputs, verify_fast_path, synthetic_flow_rows, load_preprocess,
+    load_student, flow_expiry, FlowScoringPolicy, SHORT_FLOW_BATCH, FeatureDeltaGate,
+    metrics, LogRateLimiter, BENIGN_LOG_RATE, load_detector, load_generator, resolve_normal_label
 )
+from alert_spool import AlertSpool, ALERT_SPOOL_ENABLED, ALERT_SPOOL_DIR
+from verdict_rules import VerdictEngine, MIN_ATTACK_CONFIDENCE, UNKNOWN_ATTACK, rule_hit_counts
+from capture_session import CaptureSession
+from host_sketches import HostSketchMonitor, HOST_SKETCH_ENABLED, HOST_WINDOW_SECONDS
 
 # ========== 运行配置 ==========
 CAPTURE_MINUTES = 300000 / 60  # 30秒（30/60分钟）
@@ -95,29 +106,15 @@ def reload_trusted_ips():
     except Exception as e:
         pass
 
-# 判定灵敏度（可通过环境变量调整）
-# 【调整】恢复阈值以解决unknown流量过多问题（参考backup版本）
-MIN_ATTACK_CONFIDENCE = float(os.environ.get("MIN_ATTACK_CONFIDENCE", "0.5"))
-# 【调整】恢复OOD检测敏感度（参考backup版本）
-REAL_SCORE_THRESHOLD = float(os.environ.get("REAL_SCORE_THRESHOLD", "-0.05"))
-
-# 端口特征：哪些组合被视为“已知”攻击（其余高危流量可落入未知）
-KNOWN_ATTACK_SOURCE_PORTS = {
-    50000, 50001, 50002, 50010, 50011, 50012, 50013, 50014,
-    58000,  # 端口扫描
-    59000,  # Web攻击
-    60000,  # 暴力破解
-    61000,  # 渗透攻击
-    62000   # 僵尸网络
-}
-KNOWN_TCP_TARGET_PORTS = {
-    21, 22, 23, 25, 53, 80, 81, 110, 143, 443, 445, 3306, 3389, 5432, 8080, 8443
-}
-KNOWN_UDP_TARGET_PORTS = {53, 80, 81, 8080}
-
 # 告警网关配置
 ALERT_API_URL = os.environ.get("ALERT_API_URL", "http://127.0.0.1:8081/api/analysis/alert")
 ALERT_API_TIMEOUT = float(os.environ.get("ALERT_API_TIMEOUT", "2.5"))
+# 告警投递：固定数量的发送线程 + 有界队列（满时先丢弃严重度最低的告警）
+ALERT_WORKERS = int(os.environ.get("ALERT_WORKERS", "2"))
+ALERT_QUEUE_SIZE = int(os.environ.get("ALERT_QUEUE_SIZE", "1000"))
+# 批量推送：Backnode 的 /api/analysis/alert 只接收单条告警；网关提供接收 JSON 数组的批量接口时配置 ALERT_BATCH_URL
+ALERT_BATCH_URL = os.environ.get("ALERT_BATCH_URL", "")
+ALERT_BATCH_SIZE = int(os.environ.get("ALERT_BATCH_SIZE", "20"))
 
 # 确保URL格式正确
 if ALERT_API_URL and not ALERT_API_URL.startswith("http"):
@@ -138,10 +135,37 @@ alert_detected_count = 0  # 检测到的异常总数（包括未推送的）
 short_sequence_skipped = 0
 feature_extract_skipped = 0
 stop_capture = False
+capture_session = None  # 常驻抓包会话（capture_traffic 中创建，整个检测周期只打开一次句柄）
 model, generator, scaler, pca, labels = None, None, None, None, []
+infer_scheduler = None  # 批量推理调度器（INFER_BATCH_SIZE<=1 时为 None，逐流内联推理）
+use_fast_path = False  # 单向量快速路径（启动自检通过后开启）
+preprocess = None  # scaler+PCA 预处理（优先融合仿射变换）
+student = None  # 蒸馏学生模型（第一级分类器），None 表示全部流走判别器
+student_handled = 0  # 学生直接裁决的流数
+student_escalated = 0  # 升级到判别器的流数
+student_seconds = 0.0
+teacher_seconds = 0.0
+final_scored_flows = 0  # 流超时结束时补做最后一次评分的流数
+scoring_policy = FlowScoringPolicy()  # 流评分时机（FIN/RST、超时、包数检查点）
+delta_gate = None  # 特征增量门控（特征几乎不变时复用上次模型输出），init_detection_engine 中创建
+replay_mode = False  # pcap 离线回放：流统计由报文时间驱动，不加载本机信任/封禁名单
+push_alerts = True  # 是否向告警网关推送（回放模式默认关闭）
+alert_spool = None  # 告警网关不可达时的落盘缓存（init_detection_engine 中打开）
+alert_spool_dir = ALERT_SPOOL_DIR  # 分片流水线中每个 worker 使用各自的子目录
+_spool_session = None  # 缓存重放线程专用的 keep-alive 会话
+benign_log_limiter = LogRateLimiter(BENIGN_LOG_RATE, "benign_log")  # 正常流量日志限流，避免逐流写盘
+verdict_sink = None  # 回放模式的逐流判定输出（JSONL）
+REPLAY_SEED = 0  # --deterministic 时判定逻辑中 random 抖动使用的种子
+_push_count_lock = threading.Lock()
 target_iface = None
 start_timestamp = 0
 normal_label = "Benign"
+engine_init_started = None  # init_detection_engine 开始时刻（perf_counter），首次判定耗时以此为起点
+model_load_seconds = 0.0
+model_source = ""  # slim（精简检测模型）/ checkpoint（完整训练 checkpoint）
+first_verdict_seconds = None  # 初始化开始到第一次判定完成的耗时
+verdict_engine = None  # 模型输出之后的规则表判定（verdict_rules.VerdictEngine），init_detection_engine 中按 normal_label 创建
+host_monitor = None  # 主机级草图（host_sketches.HostSketchMonitor），跨流检测扫描/分布式洪泛；HOST_SKETCH=0 时为 None
 
 
 def is_private_ip(ip_str):
@@ -312,13 +336,7 @@ def handle_non_ip_packet(packet, packet_summary):
         logger.debug(f"处理非IP包失败: {str(e)}")
 
 
-def send_alert_payload(payload):
-    global alert_push_success, alert_push_failed
-    if not ALERT_API_URL:
-        logger.warning(f"{COLORS['yellow']}⚠️ 告警网关URL未配置，跳过推送{COLORS['reset']}")
-        alert_push_failed += 1
-        return False
-    
+def _to_backnode_payload(payload):
     # 【适配 Backnode】构造符合 potentialThreatAlert 实体的 Payload
     # Backnode 实体字段: threatId, threatLevel, impactScope, occurTime, createTime
     try:
@@ -333,15 +351,69 @@ def send_alert_payload(payload):
         }
         # 记录调试日志
         logger.debug(f"Payload adapted for Backnode: {backnode_payload}")
-        json_to_send = backnode_payload
+        return backnode_payload
     except Exception as e:
         logger.error(f"Payload adaptation failed: {e}")
-        json_to_send = payload # Fallback to original if adaptation fails
+        return payload # Fallback to original if adaptation fails
+
+
+def _count_push(success=0, failed=0):
+    """多个发送线程共用推送计数，加锁累加"""
+    global alert_push_success, alert_push_failed
+    with _push_count_lock:
+        alert_push_success += success
+        alert_push_failed += failed
+
+
+def _spool_or_fail(json_to_send):
+    """网关不可达：有落盘缓存时写入缓存等待重放，否则计为推送失败"""
+    if alert_spool is not None:
+        alert_spool.append(json_to_send)
+        logger.warning(f"{COLORS['yellow']}   告警已写入本地缓存，网关恢复后按顺序重放（待重放{alert_spool.pending_records}条）{COLORS['reset']}")
+    else:
+        _count_push(failed=1)
+
+
+def _deliver_spooled(json_to_send):
+    """缓存重放回调：投递成功或被网关拒绝（4xx，重试无意义）返回 True，网关仍不可达返回 False 稍后重试"""
+    try:
+        response = _spool_session.post(
+            ALERT_API_URL,
+            json=json_to_send,
+            timeout=ALERT_API_TIMEOUT,
+            headers={"Content-Type": "application/json"},
+            proxies={"http": None, "https": None}
+        )
+    except requests.exceptions.RequestException:
+        return False
+    if response.status_code >= 500:
+        return False
+    if response.ok:
+        _count_push(success=1)
+        logger.info(f"{COLORS['green']}✅ 缓存告警已重放到网关: {json_to_send.get('threatId', 'N/A')}{COLORS['reset']}")
+    else:
+        logger.warning(f"{COLORS['yellow']}⚠️ 缓存告警被网关拒绝（HTTP {response.status_code}），不再重试{COLORS['reset']}")
+        _count_push(failed=1)
+    return True
+
+
+def send_alert_payload(payload, session=None):
+    """推送单条告警；session 为发送线程的 keep-alive 会话，None 时使用一次性连接"""
+    if not ALERT_API_URL:
+        logger.warning(f"{COLORS['yellow']}⚠️ 告警网关URL未配置，跳过推送{COLORS['reset']}")
+        _count_push(failed=1)
+        return False
+
+    json_to_send = _to_backnode_payload(payload)
+    if alert_spool is not None and alert_spool.pending_records:
+        # 缓存中还有未重放的告警：新告警排在其后，保证网关收到的顺序与产生顺序一致
+        alert_spool.append(json_to_send)
+        return False
 
     # 直接推送告警，不进行健康检查（简化流程）
     try:
         logger.debug(f"📤 正在推送告警到 {ALERT_API_URL}...")
-        response = requests.post(
+        response = (session or requests).post(
             ALERT_API_URL,
             json=json_to_send,
             timeout=ALERT_API_TIMEOUT,
@@ -350,13 +422,13 @@ def send_alert_payload(payload):
         )
         response.raise_for_status()
         logger.info(f"{COLORS['green']}✅ 告警已推送到网关: {payload.get('attack_type', 'N/A')} (ID: {response.json().get('alert_id', 'N/A')}){COLORS['reset']}")
-        alert_push_success += 1
+        _count_push(success=1)
         return True
     except requests.exceptions.ConnectionError as e:
         logger.warning(f"{COLORS['yellow']}⚠️ 无法连接到告警网关 {ALERT_API_URL}{COLORS['reset']}")
         logger.warning(f"{COLORS['yellow']}   错误详情: {str(e)}{COLORS['reset']}")
         logger.warning(f"{COLORS['yellow']}   请确保网关正在运行: python alert_gateway/alert_api.py{COLORS['reset']}")
-        alert_push_failed += 1
+        _spool_or_fail(json_to_send)
         return False
     except requests.exceptions.HTTPError as e:
         logger.warning(f"{COLORS['yellow']}⚠️ 告警推送HTTP错误: {e.response.status_code}{COLORS['reset']}")
@@ -367,20 +439,154 @@ def send_alert_payload(payload):
             pass
         if e.response.status_code == 502:
             logger.warning(f"{COLORS['yellow']}   网关可能未运行或已崩溃，请重启网关{COLORS['reset']}")
-        alert_push_failed += 1
+        if e.response.status_code >= 500:
+            _spool_or_fail(json_to_send)
+        else:
+            _count_push(failed=1)
         return False
     except requests.exceptions.Timeout:
         logger.warning(f"{COLORS['yellow']}⚠️ 告警推送超时（>{ALERT_API_TIMEOUT}秒）{COLORS['reset']}")
-        alert_push_failed += 1
+        _spool_or_fail(json_to_send)
         return False
     except Exception as exc:
         logger.warning(f"{COLORS['yellow']}⚠️ 告警推送失败：{type(exc).__name__}: {str(exc)}{COLORS['reset']}")
         import traceback
         logger.debug(f"{COLORS['yellow']}详细错误: {traceback.format_exc()}{COLORS['reset']}")
-        alert_push_failed += 1
+        _count_push(failed=1)
         return False
 
 
+class AlertDispatcher:
+    """
+    告警投递：固定数量的发送线程 + 有界队列，每个发送线程一个 keep-alive Session
+    - 队列按严重度分桶，先发严重度高的（同一严重度内先进先出）
+    - 队列满时丢弃严重度最低的最旧告警；新告警严重度不高于队列中最低者时直接丢弃新告警
+    - 配置 batch_url 时一次取多条 POST 一个 JSON 数组；批量接口不存在（404/405/415）则退回逐条推送
+    """
+
+    def __init__(self, workers=ALERT_WORKERS, max_queue=ALERT_QUEUE_SIZE, batch_url=ALERT_BATCH_URL,
+                 batch_size=ALERT_BATCH_SIZE):
+        self.workers = max(1, workers)
+        self.max_queue = max(1, max_queue)
+        self.batch_url = batch_url
+        self.batch_size = max(1, batch_size)
+        self._buckets = defaultdict(deque)  # 严重度 -> 待发送告警
+        self._size = 0
+        self._cond = threading.Condition()
+        self._threads = []
+        self._stopping = False
+        self.dropped = Counter()  # 严重度 -> 丢弃数
+        self.batches = 0
+
+    def _ensure_started(self):
+        if self._threads:
+            return
+        self._threads = [threading.Thread(target=self._run, name=f"alert-sender{i}", daemon=True)
+                         for i in range(self.workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, payload, severity):
+        with self._cond:
+            self._ensure_started()
+            if self._size >= self.max_queue:
+                lowest = min(level for level, pending in self._buckets.items() if pending)
+                if severity <= lowest:
+                    self.dropped[severity] += 1
+                    return False
+                self._buckets[lowest].popleft()
+                self.dropped[lowest] += 1
+                self._size -= 1
+            self._buckets[severity].append(payload)
+            self._size += 1
+            self._cond.notify()
+        return True
+
+    def _take(self):
+        """取出下一批（未配置批量接口时为 1 条）；停止且队列已空时返回 []"""
+        with self._cond:
+            while self._size == 0 and not self._stopping:
+                self._cond.wait()
+            limit = self.batch_size if self.batch_url else 1
+            batch = []
+            for level in sorted((level for level, pending in self._buckets.items() if pending), reverse=True):
+                pending = self._buckets[level]
+                while pending and len(batch) < limit:
+                    batch.append(pending.popleft())
+                if len(batch) >= limit:
+                    break
+            self._size -= len(batch)
+            return batch
+
+    def _run(self):
+        session = requests.Session()
+        while True:
+            batch = self._take()
+            if not batch:
+                return
+            if len(batch) > 1 and self._post_batch(session, batch):
+                continue
+            for payload in batch:
+                send_alert_payload(payload, session)
+
+    def _post_batch(self, session, batch):
+        """批量推送；返回 False 表示批量接口不可用，由调用方逐条推送"""
+        batch_url = self.batch_url
+        if not batch_url:
+            return False
+        if alert_spool is not None and alert_spool.pending_records:
+            # 缓存中还有未重放的告警：逐条走 send_alert_payload，新告警排在缓存之后
+            return False
+        try:
+            response = session.post(
+                batch_url,
+                json=[_to_backnode_payload(payload) for payload in batch],
+                timeout=ALERT_API_TIMEOUT,
+                proxies={"http": None, "https": None}
+            )
+            if response.status_code in (404, 405, 415):
+                logger.warning(f"{COLORS['yellow']}⚠️ 批量告警接口不可用（HTTP {response.status_code}），改为逐条推送{COLORS['reset']}")
+                self.batch_url = ""
+                return False
+            response.raise_for_status()
+            _count_push(success=len(batch))
+            self.batches += 1
+            logger.info(f"{COLORS['green']}✅ 批量推送告警{len(batch)}条到网关{COLORS['reset']}")
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as exc:
+            logger.warning(f"{COLORS['yellow']}⚠️ 批量告警推送失败（{len(batch)}条）：{type(exc).__name__}{COLORS['reset']}")
+            for payload in batch:
+                _spool_or_fail(_to_backnode_payload(payload))
+        except requests.exceptions.HTTPError as exc:
+            status = exc.response.status_code
+            logger.warning(f"{COLORS['yellow']}⚠️ 批量告警推送HTTP错误（{len(batch)}条）：{status}{COLORS['reset']}")
+            if status >= 500:
+                # 与单条推送一致：网关侧故障写入缓存等待重放，4xx 重试无意义计为失败
+                for payload in batch:
+                    _spool_or_fail(_to_backnode_payload(payload))
+            else:
+                _count_push(failed=len(batch))
+        except Exception as exc:
+            logger.warning(f"{COLORS['yellow']}⚠️ 批量告警推送失败（{len(batch)}条）：{type(exc).__name__}: {str(exc)}{COLORS['reset']}")
+            _count_push(failed=len(batch))
+        return True
+
+    def stop(self, timeout=10.0):
+        """停止接收新告警的等待，发完队列中剩余告警后退出，最多等待 timeout 秒"""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        deadline = time.time() + timeout
+        for thread in self._threads:
+            thread.join(timeout=max(0.0, deadline - time.time()))
+
+    def pending(self):
+        with self._cond:
+            return self._size
+
+
+alert_dispatcher = AlertDispatcher()
+
+
 def calculate_severity(attack_type, confidence, is_known_attack, real_score, flow_stats=None):
     """根据攻击类型、置信度等动态计算严重程度"""
     # 高危攻击类型（severity 4-5）
@@ -434,6 +640,8 @@ def calculate_severity(attack_type, confidence, is_known_attack, real_score, flo
 
 
 def push_detection_alert(flow_key, attack_type, confidence, severity, message, real_score, flow_stats=None):
+    if not push_alerts:
+        return
     try:
         # 如果传入的severity为None或需要重新计算，使用动态计算
         if severity is None or severity < 3:
@@ -467,42 +675,48 @@ def push_detection_alert(flow_key, attack_type, confidence, severity, message, r
             level = "ℹ️ 低危"
         
         logger.info(f"{color}{level} 推送告警: {attack_type} (置信度: {confidence:.2f}, 严重度: {severity}){COLORS['reset']}")
-        send_alert_payload(alert_payload)
+        if not alert_dispatcher.submit(alert_payload, int(severity)):
+            logger.warning(f"{COLORS['yellow']}⚠️ 告警队列已满，丢弃严重度{severity}的告警: {attack_type}{COLORS['reset']}")
     except Exception as e:
         logger.error(f"{COLORS['red']}❌ 告警数据构造失败: {str(e)}{COLORS['reset']}")
         import traceback
         logger.error(f"{COLORS['red']}详细错误: {traceback.format_exc()}{COLORS['reset']}")
 
 
+def observe_host_packet(packet, timestamp=None):
+    """主机级草图逐包更新（仅 IPv4）；跨入新的子窗口时判定一次，把扫描/洪泛告警推送到网关"""
+    ip = packet[IP]
+    layer = packet[TCP] if packet.haslayer(TCP) else (packet[UDP] if packet.haslayer(UDP) else None)
+    dst_port = int(layer.dport) if layer is not None else 0
+    alerts = host_monitor.update(ip.src, ip.dst, dst_port, int(ip.proto), ip.len or len(ip),
+                                 timestamp if timestamp is not None else time.time())
+    for alert in alerts:
+        logger.warning(f"{COLORS['red']}🚨 {alert.message}（{alert.attack_type}）{COLORS['reset']}")
+        # 扫描告警的目标、洪泛告警的来源为 "*"（多个主机），端口/协议不适用
+        push_detection_alert((alert.src_ip, alert.dst_ip, 0, 0, 0), alert.attack_type, alert.confidence,
+                             alert.severity, alert.message, 0.0)
+
+
 def get_label_name(idx: int) -> str:
     if labels and 0 <= idx < len(labels):
         return labels[idx]
     return f"Class_{idx}"
 
 
-def resolve_normal_label(label_list):
-    if not label_list:
-        return "Benign"
-    candidates = ["benign", "normal", "benign traffic", "normal traffic", "正常", "0"]
-    for cand in candidates:
-        for label in label_list:
-            label_str = label if isinstance(label, str) else str(label)
-            if label_str.lower() == cand:
-                return label
-    return label_list[0]
-
-
-def packet_callback(packet):
-    global total_packets_captured, total_valid_packets, short_sequence_skipped, feature_extract_skipped, alert_detected_count
+def packet_callback(packet, timestamp=None):
+    """timestamp：pcap 回放时传入报文时间，流统计与超时都按报文时间计算；实时抓包为 None"""
+    global total_packets_captured, total_valid_packets, short_sequence_skipped, feature_extract_skipped
     if stop_capture:
         return
+    arrived_at = time.perf_counter()
 
     total_packets_captured += 1
-    clean_timeout_flows()
+    clean_timeout_flows(timestamp)
 
-    # 0. 检查是否为信任IP（白名单）或已封禁IP
-    reload_trusted_ips()
-    reload_blocked_ips()
+    # 0. 检查是否为信任IP（白名单）或已封禁IP（回放的抓包来自其他主机，不使用本机名单）
+    if not replay_mode:
+        reload_trusted_ips()
+        reload_blocked_ips()
     if packet.haslayer(IP):
         src_ip = packet[IP].src
         if src_ip in trusted_ips:
@@ -511,6 +725,8 @@ def packet_callback(packet):
         if src_ip in blocked_ips:
             # 已封禁IP的流量，跳过检测（避免重复告警）
             return
+        if host_monitor is not None:
+            observe_host_packet(packet, timestamp)
 
     # === 新增：特定端口白名单（放行腾讯会议等高频流量） ===
     if packet.haslayer(TCP) or packet.haslayer(UDP):
@@ -558,7 +774,7 @@ def packet_callback(packet):
 
     # 2. 特征提取+检测（仅IPv4包）
     try:
-        feat_result = extract_features(packet)
+        feat_result = extract_features(packet, timestamp)
         if not feat_result:
             feature_extract_skipped += 1
             return
@@ -569,678 +785,273 @@ def packet_callback(packet):
         # 关键修复：特征窗口逻辑
         # 问题：原来每次append的是累积特征，导致窗口中的特征递增（第1个包特征值小，第32个包特征值大）
         # 解决：使用当前累积的完整流特征（基于整个流的统计），填充整个窗口
-        # 注意：feature_window仍然用于记录包数，但检测时使用完整的流特征
         
-        # 检查是否积累了足够包数（降低阈值以检测更多攻击）
-        # 原来是32个包，现在降低到16个包
-        min_packets = SEQ_LEN // 2  # 16个包
-        if flow["stats"] is None or (flow["stats"].fwd_packets + flow["stats"].bwd_packets) < min_packets:
+        # 评分时机由 scoring_policy 决定（见 ids_common.FlowScoringPolicy）：
+        # event 模式在 TCP FIN/RST 与包数检查点评分，短流在超时结束时成批评分；
+        # legacy 模式为原逻辑：满 SEQ_LEN//2（16）个包后，每增加 16 个包检测一次
+        if flow["stats"] is None:
             short_sequence_skipped += 1
             return
-        
-        # 【关键修复】避免同一流被重复检测：只在达到SEQ_LEN时检测一次，或每隔一定包数检测一次
-        # 如果这个流已经检测过，并且包数没有显著增加，跳过检测
-        if "last_detection_packet_count" in flow:
-            current_packet_count = flow["stats"].fwd_packets + flow["stats"].bwd_packets
-            # 只有当包数增加了至少SEQ_LEN/2（16个包）时才重新检测，避免每个包都检测
-            if current_packet_count - flow["last_detection_packet_count"] < SEQ_LEN // 2:
-                return
-        flow["last_detection_packet_count"] = flow["stats"].fwd_packets + flow["stats"].bwd_packets
+        tcp_flags = int(packet[TCP].flags) if packet.haslayer(TCP) else 0
+        reason = scoring_policy.on_packet(flow, tcp_flags)
+        if reason is None:
+            if scoring_policy.mode == "legacy" and (flow["stats"].fwd_packets + flow["stats"].bwd_packets) < SEQ_LEN // 2:
+                short_sequence_skipped += 1
+            return
+        scoring_policy.mark_scored(flow, reason)
         
         # 使用当前累积的完整流特征（这是基于整个流的统计特征）
         # 用这个特征填充32个位置，符合CICIDS2017的训练方式
-        complete_flow_features = features  # 当前累积的完整流特征
-        feat_seq = np.array([complete_flow_features] * SEQ_LEN, dtype=np.float32)
+        # 当前累积的完整流特征（列式流表不逐包计算，评分时才取）
+        complete_flow_features = features if features is not None else flow["stats"].to_feature_vector()
 
-        # 数据预处理
-        feat_scaled = scaler.transform(feat_seq)
-        feat_pca = pca.transform(feat_scaled)
-        tensor_input = torch.tensor(feat_pca, dtype=torch.float32).unsqueeze(0).to(DEVICE)
+        # 特征与上次推理时几乎相同且上次结果置信度高：复用模型输出，只重新走判定逻辑
+        reused = delta_gate.check(flow, complete_flow_features) if delta_gate is not None else None
+        if reused is not None:
+            apply_detection_verdict(flow_key, flow, flow["stats"], *reused)
+            return
 
-        # 模型推理（完整OOD检测逻辑）
-        with torch.no_grad():
-            real_pred, class_pred = model(tensor_input)  # 同时获取真实/虚假判定+分类
-            class_prob = torch.softmax(class_pred, dim=1)
-            attack_idx = class_prob.argmax(1).cpu().numpy().item()
-            attack_type = get_label_name(attack_idx)
-            confidence = class_prob[0, attack_idx].cpu().numpy().item()
-            real_score = real_pred.cpu().numpy().item()  # 真实流量得分（越高越真实）
-            
-            # 【调试日志】记录模型原始输出（仅在DEBUG模式下）
-            try:
-                import logging
-                if logger.level <= logging.DEBUG:
-                    all_probs = class_prob[0].cpu().numpy()
-                    prob_str = ", ".join([f"{get_label_name(i)}={p:.3f}" for i, p in enumerate(all_probs)])
-                    logger.debug(f"模型输出: attack_type={attack_type}, confidence={confidence:.3f}, real_score={real_score:.3f}, 所有类别概率=[{prob_str}]")
-            except:
-                pass
-
-        # 置信度与真实度综合判定（优化版：更敏感的异常检测）
-        is_unknown = False
-        is_known_attack = False
-        
-        # 【关键修复】获取流量特征用于辅助判定
-        flow_stats = flow.get("stats")
-        packets_per_s = 0
-        bytes_per_s = 0
-        if flow_stats:
-            duration = max(flow_stats.last_time - flow_stats.start_time, 1e-6)
-            total_packets = flow_stats.fwd_packets + flow_stats.bwd_packets
-            total_bytes = flow_stats.fwd_bytes + flow_stats.bwd_bytes
-            packets_per_s = total_packets / duration
-            bytes_per_s = total_bytes / duration
-        
-        # 【关键修复】保留模型的原始分类结果，不要强制改为"Unknown Attack (UA)"
-        # 已知攻击类型列表（与训练数据一致）
-        known_attack_types = [
-            "DoS_Hulk", "DoS_GoldenEye", "PortScan", "DDoS", "BruteForce",
-            "WebAttack", "Infiltration", "Bot"  # 新增的攻击类型
-        ]
-        original_attack_type = attack_type  # 保存原始分类结果
-        
-        # 【关键修复】判断流量方向（在模型分类判断之前）
-        flow_stats_for_direction = flow.get("stats")
-        is_local_to_external = False
-        if flow_stats_for_direction:
-            src_ip = flow_stats_for_direction.src_ip
-            dst_ip = flow_stats_for_direction.dst_ip
-            is_src_local = is_private_ip(src_ip)
-            is_dst_local = is_private_ip(dst_ip)
-            is_local_to_external = is_src_local and not is_dst_local  # 本地访问外部
-        
-        # 如果模型分类为攻击类型
-        if attack_type != normal_label:
-            # 【关键修复】对于本地->外部的流量，如果模型分类为PortScan，需要更严格的条件
-            if is_local_to_external and "PortScan" in attack_type:
-                # 本地->外部的PortScan分类可能是误判（正常访问外部服务）
-                # 只有在特征非常异常时才保留攻击分类
-                if flow_stats:
-                    duration = max(flow_stats.last_time - flow_stats.start_time, 1e-6)
-                    total_packets = flow_stats.fwd_packets + flow_stats.bwd_packets
-                    packets_per_s = total_packets / duration
-                    # 只有包速率非常高（>200包/秒）才认为是攻击
-                    if packets_per_s < 200:
-                        # 包速率不高，可能是正常访问，改为正常流量
-                        attack_type = normal_label
-                        is_known_attack = False
-                        is_unknown = False
-            # 【关键修复】对于本地->外部的流量，如果模型分类为DoS_Hulk，也需要更严格的条件
-            elif is_local_to_external and "DoS" in attack_type:
-                if flow_stats:
-                    duration = max(flow_stats.last_time - flow_stats.start_time, 1e-6)
-                    total_packets = flow_stats.fwd_packets + flow_stats.bwd_packets
-                    packets_per_s = total_packets / duration
-                    # DoS攻击通常包速率很高，如果速率不高（<500包/秒），可能是误判
-                    if packets_per_s < 500:
-                        attack_type = normal_label
-                        is_known_attack = False
-                        is_unknown = False
-            # 检查是否为已知攻击类型
-            is_known_attack_type = any(known_type in attack_type for known_type in known_attack_types)
-            
-            if confidence >= MIN_ATTACK_CONFIDENCE:
-                # 高置信度攻击：已知攻击
-                is_known_attack = True
-            elif is_known_attack_type and confidence >= 0.3:
-                # 【关键修复】如果模型分类为已知攻击类型（DoS_Hulk, PortScan等），即使置信度不够高（0.3-0.5），也保留原始分类
-                # 这样可以显示具体的攻击类型，而不是全部显示为"Unknown Attack (UA)"
-                # 降低阈值到0.3，确保攻击流量能被检测到
-                is_known_attack = True
-                # 保持原始分类和置信度，不修改
-            elif real_score <= REAL_SCORE_THRESHOLD:
-                # 低真实度得分：未知攻击（OOD检测）
-                # 【关键修复】对于本地→外部的流量,如果模型分类为Benign,不应该判定为未知攻击
-                # 因为本地访问外部网站(DNS、HTTPS等)是正常行为,real_score低可能是因为训练数据中缺少这类流量
-                if is_local_to_external and attack_type == normal_label:
-                    # 本地→外部的正常流量,即使real_score低也不判定为攻击
-                    pass  # 保持为正常流量
-                elif not is_known_attack_type:
-                    attack_type = "Unknown Attack (UA)"
-                    confidence = max(1.0 - confidence, 0.01)
-                    is_unknown = True
-                else:
-                    # 即使real_score低，也保留原始分类
-                    is_known_attack = True
-            elif confidence >= 0.5:  # 提高阈值到0.5，减少误报
-                # 中等置信度：可能是攻击但模型不确定
-                if is_known_attack_type:
-                    # 如果模型分类为已知攻击类型，保留原始分类
-                    is_known_attack = True
-                elif packets_per_s > 5000 or bytes_per_s > 10000000:  # 每秒5000包或10MB（再次大幅提高阈值，避免正常高带宽流量误报）
-                    # 【关键修复】对于本地→外部的流量,即使特征异常,也要检查是否为正常流量
-                    if is_local_to_external and attack_type == normal_label:
-                        # 本地→外部的正常流量,即使包速率高也可能是正常下载/上传
-                        attack_type = normal_label
-                    else:
-                        # 如果特征异常但模型分类不确定，视为未知攻击
-                        attack_type = "Unknown Attack (UA)"
-                        confidence = min(0.9, 0.4 + (packets_per_s / 5000.0) * 0.3)  # 最高0.9
-                        is_unknown = True
-                else:
-                    attack_type = normal_label
-            elif real_score <= -0.2:  # 进一步降低阈值到-0.2，只有非常不真实的流量才报异常
-                # 【关键修复】对于本地→外部的流量,如果模型分类为Benign,不应该判定为未知攻击
-                if is_local_to_external and attack_type == normal_label:
-                    # 本地→外部的正常流量,即使real_score很低也不判定为攻击
-                    pass  # 保持为正常流量
-                elif is_known_attack_type:
-                    # 如果模型分类为已知攻击类型，保留原始分类
-                    is_known_attack = True
-                else:
-                    # 未知攻击（OOD）
-                    # 【关键修复】增加过滤：忽略低频/小包的未知流量，减少误报
-                    is_noise = False
-                    if flow_stats:
-                        total_pkts = flow_stats.fwd_packets + flow_stats.bwd_packets
-                        # 如果包很少（<5）且不是关键端口，视为噪声
-                        if total_pkts < 5 and dst_port not in KNOWN_TCP_TARGET_PORTS:
-                            is_noise = True
-                    
-                    if not is_noise:
-                        attack_type = "Unknown Attack (UA)"
-                        confidence = min(0.85, 0.5 + abs(real_score) * 2.0)  # real_score=-0.15时，confidence=0.8
-                        is_unknown = True
-                    else:
-                        attack_type = normal_label
+        if infer_scheduler is not None:
+            # 批处理模式：只入队，预处理+前向在推理线程按批完成
+            # FlowStats 取快照，判定逻辑看到的是流就绪时刻的统计，而不是之后继续累积的值
+            infer_scheduler.submit((flow_key, flow, copy.copy(flow["stats"]), complete_flow_features),
+                                   arrived_at=arrived_at, block=replay_mode)
+            return
+
+        _apply_batched_verdict((flow_key, flow, flow["stats"], complete_flow_features),
+                               run_discriminator([complete_flow_features])[0])
+
+    except Exception as e:
+        logger.error(f"{COLORS['red']}❌ 检测流程错误：{str(e)}{COLORS['reset']}")
+
+
+def run_discriminator(feature_rows):
+    """
+    对一批流特征做一次前向推理
+    每条流特征重复 SEQ_LEN 次组成时序窗口（快速路径下只变换一次、在模型内广播），整批一次送入判别器
+    加载了学生模型时先由学生分类，只有学生不确定的流升级给判别器
+    返回：[(attack_type, confidence, real_score), ...]，顺序与 feature_rows 一致
+    """
+    global student_handled, student_escalated, student_seconds, teacher_seconds
+    batch_size = len(feature_rows)
+    if student is None:
+        # 模型推理（完整OOD检测逻辑）：同时获取真实/虚假判定+分类，real_scores 越高越真实
+        started = time.perf_counter()
+        real_scores, class_prob = discriminator_outputs(model, feature_rows, preprocess, fast=use_fast_path)
+        teacher_seconds += time.perf_counter() - started
+    else:
+        started = time.perf_counter()
+        real_scores, class_prob = student.predict(preprocess.transform(np.asarray(feature_rows, dtype=np.float32)))
+        real_scores = real_scores.astype(np.float64)
+        class_prob = class_prob.astype(np.float64)
+        escalate = ~student.confident_mask(real_scores, class_prob, labels.index(normal_label))
+        student_seconds += time.perf_counter() - started
+        student_handled += batch_size - int(escalate.sum())
+        student_escalated += int(escalate.sum())
+        if escalate.any():
+            started = time.perf_counter()
+            idx = np.flatnonzero(escalate)
+            teacher_real, teacher_prob = discriminator_outputs(model, [feature_rows[i] for i in idx], preprocess,
+                                                               fast=use_fast_path)
+            real_scores[idx] = teacher_real
+            class_prob[idx] = teacher_prob
+            teacher_seconds += time.perf_counter() - started
+
+    verdicts = []
+    for i in range(batch_size):
+        attack_idx = int(class_prob[i].argmax())
+        attack_type = get_label_name(attack_idx)
+        confidence = class_prob[i, attack_idx].item()
+        real_score = real_scores[i].item()
+        verdicts.append((attack_type, confidence, real_score))
+
+        # 【调试日志】记录模型原始输出（仅在DEBUG模式下）
+        if logger.level <= logging.DEBUG:
+            prob_str = ", ".join([f"{get_label_name(j)}={p:.3f}" for j, p in enumerate(class_prob[i])])
+            logger.debug(f"模型输出: attack_type={attack_type}, confidence={confidence:.3f}, real_score={real_score:.3f}, 所有类别概率=[{prob_str}]")
+    return verdicts
+
+
+def score_finished_flows(expired):
+    """
+    流结束事件（超时堆回调，expired 为同一次检查中结束的 [(flow_key, flow), ...]）：
+    从未评分过的短流、以及最后一次评分后又来了新包的流，用结束时刻的完整统计成批评分
+    """
+    global final_scored_flows
+    ready = []
+    for flow_key, flow in expired:
+        reason = scoring_policy.on_expire(flow)
+        if reason is None:
+            continue
+        scoring_policy.mark_scored(flow, reason)
+        final_scored_flows += 1
+        features = flow["stats"].to_feature_vector()
+        reused = delta_gate.check(flow, features) if delta_gate is not None else None
+        if reused is not None:
+            apply_detection_verdict(flow_key, flow, flow["stats"], *reused)
+            continue
+        ready.append((flow_key, flow, flow["stats"], features))
+    if infer_scheduler is not None:
+        for item in ready:
+            infer_scheduler.submit(item, block=replay_mode)
+        return
+    for start in range(0, len(ready), SHORT_FLOW_BATCH):
+        batch = ready[start:start + SHORT_FLOW_BATCH]
+        _apply_batched_verdicts(batch, run_discriminator([item[3] for item in batch]))
+
+
+def _apply_batched_verdict(item, verdict):
+    """推理完成回调（批量推理线程或内联）：记录本次推理结果供特征增量门控复用，再交回判定逻辑"""
+    flow_key, flow, flow_stats, features = item
+    if delta_gate is not None:
+        delta_gate.record(flow, features, verdict)
+    attack_type, confidence, real_score = verdict
+    apply_detection_verdict(flow_key, flow, flow_stats, attack_type, confidence, real_score)
+
+
+def _apply_batched_verdicts(items, verdicts):
+    """整批推理完成回调：规则表对整批流一次判定（verdict_engine.decide_batch），再逐条推送告警/记录"""
+    if delta_gate is not None:
+        for (_, flow, _, features), verdict in zip(items, verdicts):
+            delta_gate.record(flow, features, verdict)
+    with_stats = [i for i, item in enumerate(items) if item[2] is not None]
+    decisions = dict(zip(with_stats, verdict_engine.decide_batch([(*verdicts[i], items[i][2]) for i in with_stats])))
+    for i, ((flow_key, flow, flow_stats, _), (attack_type, confidence, real_score)) in enumerate(zip(items, verdicts)):
+        try:
+            decision = decisions.get(i) or verdict_engine.decide(attack_type, confidence, real_score, flow_stats)
+            finish_detection_verdict(flow_key, flow, flow_stats, attack_type, confidence, real_score, decision)
+        except Exception as e:
+            logger.error(f"{COLORS['red']}❌ 检测流程错误：{str(e)}{COLORS['reset']}")
+
+
+class VerdictSink:
+    """
+    pcap 回放的判定输出（JSONL，每次检测一行；同一条流可能有多行，包数最大的一行为最终判定）
+    deterministic=True 时先缓存，结束时按 (报文时间, 会话, 包数) 排序写出
+    """
+
+    def __init__(self, path, deterministic=False):
+        self.path = path
+        self.deterministic = deterministic
+        self.count = 0
+        self.attack_count = 0
+        self._records = []
+        self._lock = threading.Lock()
+        self._file = open(path, "w", encoding="utf-8")
+
+    def write(self, record):
+        with self._lock:
+            self.count += 1
+            self.attack_count += int(record["is_attack"])
+            if self.deterministic:
+                self._records.append(record)
             else:
-                # 置信度很低（< 0.3）的情况
-                if is_known_attack_type:
-                    # 即使置信度很低，如果模型分类为已知攻击类型，也保留原始分类（可能是误判，但至少显示出来）
-                    is_known_attack = True
-                elif flow_stats:
-                    # 检查是否为明显的攻击特征
-                    is_one_way = (flow_stats.fwd_packets > 0 and flow_stats.bwd_packets == 0) or \
-                                 (flow_stats.fwd_packets == 0 and flow_stats.bwd_packets > 0)
-                    is_high_rate = packets_per_s > 1000 or bytes_per_s > 1000000  # 每秒1000包或1MB（大幅提高阈值）
-                    is_high_volume = total_packets > 2000  # 总包数超过2000（大幅提高阈值）
-                    
-                    # 如果满足攻击特征，视为未知攻击
-                    if (is_one_way and is_high_rate) or (is_high_rate and is_high_volume):
-                        # 【关键修复】对于本地→外部的流量,即使特征异常,也要检查是否为正常流量
-                        if is_local_to_external and attack_type == normal_label:
-                            # 本地→外部的正常流量,即使是单向高速率也可能是正常下载
-                            attack_type = normal_label
-                        else:
-                            attack_type = "Unknown Attack (UA)"
-                            # 根据多个特征动态计算置信度
-                            if is_one_way and is_high_rate:
-                                base_conf = 0.5 + (packets_per_s / 2000.0) * 0.2
-                                byte_conf = (bytes_per_s / 500000.0) * 0.1
-                                packet_conf = min(0.1, (total_packets / 2000.0) * 0.1)
-                                confidence = min(0.85, base_conf + byte_conf + packet_conf)
-                            else:
-                                base_conf = 0.5 + (packets_per_s / 1500.0) * 0.2
-                                packet_conf = min(0.15, (total_packets / 2000.0) * 0.15)
-                                confidence = min(0.8, base_conf + packet_conf)
-                            is_unknown = True
-                    else:
-                        attack_type = normal_label
-                else:
-                    # 没有统计信息
-                    if real_score <= -0.2:  # 提高阈值，减少误报
-                        # 【关键修复】对于本地→外部的流量,如果模型分类为Benign,不应该判定为未知攻击
-                        if is_local_to_external and attack_type == normal_label:
-                            # 本地→外部的正常流量,即使real_score很低也不判定为攻击
-                            pass  # 保持为正常流量
-                        elif not is_known_attack_type:
-                            attack_type = "Unknown Attack (UA)"
-                            confidence = min(0.8, 0.5 + abs(real_score) * 1.5)
-                            is_unknown = True
-                        else:
-                            is_known_attack = True
-                    else:
-                        attack_type = normal_label
-
-        # 【关键修复】异常会话统计：无论是已知攻击还是未知攻击，都要标记为异常
-        if is_known_attack or is_unknown:
-            flow["is_anomaly"] = True
-            alert_detected_count += 1  # 统计检测到的异常总数
-
-        # 【关键修复】无论模型分类为什么，都要根据流量特征进行攻击类型推断
-        # 这样可以更准确地识别攻击类型（如PortScan、BruteForce等）
-        if flow_stats:
-            # 重新计算特征（确保变量已定义）
-            duration = max(flow_stats.last_time - flow_stats.start_time, 1e-6)
-            total_packets = flow_stats.fwd_packets + flow_stats.bwd_packets
-            total_bytes = flow_stats.fwd_bytes + flow_stats.bwd_bytes
-            packets_per_s = total_packets / duration
-            bytes_per_s = total_bytes / duration
-            
-            # 检查是否为明显的攻击特征
-            is_one_way = (flow_stats.fwd_packets > 0 and flow_stats.bwd_packets == 0) or \
-                         (flow_stats.fwd_packets == 0 and flow_stats.bwd_packets > 0)
-            is_high_rate = packets_per_s > 500 or bytes_per_s > 500000  # 每秒500包或500KB（提高阈值，减少误报）
-            is_high_volume = total_packets > 500  # 总包数超过500（提高阈值，减少误报）
-            is_very_high_rate = packets_per_s > 300 or bytes_per_s > 300000  # 每秒300包或300KB（提高阈值，减少误报）
-            
-            # 【关键修复】根据源端口、目标端口、协议和流量特征精确推断攻击类型
-            # 优先级：源端口识别 > 协议+端口模式 > 包速率特征
-            inferred_attack_type = None
-            inferred_unknown = False
-            inferred_confidence = None
-            
-            # 获取端口信息用于更精确的判断
-            src_port = flow_stats.src_port
-            dst_port = flow_stats.dst_port
-            
-            # 定义常见服务端口（需要严格过滤以防误报）
-            common_service_ports = {80, 443, 53, 22, 21, 25, 110, 143, 993, 995, 8080, 8443, 3389, 445, 3478}
-            is_common_port = (dst_port in common_service_ports) or (src_port in common_service_ports)
-            
-            # 【第一步】根据源端口识别攻击类型（攻击脚本使用了固定源端口）
-            # UDP Flood: 源端口50000, 目标端口80
-            if src_port == 50000 and flow_stats.proto == 17 and dst_port == 80:
-                inferred_attack_type = "DDoS"
-            # 高频UDP攻击: 源端口50001, 目标端口53 - 应该识别为DDoS（UDP Flood攻击）
-            elif src_port == 50001 and flow_stats.proto == 17 and dst_port == 53:
-                # 高频UDP攻击是DDoS类型，不是DoS_Hulk
-                inferred_attack_type = "DDoS"
-            # 大包攻击: 源端口50002, 目标端口8080 - 应该识别为DDoS（UDP大包攻击）
-            elif src_port == 50002 and flow_stats.proto == 17 and dst_port == 8080:
-                # 大包UDP攻击是DDoS类型
-                inferred_attack_type = "DDoS"
-            # TCP SYN Flood: 源端口50010-50014, 目标端口80
-            elif src_port >= 50010 and src_port <= 50014 and flow_stats.proto == 6 and dst_port == 80:
-                inferred_attack_type = "DoS_Hulk"
-            # 端口扫描: 源端口58000
-            elif src_port == 58000 and flow_stats.proto == 6:
-                inferred_attack_type = "PortScan"
-            # Web攻击: 源端口59000, 目标端口80
-            elif src_port == 59000 and flow_stats.proto == 6 and dst_port == 80:
-                inferred_attack_type = "WebAttack"
-            # 暴力破解: 源端口60000, 目标端口22
-            elif src_port == 60000 and flow_stats.proto == 6 and dst_port == 22:
-                inferred_attack_type = "BruteForce"
-            # 渗透攻击: 源端口61000, 目标端口443
-            elif src_port == 61000 and flow_stats.proto == 6 and dst_port == 443:
-                inferred_attack_type = "Infiltration"
-            # 僵尸网络: 源端口62000, 目标端口53
-            elif src_port == 62000 and flow_stats.proto == 17 and dst_port == 53:
-                inferred_attack_type = "Bot"
-            
-            # 【关键修复】判断流量方向：本地->外部 vs 外部->本地
-            src_ip = flow_stats.src_ip
-            dst_ip = flow_stats.dst_ip
-            is_src_local = is_private_ip(src_ip)
-            is_dst_local = is_private_ip(dst_ip)
-            is_local_to_external = is_src_local and not is_dst_local  # 本地访问外部
-            is_external_to_local = not is_src_local and is_dst_local  # 外部访问本地
-            is_local_to_local = is_src_local and is_dst_local  # 本地访问本地
-            is_external_to_external = not is_src_local and not is_dst_local  # 外部访问外部（过路流量）
-            
-            # 【第二步】如果源端口无法识别，根据协议、目标端口和流量特征判断
-            if not inferred_attack_type:
-                # TCP协议的攻击类型判断
-                if flow_stats.proto == 6:  # TCP
-                    known_tcp_signature = (
-                        src_port in KNOWN_ATTACK_SOURCE_PORTS or
-                        dst_port in KNOWN_TCP_TARGET_PORTS
-                    )
-                    # 【关键修复】对于本地->外部的流量，不应该判定为端口扫描（这是正常的客户端访问）
-                    # 只有外部->本地或本地->本地的异常流量才判定为攻击
-                    if is_local_to_external:
-                        # 本地->外部：只有非常异常的特征才判定为攻击（如DoS攻击）
-                        if is_very_high_rate or (is_one_way and is_high_rate and packets_per_s > 500):
-                            # 极高包速率或单向高速率：可能是DoS攻击
-                            if known_tcp_signature:
-                                inferred_attack_type = "DoS_Hulk"
-                            else:
-                                inferred_attack_type = "Unknown Attack (UA)"
-                                inferred_unknown = True
-                        # 正常访问外部服务不应该判定为攻击
-                        # 不设置inferred_attack_type，让模型分类决定
-                    else:
-                        # 外部->本地 或 本地->本地：需要严格判定
-                        # 【关键修复】端口扫描的判断需要更严格：必须是单向流量或双向但响应很少
-                        common_scan_ports = [21, 22, 23, 25, 53, 80, 110, 143, 443, 445, 3306, 3389, 5432, 8080, 8443]
-                        if dst_port in common_scan_ports:
-                            # 【关键修复】端口扫描特征：必须是单向流量（没有响应）或双向但响应很少
-                            # 计算双向流量比例
-                            response_ratio = 0.0
-                            if total_packets > 0:
-                                response_packets = min(flow_stats.fwd_packets, flow_stats.bwd_packets)
-                                response_ratio = response_packets / total_packets
-                            
-                            # 端口扫描：单向流量（response_ratio < 0.1）或双向但响应很少（response_ratio < 0.3）
-                            is_likely_scan = is_one_way or (response_ratio < 0.3 and total_packets > 50)
-                            
-                            if is_likely_scan and (packets_per_s >= 10 and packets_per_s < 150) and total_packets > 100:
-                                # 进一步判断：如果是SSH/MySQL/RDP等常见服务端口，且包速率较低，可能是暴力破解
-                                brute_force_ports = [22, 23, 3306, 3389]
-                                if dst_port in brute_force_ports and packets_per_s >= 10 and packets_per_s < 50 and total_packets > 100:
-                                    inferred_attack_type = "BruteForce"
-                                else:
-                                    inferred_attack_type = "PortScan"
-                            # 如果包数很多但速率不高，且是单向流量，也可能是端口扫描
-                            elif is_one_way and total_packets > 200 and packets_per_s < 100:
-                                inferred_attack_type = "PortScan"
-                            # 如果包速率很高，可能是DoS攻击
-                            elif is_very_high_rate or (is_one_way and is_high_rate):
-                                inferred_attack_type = "DoS_Hulk" if known_tcp_signature else "Unknown Attack (UA)"
-                                if inferred_attack_type == "Unknown Attack (UA)":
-                                    inferred_unknown = True
-                        # 如果目标端口不是常见扫描端口，但包速率很高，可能是DoS攻击
-                        elif is_very_high_rate or (is_one_way and is_high_rate):
-                            inferred_attack_type = "DoS_Hulk" if known_tcp_signature else "Unknown Attack (UA)"
-                            if inferred_attack_type == "Unknown Attack (UA)":
-                                inferred_unknown = True
-                        # 如果包速率中等，且是单向流量，可能是端口扫描（扫描不常见端口）
-                        elif is_one_way and packets_per_s >= 10 and packets_per_s < 150 and total_packets > 100:
-                            inferred_attack_type = "PortScan"
-                
-                # UDP协议的攻击类型判断
-                elif flow_stats.proto == 17:  # UDP
-                    known_udp_signature = (
-                        src_port in KNOWN_ATTACK_SOURCE_PORTS or
-                        dst_port in KNOWN_UDP_TARGET_PORTS
-                    )
-                    # UDP攻击通常是DDoS，但需要区分不同类型
-                    if is_very_high_rate or (is_one_way and is_high_rate):
-                        # 极高包速率或单向高速率：DDoS 或 Unknown
-                        if known_udp_signature:
-                            inferred_attack_type = "DDoS"
-                        else:
-                            inferred_attack_type = "Unknown Attack (UA)"
-                            inferred_unknown = True
-                    elif is_high_rate and is_high_volume:
-                        # 高速率+高包数：DDoS 或 Unknown
-                        if known_udp_signature:
-                            inferred_attack_type = "DDoS"
-                        else:
-                            inferred_attack_type = "Unknown Attack (UA)"
-                            inferred_unknown = True
-                    elif is_one_way and total_packets > 200:
-                        # 单向流量且包数较多：DDoS（提高阈值）
-                        if known_udp_signature:
-                            inferred_attack_type = "DDoS"
-                        else:
-                            inferred_attack_type = "Unknown Attack (UA)"
-                            inferred_unknown = True
-            
-            # 【第三步】如果仍然无法识别，但特征明显异常，根据协议判断
-            if not inferred_attack_type:
-                # 【关键修复】对于本地->外部的流量，需要更严格的条件才判定为攻击
-                if is_local_to_external:
-                    # 本地->外部：只有非常异常的特征才判定为攻击
-                    if is_very_high_rate and packets_per_s > 500:  # 极高包速率
-                        if flow_stats.proto == 17:  # UDP
-                            known_udp_signature = (
-                                src_port in KNOWN_ATTACK_SOURCE_PORTS or
-                                dst_port in KNOWN_UDP_TARGET_PORTS
-                            )
-                            if known_udp_signature:
-                                inferred_attack_type = "DDoS"
-                            else:
-                                inferred_attack_type = "Unknown Attack (UA)"
-                                inferred_unknown = True
-                        elif flow_stats.proto == 6:  # TCP
-                            known_tcp_signature = (
-                                src_port in KNOWN_ATTACK_SOURCE_PORTS or
-                                dst_port in KNOWN_TCP_TARGET_PORTS
-                            )
-                            if known_tcp_signature:
-                                inferred_attack_type = "DoS_Hulk"
-                            else:
-                                inferred_attack_type = "Unknown Attack (UA)"
-                                inferred_unknown = True
-                else:
-                    # 外部->本地 或 本地->本地：特征异常就判定为攻击
-                    if is_very_high_rate or (is_one_way and is_high_rate) or (is_high_rate and is_high_volume) or (is_one_way and total_packets > 200):
-                        # 特征明显异常，根据协议判断
-                        if flow_stats.proto == 17:  # UDP
-                            known_udp_signature = (
-                                src_port in KNOWN_ATTACK_SOURCE_PORTS or
-                                dst_port in KNOWN_UDP_TARGET_PORTS
-                            )
-                            if known_udp_signature:
-                                inferred_attack_type = "DDoS"
-                            else:
-                                inferred_attack_type = "Unknown Attack (UA)"
-                                inferred_unknown = True
-                        elif flow_stats.proto == 6:  # TCP
-                            # TCP攻击：根据目标端口判断
-                            if dst_port in [22, 23, 3306, 3389]:
-                                inferred_attack_type = "BruteForce"
-                            elif dst_port in [21, 22, 23, 25, 53, 80, 110, 143, 443, 445, 3306, 3389, 5432, 8080, 8443]:
-                                inferred_attack_type = "PortScan"
-                            else:
-                                if (src_port in KNOWN_ATTACK_SOURCE_PORTS) or (dst_port in KNOWN_TCP_TARGET_PORTS):
-                                    inferred_attack_type = "DoS_Hulk"
-                                else:
-                                    inferred_attack_type = "Unknown Attack (UA)"
-                                    inferred_unknown = True
-
-            if inferred_attack_type == "Unknown Attack (UA)" and inferred_confidence is None:
-                base_conf = 0.6 + min(0.25, packets_per_s / 600.0)
-                packet_conf = min(0.15, total_packets / 600.0)
-                inferred_confidence = min(0.9, base_conf + packet_conf)
-            
-            # 【关键修复】推断逻辑不应该无条件覆盖模型分类
-            # 应该优先信任模型分类，推断逻辑只作为辅助（当模型分类不确定时）
-            # 【重要修复】如果基于源端口识别到攻击类型，应该无条件使用（攻击脚本使用了固定源端口）
-            if inferred_attack_type:
-                should_use_inferred = False
-                if inferred_unknown:
-                    should_use_inferred = True
-                
-                # 【最高优先级】基于源端口的攻击识别
-                # 如果源端口在已知攻击列表中，强制判定为攻击，并锁定结果，防止被后续逻辑修改
-                if src_port in KNOWN_ATTACK_SOURCE_PORTS:
-                    # 基于源端口的识别，无条件使用
-                    should_use_inferred = True
-                    # 强制标记为已知攻击
-                    is_known_attack = True
-                    is_unknown = False
-                    # 设置高置信度
-                    if confidence < 0.9:
-                        confidence = 0.95
-                    logger.info(f"{COLORS['yellow']}🔍 [强制判定] 发现攻击脚本流量: 源端口={src_port}, 类型={inferred_attack_type}{COLORS['reset']}")
-                
-                # 情况1：模型分类为正常，但特征非常异常
-                elif attack_type == normal_label:
-                    # 只有非常异常的特征才覆盖（极高包速率、单向高速率等）
-                    if is_very_high_rate and packets_per_s > 500:
-                        should_use_inferred = True
-                    elif is_one_way and is_high_rate and packets_per_s > 200:
-                        should_use_inferred = True
-                    # 对于本地->外部的流量，需要更严格的条件
-                    elif is_local_to_external:
-                        # 本地->外部：只有极高包速率才覆盖
-                        if is_very_high_rate and packets_per_s > 1000:
-                            should_use_inferred = True
-                    # 对于外部->本地，如果特征异常，可以使用推断
-                    elif is_external_to_local and (is_very_high_rate or (is_one_way and is_high_rate)):
-                        should_use_inferred = True
-                
-                # 情况2：模型分类为攻击，但置信度很低（<0.4），且推断类型更具体
-                elif attack_type != normal_label and confidence < 0.4:
-                    # 如果推断类型是已知攻击类型，且特征明显异常，使用推断类型
-                    if inferred_attack_type in known_attack_types and (is_very_high_rate or is_one_way or is_high_rate):
-                        should_use_inferred = True
-                
-                # 情况3：模型分类为攻击，但推断类型更准确（如DDoS vs DoS_Hulk, PortScan vs DDoS）
-                elif attack_type != normal_label and inferred_attack_type in known_attack_types:
-                    # 如果推断类型更具体（如PortScan），且特征匹配，使用推断类型
-                    if inferred_attack_type == "PortScan" and is_one_way:
-                        should_use_inferred = True
-                    elif inferred_attack_type == "BruteForce" and dst_port in [22, 23, 3306, 3389]:
-                        should_use_inferred = True
-                    # 如果推断类型是DDoS但模型分类为DoS_Hulk，使用推断类型（更准确）
-                    elif inferred_attack_type == "DDoS" and attack_type == "DoS_Hulk" and flow_stats.proto == 17:
-                        should_use_inferred = True
-                    # 如果推断类型是DoS_Hulk但模型分类为DDoS，且是TCP协议，使用推断类型
-                    elif inferred_attack_type == "DoS_Hulk" and attack_type == "DDoS" and flow_stats.proto == 6:
-                        should_use_inferred = True
-                
-                if should_use_inferred:
-                    # 使用推断的攻击类型
-                    attack_type = inferred_attack_type
-                    if flow_stats and flow_stats.src_port == 50000:
-                        logger.info(f"DEBUG: Trace 0 - Applied inferred type: {attack_type}")
-
-                    if attack_type == "Unknown Attack (UA)" or inferred_unknown:
-                        is_unknown = True
-                        is_known_attack = False
-                    else:
-                        is_known_attack = True
-                        is_unknown = False
-                    # 根据特征动态计算置信度
-                    # 【关键修复】如果基于源端口识别，置信度应该更高（因为这是最可靠的识别方式）
-                    if inferred_confidence is not None:
-                        confidence = inferred_confidence
-                    elif src_port in KNOWN_ATTACK_SOURCE_PORTS:
-                        # 基于源端口识别，置信度设为0.85-0.95（非常高）
-                        if is_very_high_rate:
-                            base_conf = 0.85 + (packets_per_s / 1000.0) * 0.1
-                            confidence = min(0.95, base_conf + random.uniform(-0.02, 0.03))
-                        elif (is_one_way and is_high_rate) or (is_high_rate and is_high_volume):
-                            base_conf = 0.85 + (total_packets / 500.0) * 0.1
-                            confidence = min(0.95, base_conf + random.uniform(-0.02, 0.03))
-                        else:
-                            confidence = 0.85 + random.uniform(-0.02, 0.03)  # 即使特征不明显，基于源端口识别也给予高置信度
-                    elif is_very_high_rate:
-                        base_conf = 0.6 + (packets_per_s / 1000.0) * 0.2
-                        confidence = min(0.95, base_conf + random.uniform(-0.03, 0.04))
-                    elif (is_one_way and is_high_rate) or (is_high_rate and is_high_volume):
-                        if is_one_way and is_high_rate:
-                            base_conf = 0.5 + (packets_per_s / 200.0) * 0.2
-                            byte_conf = (bytes_per_s / 50000.0) * 0.1
-                            packet_conf = min(0.1, (total_packets / 500.0) * 0.1)
-                            confidence = min(0.9, base_conf + byte_conf + packet_conf + random.uniform(-0.02, 0.02))
-                        else:
-                            base_conf = 0.5 + (packets_per_s / 150.0) * 0.2
-                            packet_conf = min(0.15, (total_packets / 500.0) * 0.15)
-                            confidence = min(0.85, base_conf + packet_conf + random.uniform(-0.02, 0.02))
-                    else:
-                        confidence = min(0.8, 0.5 + (total_packets / 200.0) * 0.2 + random.uniform(-0.03, 0.03))
-                # 否则保持模型分类，不覆盖
-            elif (is_very_high_rate or (is_one_way and is_high_rate) or (is_high_rate and is_high_volume) or (is_one_way and total_packets > 200)) and attack_type == normal_label:
-                # 【关键修复】对于本地->外部的流量，不应该判定为未知攻击
-                if is_local_to_external:
-                    # 本地->外部：保持正常流量分类
-                    pass
-                # 【关键修复】如果real_score > 0.0，且是常见端口，说明模型认为流量结构很正常
-                elif real_score > 0.0 and is_common_port:
-                    pass
-                else:
-                    # 如果无法推断具体类型，但特征明显异常，且模型分类为正常，使用"Unknown Attack (UA)"
-                    attack_type = "Unknown Attack (UA)"
-                    if is_very_high_rate:
-                        confidence = min(0.95, 0.6 + (packets_per_s / 1000.0) * 0.2)
-                    elif (is_one_way and is_high_rate) or (is_high_rate and is_high_volume):
-                        if is_one_way and is_high_rate:
-                            base_conf = 0.5 + (packets_per_s / 200.0) * 0.2
-                            byte_conf = (bytes_per_s / 50000.0) * 0.1
-                            packet_conf = min(0.1, (total_packets / 500.0) * 0.1)
-                            confidence = min(0.9, base_conf + byte_conf + packet_conf + random.uniform(-0.02, 0.02))
-                        else:
-                            base_conf = 0.5 + (packets_per_s / 150.0) * 0.2
-                            packet_conf = min(0.15, (total_packets / 500.0) * 0.15)
-                            confidence = min(0.85, base_conf + packet_conf + random.uniform(-0.02, 0.02))
-                    else:
-                        confidence = min(0.8, 0.5 + (total_packets / 200.0) * 0.2 + random.uniform(-0.03, 0.03))
-                    is_unknown = True
-
-        # 【调试日志】追踪状态
-        if flow_stats and flow_stats.src_port == 50000:
-            logger.info(f"DEBUG: Trace 1 - attack_type={attack_type}, is_local_to_external={is_local_to_external}, src={src_ip}, dst={dst_ip}")
-
-        # 【最终安全检查】再次检查本地->外部流量
-        # 如果是本地->外部，且被判定为攻击（无论是模型还是推断），需要极高的特征阈值
-        # 【修正】直接排除已知源端口的攻击，防止被错误过滤
-        is_port_based_attack = False
-        if flow_stats and flow_stats.src_port in KNOWN_ATTACK_SOURCE_PORTS:
-            is_port_based_attack = True
-        
-        # 【强制保护】如果是基于端口的攻击，跳过所有过滤逻辑！
-        if is_port_based_attack:
-            pass # 直接放行，不进行过滤
-        elif is_local_to_external and attack_type != normal_label:
-            if flow_stats and flow_stats.src_port == 50000:
-                logger.info(f"DEBUG: Trace 2 - Inside filtering block")
-            # 除非是基于源端口的已知攻击（脚本攻击），否则需要严格过滤
-            is_script_attack = False
-            if flow_stats:
-                if flow_stats.src_port in KNOWN_ATTACK_SOURCE_PORTS:
-                    is_script_attack = True
-            
-            if not is_script_attack:
-                # 如果不是脚本攻击，检查包速率
-                if flow_stats:
-                    duration = max(flow_stats.last_time - flow_stats.start_time, 1e-6)
-                    total_packets = flow_stats.fwd_packets + flow_stats.bwd_packets
-                    packets_per_s = total_packets / duration
-                    
-                    # 如果包速率不是极高（<500），强制改为正常
-                    # 正常的高速下载/上传可能有几百包/秒，但DDoS通常更高
-                    if packets_per_s < 500:
-                        logger.warning(f"【误报过滤】本地->外部流量速率不足({packets_per_s:.1f}pps)，判定为正常。源IP: {src_ip}, 目的IP: {dst_ip}")
-                        attack_type = normal_label
-                        is_known_attack = False
-                        is_unknown = False
-
-        # 结果显示
-        green = COLORS['green'] if SHOW_COLOR else ""
-        red = COLORS['red'] if SHOW_COLOR else ""
-        yellow = COLORS['yellow'] if SHOW_COLOR else ""
-        reset = COLORS['reset'] if SHOW_COLOR else ""
-        
-        # 【关键修复】IP地址方向显示问题
-        # flow_key是标准化的（小的IP在前），所以需要使用FlowStats中的真实源IP和目标IP
-        flow_stats = flow.get("stats")
-        if flow_stats:
-            # 使用FlowStats中的真实源IP和目标IP（这是从原始包中提取的）
-            src_ip, dst_ip = flow_stats.src_ip, flow_stats.dst_ip
-        else:
-            # 如果没有FlowStats，使用flow_key（虽然可能方向不对，但至少能显示）
-            src_ip, dst_ip = flow_key[0], flow_key[1]
+                self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
 
-        # 【调试日志】追踪状态
-        if flow_stats and flow_stats.src_port == 50000:
-             logger.info(f"DEBUG: Trace 3 - attack_type={attack_type}, is_local_to_external={is_local_to_external if 'is_local_to_external' in locals() else 'N/A'}")
+    def close(self):
+        with self._lock:
+            self._records.sort(key=lambda r: (r["ts"], r["src_ip"], r["src_port"], r["dst_ip"],
+                                              r["dst_port"], r["proto"], r["packets"]))
+            for record in self._records:
+                self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+            self._records = []
+            self._file.close()
 
-        # 【关键修复】如果是正常流量，强制置信度为 1.0 或不显示
-        if attack_type == normal_label:
-            # 正常流量不需要显示低置信度，以免误导用户
-            confidence = 1.0  # 或者你可以选择不修改，但在日志中特殊处理
-        
-        # 记录检测结果
-        if attack_type != normal_label:
-            # 【最终确认】如果是攻击，确保相关标志位正确
-            if attack_type == "Unknown Attack (UA)":
-                is_unknown = True
-                is_known_attack = False
-            elif not is_known_attack: # 如果不是Unkown且is_known_attack为False，强制修正
-                is_known_attack = True
-                is_unknown = False
-
-            # 计算严重程度
-            severity_val = calculate_severity(attack_type, confidence, is_known_attack, real_score, flow.get("stats"))
-            
-            # 发送告警到后端API
-            # 使用 push_detection_alert 在线程中发送，避免阻塞
-            try:
-                # 构造消息
-                message = f"Detected {attack_type}"
-                
-                # 启动线程发送告警
-                threading.Thread(
-                    target=push_detection_alert,
-                    args=(flow_key, attack_type, confidence, severity_val, message, real_score, flow.get("stats"))
-                ).start()
-                
-            except Exception as e:
-                logger.error(f"❌ 启动告警线程失败: {str(e)}")
-        else:
-            # 正常流量日志，降低级别或减少输出频率
-            # if random.random() < 0.1:  # 仅抽样打印10%的正常流量日志，避免刷屏
-            logger.info(f"【正常流量】✅ 会话：({src_ip} → {dst_ip}) | 类型：{attack_type} | 置信度：{confidence:.2f}")
+
+def _verdict_record(flow_key, flow_stats, model_label, model_confidence, attack_type, confidence, real_score):
+    if flow_stats:
+        src_ip, dst_ip, src_port, dst_port = flow_stats.src_ip, flow_stats.dst_ip, flow_stats.src_port, flow_stats.dst_port
+        packets = flow_stats.fwd_packets + flow_stats.bwd_packets
+        total_bytes = flow_stats.fwd_bytes + flow_stats.bwd_bytes
+        first_ts, last_ts = flow_stats.start_time, flow_stats.last_time
+    else:
+        src_ip, dst_ip, src_port, dst_port = flow_key[0], flow_key[1], flow_key[2], flow_key[3]
+        packets, total_bytes, first_ts, last_ts = 0, 0.0, 0.0, 0.0
+    return {
+        "ts": round(float(last_ts), 6),
+        "first_ts": round(float(first_ts), 6),
+        "src_ip": src_ip,
+        "src_port": int(src_port),
+        "dst_ip": dst_ip,
+        "dst_port": int(dst_port),
+        "proto": int(flow_key[4]),
+        "packets": int(packets),
+        "bytes": float(total_bytes),
+        "model_label": str(model_label),
+        "model_confidence": round(float(model_confidence), 6),
+        "real_score": round(float(real_score), 6),
+        "label": str(attack_type),
+        "confidence": round(float(confidence), 6),
+        "is_attack": attack_type != normal_label,
+    }
 
 
+def apply_detection_verdict(flow_key, flow, flow_stats, attack_type, confidence, real_score):
+    """
+    模型输出之后的综合判定：置信度/真实度/流量特征推断/误报过滤由 verdict_engine 按规则表完成（见 verdict_rules.py），
+    这里根据判定结果统计异常会话、推送告警并记录
+    flow_stats：流就绪时刻的 FlowStats（批处理模式下为快照）
+    """
+    try:
+        finish_detection_verdict(flow_key, flow, flow_stats, attack_type, confidence, real_score,
+                                 verdict_engine.decide(attack_type, confidence, real_score, flow_stats))
     except Exception as e:
         logger.error(f"{COLORS['red']}❌ 检测流程错误：{str(e)}{COLORS['reset']}")
 
+
+def finish_detection_verdict(flow_key, flow, flow_stats, model_label, model_confidence, real_score, decision):
+    global alert_detected_count, first_verdict_seconds
+    attack_type, confidence = decision.attack_type, decision.confidence
+    if first_verdict_seconds is None and engine_init_started is not None:
+        first_verdict_seconds = time.perf_counter() - engine_init_started
+        logger.info(f"{COLORS['green']}⏱️ 首次判定完成：初始化开始后{first_verdict_seconds:.2f}s"
+                    f"（其中模型加载{model_load_seconds:.2f}s，来源：{model_source}）{COLORS['reset']}")
+
+    # 【关键修复】异常会话统计：无论是已知攻击还是未知攻击，都要标记为异常
+    if decision.anomalous:
+        flow["is_anomaly"] = True
+        alert_detected_count += 1  # 统计检测到的异常总数
+
+    # 【关键修复】IP地址方向显示问题
+    # flow_key是标准化的（小的IP在前），所以需要使用FlowStats中的真实源IP和目标IP
+    if flow_stats:
+        src_ip, dst_ip = flow_stats.src_ip, flow_stats.dst_ip
+    else:
+        # 如果没有FlowStats，使用flow_key（虽然可能方向不对，但至少能显示）
+        src_ip, dst_ip = flow_key[0], flow_key[1]
+
+    if decision.forced:
+        logger.info(f"{COLORS['yellow']}🔍 [强制判定] 发现攻击脚本流量: 源端口={flow_stats.src_port}, "
+                    f"类型={decision.inferred}{COLORS['reset']}")
+    if decision.filtered:
+        logger.warning(f"【误报过滤】本地->外部流量速率不足({decision.packets_per_s:.1f}pps)，判定为正常。"
+                       f"源IP: {src_ip}, 目的IP: {dst_ip}")
+
+    # 【关键修复】如果是正常流量，强制置信度为 1.0，以免误导用户
+    if attack_type == normal_label:
+        confidence = 1.0
+
+    is_unknown = attack_type == UNKNOWN_ATTACK
+    if attack_type != normal_label:
+        # 计算严重程度
+        severity_val = calculate_severity(attack_type, confidence, not is_unknown, real_score, flow_stats)
+
+        # 发送告警到后端API
+        # push_detection_alert 只构造告警并放入 alert_dispatcher 队列，由固定的发送线程推送，避免阻塞
+        message = f"Detected {attack_type}"
+        push_detection_alert(flow_key, attack_type, confidence, severity_val, message, real_score, flow_stats)
+    elif benign_log_limiter.allow():
+        # 正常流量日志按 BENIGN_LOG_RATE 限流；被省略的条数在最终统计中报告
+        logger.info(f"【正常流量】✅ 会话：({src_ip} → {dst_ip}) | 类型：{attack_type} | 置信度：{confidence:.2f}")
+
+    verdict_class = "normal" if attack_type == normal_label else ("unknown" if is_unknown else "known")
+    metrics.inc(f"verdict_{verdict_class}")
+    metrics.observe(f"confidence_{verdict_class}", model_confidence)
+
+    if verdict_sink is not None:
+        verdict_sink.write(_verdict_record(flow_key, flow_stats, model_label, model_confidence,
+                                           attack_type, confidence, real_score))
+
 def simulate_anomaly_traffic():
     if not ENABLE_ANOMALY_SIMULATION:
         return
@@ -1282,16 +1093,14 @@ def simulate_anomaly_traffic():
 
         flow_key = get_flow_key(src_ip, dst_ip, src_port, dst_port, proto)
         flow = flows[flow_key]
-        flow["feature_window"].clear()
-        flow["feature_window"].extend([features] * SEQ_LEN)
         flow["last_packet_time"] = time.time()
+        flow_expiry.touch(flow_key, flow["last_packet_time"])
         flow["is_anomaly"] = True
         flow["stats"] = None
 
-        # 手动检测
-        feat_seq = np.array(flow["feature_window"], dtype=np.float32)
-        feat_scaled = scaler.transform(feat_seq)
-        feat_pca = pca.transform(feat_scaled)
+        # 手动检测：模拟特征重复 SEQ_LEN 次组成时序窗口
+        feat_seq = np.repeat(features[np.newaxis, :], SEQ_LEN, axis=0)
+        feat_pca = preprocess.transform(feat_seq)
         tensor_input = torch.tensor(feat_pca, dtype=torch.float32).unsqueeze(0).to(DEVICE)
 
         with torch.no_grad():
@@ -1307,6 +1116,7 @@ def simulate_anomaly_traffic():
             f"{red}【模拟攻击】⚠️{reset} "
             f"会话：({src_ip}:{src_port} → {dst_ip}:{dst_port}) | 攻击类型：{attack_type} | 置信度：{confidence:.2f}"
         )
+        metrics.inc("verdict_known")
         # 模拟攻击使用动态严重程度计算
         calculated_severity = calculate_severity(attack_type, confidence, True, 0.0, None)
         push_detection_alert(
@@ -1323,23 +1133,334 @@ def simulate_anomaly_traffic():
     logger.info(f"{COLORS['yellow']}🔴 异常流量模拟结束{COLORS['reset']}\n")
 
 def capture_traffic():
-    global stop_capture
+    global stop_capture, capture_session
     logger.info(f"{COLORS['green']}🔍 抓包线程启动，持续{CAPTURE_MINUTES}分钟{COLORS['reset']}")
     conf.use_pcap = True
     conf.verb = 0
-    while not stop_capture:
-        if time.time() - start_timestamp >= CAPTURE_MINUTES * 60:
-            break
-        try:
-            sniff(iface=target_iface, prn=packet_callback, store=0, timeout=3)
-        except Exception as e:
-            logger.warning(f"{COLORS['yellow']}⚠️ 抓包异常：{str(e)}（1秒后重试）{COLORS['reset']}")
-            time.sleep(1)
+    # 无流量时 packet_callback 不会被调用，on_idle 保证超时检查每个 tick 至少执行一次（与报文处理同一线程）
+    capture_session = CaptureSession(target_iface, packet_callback, on_idle=clean_timeout_flows)
+    if not stop_capture:
+        capture_session.run(deadline=start_timestamp + CAPTURE_MINUTES * 60)
     stop_capture = True
     logger.info(f"{COLORS['green']}⏹️  抓包线程结束{COLORS['reset']}")
 
+
+def request_capture_stop():
+    global stop_capture
+    stop_capture = True
+    if capture_session is not None:
+        capture_session.stop()
+
+def init_detection_engine(batching=True):
+    """加载模型/预处理/学生模型，完成快速路径自检，按需启动批量推理线程（实时抓包与 pcap 回放共用）"""
+    global model, generator, scaler, pca, labels, normal_label, infer_scheduler, use_fast_path, preprocess, student, delta_gate
+    global alert_spool, _spool_session, verdict_engine, engine_init_started, model_load_seconds, model_source, host_monitor
+    engine_init_started = time.perf_counter()
+    logger.info(f"{COLORS['green']}🔧 初始化模型...{COLORS['reset']}")
+    # 优先加载精简检测模型（只有判别器+标签+融合预处理）；不可用时回退完整 checkpoint + scaler/pca.pkl
+    detector = load_detector()
+    if detector is not None:
+        model, preprocess, raw_labels, scaler = detector
+        pca, model_source = None, "slim"
+    else:
+        model, _, scaler, pca, raw_labels = load_model()
+        preprocess = load_preprocess(scaler, pca)
+        model_source = "checkpoint"
+    # 生成器只在启用异常流量模拟时加载
+    generator = load_generator() if ENABLE_ANOMALY_SIMULATION else None
+    model_load_seconds = time.perf_counter() - engine_init_started
+    if isinstance(raw_labels, np.ndarray):
+        labels = raw_labels.tolist()
+    else:
+        labels = list(raw_labels) if raw_labels else []
+    if not labels:
+        labels = ["Benign"]
+    labels = [label if isinstance(label, str) else str(label) for label in labels]
+    normal_label = resolve_normal_label(labels)
+    verdict_engine = VerdictEngine(normal_label, is_private_ip)
+    logger.info(f"{COLORS['green']}✅ 正常流量标签：{normal_label} | 模型标签集：{labels}{COLORS['reset']}")
+
+    student = load_student()
+    if student is not None and student.label_classes != labels:
+        logger.warning(f"{COLORS['yellow']}⚠️ 学生模型标签集{student.label_classes}与判别器不一致，停用学生模型{COLORS['reset']}")
+        student = None
+
+    if SINGLE_VECTOR_FASTPATH:
+        use_fast_path, full_ms, fast_ms = verify_fast_path(model, preprocess, synthetic_flow_rows(scaler, 64),
+                                                           batch_sizes=(1, 8, max(INFER_BATCH_SIZE, 1)))
+        if use_fast_path:
+            logger.info(f"{COLORS['green']}⚡ 单向量快速路径自检通过：单次检测 {full_ms:.2f}ms → {fast_ms:.2f}ms"
+                        f"（节省{full_ms - fast_ms:.2f}ms）{COLORS['reset']}")
+
+    delta_gate = FeatureDeltaGate(preprocess)
+    if delta_gate.eps > 0:
+        logger.info(f"{COLORS['green']}🔁 特征增量门控：距离<{delta_gate.eps}且置信度>={delta_gate.min_confidence}时复用上次结果"
+                    f"{'（评估模式，不实际跳过）' if delta_gate.evaluate else ''}{COLORS['reset']}")
+
+    flow_expiry.on_expire = score_finished_flows
+
+    if HOST_SKETCH_ENABLED:
+        host_monitor = HostSketchMonitor()
+        logger.info(f"{COLORS['green']}🧮 主机级草图：{HOST_WINDOW_SECONDS:g}s滑动窗口，"
+                    f"固定内存{host_monitor.memory_bytes() / 1024 / 1024:.1f}MB{COLORS['reset']}")
+
+    if batching and INFER_BATCH_SIZE > 1:
+        infer_scheduler = BatchInferenceScheduler(run_discriminator, _apply_batched_verdict,
+                                                  on_batch=_apply_batched_verdicts).start()
+        logger.info(f"{COLORS['green']}⚙️  批量推理：最多{INFER_BATCH_SIZE}条流/批，最长等待{INFER_MAX_LATENCY_MS}ms{COLORS['reset']}")
+
+    if push_alerts and ALERT_SPOOL_ENABLED and ALERT_API_URL:
+        _spool_session = requests.Session()
+        alert_spool = AlertSpool(alert_spool_dir).start(_deliver_spooled)
+        logger.info(f"{COLORS['green']}📦 告警落盘缓存：{alert_spool_dir}（上次遗留待重放{alert_spool.pending_records}条）{COLORS['reset']}")
+
+    logger.info(f"{COLORS['green']}⏱️ 检测引擎就绪：{time.perf_counter() - engine_init_started:.2f}s"
+                f"（模型加载{model_load_seconds:.2f}s，来源：{model_source}）{COLORS['reset']}")
+
+
+def shutdown_engine(infer_timeout=5.0):
+    """停止批量推理线程（先处理完队列中的流），再发完告警队列中剩余的告警；未重放的缓存告警留待下次启动"""
+    if infer_scheduler is not None:
+        infer_scheduler.stop(timeout=infer_timeout)
+    alert_dispatcher.stop()
+    if alert_spool is not None:
+        alert_spool.close()
+
+
+def replay_pcap(pcap_path, output_path, deterministic=False):
+    """
+    离线回放 pcap/pcapng：流式读取、按报文时间驱动流统计与超时，不限速
+    回放结束时剩余的流按流结束处理（补做最后一次评分），每次检测的判定写入 JSONL
+    """
+    global replay_mode, verdict_sink, start_timestamp
+    replay_mode = True
+    start_timestamp = time.time()
+    if deterministic:
+        # 判定逻辑里的置信度带 random 抖动；固定种子并关闭推理线程，逐包顺序推理
+        random.seed(REPLAY_SEED)
+    init_detection_engine(batching=not deterministic)
+    verdict_sink = VerdictSink(output_path, deterministic)
+    logger.info(f"{COLORS['green']}📼 回放：{pcap_path} → {output_path}"
+                f"（{'确定性输出' if deterministic else '流式输出'}，告警推送{'开启' if push_alerts else '关闭'}）{COLORS['reset']}")
+
+    started = time.perf_counter()
+    first_ts = last_ts = None
+    try:
+        with PcapReader(pcap_path) as reader:
+            for packet in reader:
+                last_ts = float(packet.time)
+                if first_ts is None:
+                    first_ts = last_ts
+                packet_callback(packet, last_ts)
+        score_finished_flows(flow_expiry.drain())
+    except KeyboardInterrupt:
+        logger.info(f"{COLORS['red']}⚠️ 手动停止回放{COLORS['reset']}")
+    finally:
+        shutdown_engine(infer_timeout=None)
+        verdict_sink.close()
+
+    elapsed = time.perf_counter() - started
+    capture_span = (last_ts - first_ts) if first_ts is not None else 0.0
+    logger.info("\n" + "="*80)
+    logger.info(f"{COLORS['green']}📊 回放统计：{COLORS['reset']}")
+    logger.info(f"   1. 报文数：{total_packets_captured}（有效{total_valid_packets}，特征失败{feature_extract_skipped}，未满窗口{short_sequence_skipped}）")
+    logger.info(f"   2. 流数：{flow_expiry.expired_total}（结束时补评分{final_scored_flows}条）")
+    logger.info(f"   3. 判定记录：{verdict_sink.count}条（异常{verdict_sink.attack_count}条）→ {output_path}")
+    logger.info(f"   4. 耗时：{elapsed:.2f}秒，抓包时间跨度{capture_span:.2f}秒，"
+                f"{total_packets_captured / max(elapsed, 1e-9):.0f}包/秒（{capture_span / max(elapsed, 1e-9):.1f}倍实时）")
+    if infer_scheduler is not None:
+        logger.info(f"   5. 批量推理统计：")
+        for line in infer_scheduler.report_lines():
+            logger.info(f"       {line}")
+    logger.info("="*80)
+
+
+def collect_stats():
+    """本进程的统计计数（流水线模式下各 worker 各自收集，由主进程 merge_stats 合并）"""
+    return {
+        "total_packets_captured": total_packets_captured,
+        "total_valid_packets": total_valid_packets,
+        "feature_extract_skipped": feature_extract_skipped,
+        "short_sequence_skipped": short_sequence_skipped,
+        "total_sessions": len(flows),
+        "anomaly_sessions": sum(1 for flow in flows.values() if flow["is_anomaly"]),
+        "normal_count": metrics.value("verdict_normal"),
+        "known_anomaly_count": metrics.value("verdict_known"),
+        "unknown_anomaly_count": metrics.value("verdict_unknown"),
+        "confidence_hist_normal": metrics.histogram("confidence_normal"),
+        "confidence_hist_known": metrics.histogram("confidence_known"),
+        "confidence_hist_unknown": metrics.histogram("confidence_unknown"),
+        "benign_log_logged": metrics.value("benign_log_logged"),
+        "benign_log_suppressed": metrics.value("benign_log_suppressed"),
+        "rule_hits": rule_hit_counts(),
+        "startup_report": [f"模型加载{model_load_seconds:.2f}s（{model_source}），首次判定"
+                           + (f"{first_verdict_seconds:.2f}s" if first_verdict_seconds is not None else "未发生")],
+        "alert_push_success": alert_push_success,
+        "alert_push_failed": alert_push_failed,
+        "alert_detected_count": alert_detected_count,
+        "alert_dropped": sum(alert_dispatcher.dropped.values()),
+        "alert_batches": alert_dispatcher.batches,
+        "alert_spool": alert_spool.stats() if alert_spool is not None else {},
+        "elapsed_time": int(time.time() - start_timestamp),
+        "batch_report": infer_scheduler.report_lines() if infer_scheduler is not None else [],
+        "student_enabled": student is not None,
+        "student_handled": student_handled,
+        "student_escalated": student_escalated,
+        "student_seconds": student_seconds,
+        "teacher_seconds": teacher_seconds,
+        "flows_expired": flow_expiry.expired_total,
+        "final_scored_flows": final_scored_flows,
+        "expiry_requeued": flow_expiry.requeued_total,
+        "scoring_mode": scoring_policy.mode,
+        "scoring_reasons": dict(scoring_policy.reasons),
+        "delta_gate": delta_gate.counters() if delta_gate is not None else {},
+        "host_sketch": host_monitor.counters() if host_monitor is not None else {},
+        "host_report": host_monitor.report_lines() if host_monitor is not None else [],
+        "capture_backend": capture_session.backend if capture_session is not None and capture_session.backend else "",
+        "capture_stats": capture_session.stats() if capture_session is not None else {},
+        "pipeline_report": [],
+    }
+
+
+def merge_stats(stats_list):
+    """合并多个进程的统计：计数求和，时长取最大，报告行按 worker 编号加前缀拼接"""
+    merged = {}
+    for worker_id, stats in enumerate(stats_list):
+        for key, value in stats.items():
+            if key == "elapsed_time":
+                merged[key] = max(merged.get(key, 0), value)
+            elif isinstance(value, str):
+                merged[key] = value
+            elif isinstance(value, dict):
+                bucket = merged.setdefault(key, {})
+                for sub_key, count in value.items():
+                    bucket[sub_key] = bucket.get(sub_key, 0) + count
+            elif isinstance(value, list):
+                merged.setdefault(key, []).extend(f"[worker{worker_id}] {line}" for line in value)
+            elif isinstance(value, bool):
+                merged[key] = merged.get(key, False) or value
+            else:
+                merged[key] = merged.get(key, 0) + value
+    return merged
+
+
+def log_final_stats(stats):
+    logger.info("\n" + "="*80)
+    logger.info(f"{COLORS['green']}📊 最终统计：{COLORS['reset']}")
+    logger.info(f"   1. 总捕获包数：{stats['total_packets_captured']}")
+    capture = stats.get('capture_stats')
+    if capture:
+        drop_rate = capture['dropped'] / capture['received'] * 100 if capture['received'] else 0.0
+        logger.info(f"      内核抓包统计（{stats.get('capture_backend') or '未知'}）：收到{capture['received']}，"
+                    f"缓冲区丢弃{capture['dropped']}（{drop_rate:.2f}%），网卡丢弃{capture['if_dropped']}，"
+                    f"交付{capture['delivered']}，句柄重开{capture['reopens']}次")
+    logger.info(f"   2. 有效检测包数：{stats['total_valid_packets']}（丢弃：特征失败{stats['feature_extract_skipped']}，未满窗口{stats['short_sequence_skipped']}）")
+    logger.info(f"   3. 检测会话数：{stats['total_sessions']}")
+    logger.info(f"   4. 正常流量总数：{stats['normal_count']}")
+    logger.info(f"   5. 已知异常流量数：{stats['known_anomaly_count']}")
+    logger.info(f"   6. 未知异常流量数：{stats['unknown_anomaly_count']}")
+    total_anomaly_count = stats['known_anomaly_count'] + stats['unknown_anomaly_count']
+    logger.info(f"   7. 异常流量总数：{total_anomaly_count}（已知{stats['known_anomaly_count']} + 未知{stats['unknown_anomaly_count']}）")
+    logger.info(f"   8. 异常会话数：{stats['anomaly_sessions']}")
+    for verdict_class, name in (("normal", "正常"), ("known", "已知攻击"), ("unknown", "未知攻击")):
+        hist = stats[f"confidence_hist_{verdict_class}"]
+        if any(hist.values()):
+            logger.info(f"      模型置信度分布（{name}）：" + " ".join(f"{bucket}:{count}" for bucket, count in hist.items()))
+    alert_push_success, alert_push_failed = stats['alert_push_success'], stats['alert_push_failed']
+    alert_detected_count = stats['alert_detected_count']
+    total_alert_push_attempts = alert_push_success + alert_push_failed
+    if total_alert_push_attempts > 0:
+        push_success_rate = (alert_push_success / total_alert_push_attempts) * 100
+        logger.info(f"   9. 告警推送统计：成功{alert_push_success}，失败{alert_push_failed}，成功率{push_success_rate:.1f}%"
+                    f"（批量请求{stats['alert_batches']}次，队列满丢弃{stats['alert_dropped']}条）")
+        # 显示检测与推送的差异
+        if alert_detected_count > total_alert_push_attempts:
+            not_pushed_count = alert_detected_count - total_alert_push_attempts
+            logger.info(f"   10. 检测/推送差异：检测到{alert_detected_count}个异常，但只推送了{total_alert_push_attempts}个（{not_pushed_count}个未推送）")
+        else:
+            logger.info(f"   10. 检测/推送差异：检测到{alert_detected_count}个异常，推送{total_alert_push_attempts}个")
+    else:
+        logger.info(f"   9. 告警推送统计：无推送记录（队列满丢弃{stats['alert_dropped']}条）")
+        logger.info(f"   10. 检测/推送差异：检测到{alert_detected_count}个异常，但未推送任何告警")
+    logger.info(f"   11. 实际时长：{stats['elapsed_time']}秒")
+    logger.info(f"   12. 日志路径：{LOG_FILE}（正常流量日志输出{stats['benign_log_logged']}条，限流省略{stats['benign_log_suppressed']}条）")
+    if stats['batch_report']:
+        logger.info(f"   13. 批量推理统计：")
+        for line in stats['batch_report']:
+            logger.info(f"       {line}")
+    if stats['student_enabled']:
+        student_handled, student_escalated = stats['student_handled'], stats['student_escalated']
+        student_total = student_handled + student_escalated
+        escalation_rate = student_escalated / student_total * 100 if student_total else 0.0
+        logger.info(f"   14. 学生模型：裁决{student_handled}条，升级判别器{student_escalated}条（升级率{escalation_rate:.1f}%），"
+                    f"学生吞吐{student_total / max(stats['student_seconds'], 1e-9):.0f}流/s，"
+                    f"判别器吞吐{student_escalated / max(stats['teacher_seconds'], 1e-9):.0f}流/s")
+    logger.info(f"   15. 流超时：结束{stats['flows_expired']}条（结束时补评分{stats['final_scored_flows']}条），"
+                f"超时堆重新入堆{stats['expiry_requeued']}次")
+    reasons = ", ".join(f"{reason}={count}" for reason, count in sorted(stats['scoring_reasons'].items())) or "无"
+    logger.info(f"   16. 评分事件（{stats['scoring_mode']}）：{reasons}")
+    gate = stats['delta_gate']
+    if gate.get("scored"):
+        line = (f"   17. 特征增量门控：评分{gate['scored']}次，可复用候选{gate['checked']}次，"
+                f"{'本可跳过' if gate['evaluate'] else '跳过推理'}{gate['skipped']}次（跳过率{gate['skipped'] / gate['scored']:.1%}）")
+        if gate['evaluate'] and gate['evaluated']:
+            line += f"，评估：复用结果与实际不一致{gate['mismatched']}/{gate['evaluated']}（{gate['mismatched'] / gate['evaluated']:.2%}）"
+        logger.info(line)
+    spool = stats['alert_spool']
+    if spool:
+        logger.info(f"   18. 告警落盘缓存：本次写入{spool['spooled']}条，重放{spool['delivered']}条，"
+                    f"待重放{spool['pending_records']}条（{spool['pending_bytes'] / 1024:.1f}KB），"
+                    f"超容量丢弃{spool['evicted']}条，损坏跳过{spool['corrupt']}次")
+    rule_hits = stats['rule_hits']
+    if any(rule_hits.values()):
+        logger.info(f"   19. 判定规则命中（verdict_rules）：")
+        stages = {}
+        for name, count in rule_hits.items():
+            stage, rule = name.split(".", 1)
+            stages.setdefault(stage, []).append((rule, count))
+        for stage, rules in stages.items():
+            hit = ", ".join(f"{rule}={count}" for rule, count in rules if count) or "无"
+            logger.info(f"       {stage}：{hit}")
+        unused = [name for name, count in rule_hits.items() if not count]
+        logger.info(f"       未命中规则{len(unused)}条：{', '.join(unused) or '无'}")
+    logger.info(f"   20. 启动耗时：{'; '.join(stats['startup_report'])}")
+    host = stats['host_sketch']
+    if host:
+        logger.info(f"   21. 主机级草图：{host['packets']}包，窗口判定{host['evaluations']}次，"
+                    f"告警 端口扫描{host['scan']}/主机扫描{host['sweep']}/分布式洪泛{host['flood']}")
+        for line in stats['host_report']:
+            logger.info(f"       {line}")
+    if stats['pipeline_report']:
+        logger.info(f"   22. 分片流水线：")
+        for line in stats['pipeline_report']:
+            logger.info(f"       {line}")
+    logger.info("="*80)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="异常流量检测：默认实时抓包，--pcap 离线回放")
+    parser.add_argument("--pcap", help="离线回放的 pcap/pcapng 文件（按报文时间计算流特征，不限速）")
+    parser.add_argument("--output", help="回放判定输出（JSONL），默认 <pcap>.verdicts.jsonl")
+    parser.add_argument("--deterministic", action="store_true",
+                        help="确定性输出：逐包顺序推理、固定随机种子，判定按 (报文时间, 会话, 包数) 排序写出")
+    parser.add_argument("--push-alerts", action="store_true", help="回放时仍向告警网关推送告警（默认不推送）")
+    parser.add_argument("--workers", type=int, default=int(os.environ.get("PIPELINE_WORKERS", "0")),
+                        help="实时抓包的分片worker进程数（见 flow_pipeline.py），0 表示单进程")
+    return parser.parse_args()
+
+
 def main():
-    global stop_capture, model, generator, scaler, pca, labels, target_iface, start_timestamp, normal_label
+    global target_iface, start_timestamp, push_alerts
+    args = parse_args()
+    if args.pcap:
+        push_alerts = args.push_alerts
+        replay_pcap(args.pcap, args.output or f"{args.pcap}.verdicts.jsonl", args.deterministic)
+        return
+    if args.workers > 0:
+        from flow_pipeline import run_pipeline
+        run_pipeline(get_wlan_interface(), args.workers, CAPTURE_MINUTES * 60)
+        return
+
     start_time = datetime.now()
     start_timestamp = time.time()
     end_time = start_time + timedelta(minutes=CAPTURE_MINUTES)
@@ -1359,17 +1480,7 @@ def main():
         
         logger.info(f"{COLORS['green']}🔗 告警网关URL：{ALERT_API_URL}{COLORS['reset']}")
 
-        logger.info(f"{COLORS['green']}🔧 初始化模型...{COLORS['reset']}")
-        model, generator, scaler, pca, raw_labels = load_model()
-        if isinstance(raw_labels, np.ndarray):
-            labels = raw_labels.tolist()
-        else:
-            labels = list(raw_labels) if raw_labels else []
-        if not labels:
-            labels = ["Benign"]
-        labels = [label if isinstance(label, str) else str(label) for label in labels]
-        normal_label = resolve_normal_label(labels)
-        logger.info(f"{COLORS['green']}✅ 正常流量标签：{normal_label} | 模型标签集：{labels}{COLORS['reset']}")
+        init_detection_engine()
 
         # 启动线程
         capture_thread = threading.Thread(target=capture_traffic)
@@ -1385,50 +1496,21 @@ def main():
         while capture_thread.is_alive():
             time.sleep(1)
             if time.time() - start_timestamp >= CAPTURE_MINUTES * 60:
-                stop_capture = True
+                request_capture_stop()
                 capture_thread.join(timeout=5)
                 break
 
     except PermissionError:
         logger.error(f"{COLORS['red']}❌ 请以管理员身份运行！{COLORS['reset']}")
     except KeyboardInterrupt:
-        stop_capture = True
+        request_capture_stop()
         logger.info(f"{COLORS['red']}⚠️ 手动停止{COLORS['reset']}")
     except Exception as e:
-        stop_capture = True
+        request_capture_stop()
         logger.error(f"{COLORS['red']}❌ 系统错误：{str(e)}{COLORS['reset']}")
     finally:
-        total_sessions = len(flows)
-        anomaly_sessions = sum(1 for flow in flows.values() if flow["is_anomaly"])
-        elapsed_time = int(time.time() - start_timestamp)
-
-        logger.info("\n" + "="*80)
-        logger.info(f"{COLORS['green']}📊 最终统计：{COLORS['reset']}")
-        logger.info(f"   1. 总捕获包数：{total_packets_captured}")
-        logger.info(f"   2. 有效检测包数：{total_valid_packets}（丢弃：特征失败{feature_extract_skipped}，未满窗口{short_sequence_skipped}）")
-        logger.info(f"   3. 检测会话数：{total_sessions}")
-        logger.info(f"   4. 正常流量总数：{logger.log_filter.normal_count}")
-        logger.info(f"   5. 已知异常流量数：{logger.log_filter.known_anomaly_count}")
-        logger.info(f"   6. 未知异常流量数：{logger.log_filter.unknown_anomaly_count}")
-        total_anomaly_count = logger.log_filter.known_anomaly_count + logger.log_filter.unknown_anomaly_count
-        logger.info(f"   7. 异常流量总数：{total_anomaly_count}（已知{logger.log_filter.known_anomaly_count} + 未知{logger.log_filter.unknown_anomaly_count}）")
-        logger.info(f"   8. 异常会话数：{anomaly_sessions}")
-        total_alert_push_attempts = alert_push_success + alert_push_failed
-        if total_alert_push_attempts > 0:
-            push_success_rate = (alert_push_success / total_alert_push_attempts) * 100
-            logger.info(f"   9. 告警推送统计：成功{alert_push_success}，失败{alert_push_failed}，成功率{push_success_rate:.1f}%")
-            # 显示检测与推送的差异
-            if alert_detected_count > total_alert_push_attempts:
-                not_pushed_count = alert_detected_count - total_alert_push_attempts
-                logger.info(f"   10. 检测/推送差异：检测到{alert_detected_count}个异常，但只推送了{total_alert_push_attempts}个（{not_pushed_count}个未推送）")
-            else:
-                logger.info(f"   10. 检测/推送差异：检测到{alert_detected_count}个异常，推送{total_alert_push_attempts}个")
-        else:
-            logger.info(f"   9. 告警推送统计：无推送记录")
-            logger.info(f"   10. 检测/推送差异：检测到{alert_detected_count}个异常，但未推送任何告警")
-        logger.info(f"   11. 实际时长：{elapsed_time}秒")
-        logger.info(f"   12. 日志路径：{LOG_FILE}")
-        logger.info("="*80)
+        shutdown_engine()
+        log_final_stats(collect_stats())
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
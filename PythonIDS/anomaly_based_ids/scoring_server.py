@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+"""
+本地异常检测打分服务：实现 mini_snort_pro /hybrid_score 调用的 /analyze 接口（LLM_IDS_URL）
+
+- 判别器只在本进程加载一次（优先精简检测模型，回退完整 checkpoint），签名引擎等调用方无需加载 torch
+- 并发请求经 BatchInferenceScheduler 合并成动态批：攒够 SCORING_BATCH_SIZE 条或最早一条等待超过
+  SCORING_MAX_LATENCY_MS 毫秒就跑一次前向
+- 请求体（POST /analyze）：
+    报文描述（与 hybrid_score 的 packet_info 相同）：{"proto": "tcp", "src_ip", "dst_ip", "src_port", "dst_port", "payload"}
+    流描述：{"features": [16维原始流特征]}（与 FlowStats.to_feature_vector 顺序一致），
+            或 {"packets": [报文描述, ...]}（可带 "length" 字节数与 "ts" 时间戳，按会话累积为一条流）
+    批量：{"items": [描述, ...]} 或直接 JSON 数组
+- 响应：{"label", "confidence", "real_score", "is_attack", "score"}；批量时 {"results": [...], "latency_ms"}
+- GET /health：模型来源、标签、队列深度；GET /metrics：请求/批大小分布/排队、推理、端到端延迟
+
+用法：
+    python scoring_server.py [--host 127.0.0.1] [--port 8000]
+"""
+
+import argparse
+import os
+import threading
+import time
+
+import numpy as np
+from flask import Flask, jsonify, request
+
+from ids_common import (
+    logger, COLORS, FEATURE_DIM, FlowStats, SINGLE_VECTOR_FASTPATH, BatchInferenceScheduler, LatencyRecorder,
+    metrics, load_detector, load_model, load_preprocess, discriminator_outputs, verify_fast_path, synthetic_flow_rows,
+    resolve_normal_label
+)
+
+# ========== 服务配置 ==========
+SCORING_BATCH_SIZE = int(os.environ.get("SCORING_BATCH_SIZE", "64"))
+SCORING_MAX_LATENCY_MS = float(os.environ.get("SCORING_MAX_LATENCY_MS", "5"))
+SCORING_QUEUE_SIZE = int(os.environ.get("SCORING_QUEUE_SIZE", "4096"))
+SCORING_REQUEST_TIMEOUT = float(os.environ.get("SCORING_REQUEST_TIMEOUT", "5.0"))  # 单个请求等待结果的最长时间（秒）
+SCORING_MAX_ITEMS = int(os.environ.get("SCORING_MAX_ITEMS", "1024"))  # 单个请求最多的描述条数
+
+PROTO_NUMBERS = {"tcp": 6, "udp": 17, "icmp": 1}
+HEADER_BYTES = {6: 40, 17: 28}  # IP + TCP/UDP 头，报文描述未给 length 时加到 payload 长度上
+
+
+class ScoringRequest:
+    """一条待打分的流特征；推理线程写入结果后置位 done"""
+    __slots__ = ("features", "result", "done")
+
+    def __init__(self, features):
+        self.features = features
+        self.result = None
+        self.done = threading.Event()
+
+
+class ScoringEngine:
+    def __init__(self, max_batch=SCORING_BATCH_SIZE, max_latency_ms=SCORING_MAX_LATENCY_MS,
+                 max_queue=SCORING_QUEUE_SIZE):
+        started = time.perf_counter()
+        detector = load_detector()
+        if detector is not None:
+            self.model, self.preprocess, labels, stats = detector
+            self.source = "slim"
+        else:
+            self.model, _, stats, pca, labels = load_model()
+            self.preprocess = load_preprocess(stats, pca)
+            self.source = "checkpoint"
+        self.labels = [str(label) for label in (labels.tolist() if isinstance(labels, np.ndarray) else labels)]
+        self.normal_label = resolve_normal_label(self.labels)
+        self.use_fast_path = False
+        if SINGLE_VECTOR_FASTPATH:
+            self.use_fast_path, _, _ = verify_fast_path(self.model, self.preprocess, synthetic_flow_rows(stats, 64),
+                                                        batch_sizes=(1, 8, max(max_batch, 1)))
+        self.load_seconds = time.perf_counter() - started
+
+        self.inference = LatencyRecorder()
+        self.scheduler = BatchInferenceScheduler(self._infer, self._on_result, max_batch=max_batch,
+                                                 max_latency_ms=max_latency_ms, max_queue=max_queue).start()
+
+    def _infer(self, items):
+        started = time.perf_counter()
+        try:
+            real_scores, class_prob = discriminator_outputs(self.model, np.stack([item.features for item in items]),
+                                                            self.preprocess, fast=self.use_fast_path)
+        except Exception as e:
+            metrics.inc("scoring_errors", len(items))
+            logger.error(f"{COLORS['red']}❌ 打分失败（{len(items)}条）：{str(e)}{COLORS['reset']}")
+            return [{"error": str(e)}] * len(items)
+        self.inference.add(time.perf_counter() - started)
+        results = []
+        for i in range(len(items)):
+            label_idx = int(class_prob[i].argmax())
+            label = self.labels[label_idx] if label_idx < len(self.labels) else str(label_idx)
+            confidence = float(class_prob[i, label_idx])
+            results.append({
+                "label": label,
+                "confidence": round(confidence, 6),
+                "real_score": round(float(real_scores[i]), 6),
+                "is_attack": label != self.normal_label,
+                "score": round(confidence if label != self.normal_label else 1.0 - confidence, 6),
+            })
+        return results
+
+    @staticmethod
+    def _on_result(item, result):
+        item.result = result
+        item.done.set()
+
+    def score(self, feature_rows, timeout=SCORING_REQUEST_TIMEOUT):
+        """提交一组特征并等待结果；队列满的条目返回 error，超时抛出 TimeoutError"""
+        metrics.inc("scoring_requests")
+        metrics.inc("scoring_items", len(feature_rows))
+        pending = [ScoringRequest(row) for row in feature_rows]
+        for item in pending:
+            if not self.scheduler.submit(item):
+                metrics.inc("scoring_rejected")
+                item.result = {"error": "scoring queue full"}
+                item.done.set()
+        deadline = time.monotonic() + timeout
+        for item in pending:
+            if not item.done.wait(max(0.0, deadline - time.monotonic())):
+                metrics.inc("scoring_timeouts")
+                raise TimeoutError(f"{timeout}s 内未完成打分")
+        return [item.result for item in pending]
+
+    def health(self):
+        return {
+            "status": "ok",
+            "model_source": self.source,
+            "labels": self.labels,
+            "normal_label": self.normal_label,
+            "fast_path": self.use_fast_path,
+            "load_seconds": round(self.load_seconds, 3),
+            "queue_depth": self.scheduler.queue_depth(),
+        }
+
+    def metrics_report(self):
+        scheduler = self.scheduler
+        flows_done = sum(size * count for size, count in scheduler.batch_sizes.items())
+        return {
+            "requests": metrics.value("scoring_requests"),
+            "items": metrics.value("scoring_items"),
+            "rejected": metrics.value("scoring_rejected"),  # 队列满被拒绝的条数
+            "timeouts": metrics.value("scoring_timeouts"),
+            "errors": metrics.value("scoring_errors"),
+            "batches": scheduler.batches,
+            "avg_batch_size": round(flows_done / scheduler.batches, 2) if scheduler.batches else 0.0,
+            "batch_sizes": scheduler.batch_size_distribution(),
+            "queue_wait": scheduler.queue_wait.summary(),
+            "inference": self.inference.summary(),
+            "end_to_end": scheduler.end_to_end.summary(),
+        }
+
+
+def _packet_fields(packet):
+    proto = packet.get("proto", "tcp")
+    proto = PROTO_NUMBERS.get(proto.lower(), 0) if isinstance(proto, str) else int(proto)
+    length = packet.get("length")
+    if length is None:
+        payload = packet.get("payload", "")
+        payload_len = len(payload.encode(errors="ignore")) if isinstance(payload, str) else len(payload or b"")
+        length = payload_len + HEADER_BYTES.get(proto, 20)
+    return (str(packet.get("src_ip", "0.0.0.0")), int(packet.get("src_port") or 0),
+            str(packet.get("dst_ip", "0.0.0.0")), int(packet.get("dst_port") or 0), proto, float(length))
+
+
+def descriptor_features(descriptor):
+    """把一个报文/流描述转换为 FEATURE_DIM 维原始流特征"""
+    if "features" in descriptor:
+        features = np.asarray(descriptor["features"], dtype=np.float32).reshape(-1)
+        if features.shape[0] != FEATURE_DIM:
+            raise ValueError(f"features 应为 {FEATURE_DIM} 维，实际 {features.shape[0]} 维")
+        return features
+    if "packets" in descriptor:
+        packets = descriptor["packets"]
+        if not isinstance(packets, list) or not packets or not all(isinstance(p, dict) for p in packets):
+            raise ValueError("packets 应为非空的报文描述对象数组")
+    else:
+        packets = [descriptor]
+    now = time.time()
+    stats = None
+    for packet in packets:
+        src_ip, src_port, dst_ip, dst_port, proto, length = _packet_fields(packet)
+        ts = float(packet.get("ts", now))
+        if stats is None:
+            stats = FlowStats(src_ip=src_ip, src_port=src_port, dst_ip=dst_ip, dst_port=dst_port, proto=proto,
+                              start_time=ts, last_time=ts)
+        stats.update(src_ip=src_ip, src_port=src_port, dst_ip=dst_ip, dst_port=dst_port, pkt_len=length, timestamp=ts)
+    return stats.to_feature_vector()
+
+
+def create_app(engine):
+    app = Flask("ids_scoring_server")
+
+    @app.route("/analyze", methods=["POST"])
+    def analyze():
+        started = time.perf_counter()
+        body = request.get_json(silent=True)
+        batched = isinstance(body, list) or (isinstance(body, dict) and "items" in body)
+        if isinstance(body, list):
+            descriptors = body
+        elif isinstance(body, dict):
+            descriptors = body["items"] if batched else [body]
+        else:
+            descriptors = None
+        if not isinstance(descriptors, list) or not descriptors or not all(isinstance(d, dict) for d in descriptors):
+            return jsonify({"error": "请求体应为报文/流描述对象，或 {\"items\": [...]} / JSON 数组"}), 400
+        if len(descriptors) > SCORING_MAX_ITEMS:
+            return jsonify({"error": f"单个请求最多 {SCORING_MAX_ITEMS} 条描述"}), 413
+        try:
+            rows = [descriptor_features(descriptor) for descriptor in descriptors]
+        except (TypeError, ValueError) as e:
+            return jsonify({"error": f"描述解析失败：{str(e)}"}), 400
+        try:
+            results = engine.score(rows)
+        except TimeoutError as e:
+            return jsonify({"error": str(e)}), 504
+        latency_ms = round((time.perf_counter() - started) * 1000.0, 3)
+        if batched:
+            return jsonify({"results": results, "latency_ms": latency_ms})
+        result = dict(results[0], latency_ms=latency_ms)
+        return jsonify(result), (503 if "error" in result else 200)
+
+    @app.route("/health", methods=["GET"])
+    def health():
+        return jsonify(engine.health())
+
+    @app.route("/metrics", methods=["GET"])
+    def metrics():
+        return jsonify(engine.metrics_report())
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="异常检测打分服务（/analyze）")
+    parser.add_argument("--host", default=os.environ.get("SCORING_HOST", "127.0.0.1"))
+    parser.add_argument("--port", type=int, default=int(os.environ.get("SCORING_PORT", "8000")))
+    args = parser.parse_args()
+
+    engine = ScoringEngine()
+    logger.info(f"{COLORS['green']}🚀 打分服务：http://{args.host}:{args.port}/analyze（模型来源：{engine.source}，"
+                f"加载{engine.load_seconds:.2f}s，动态批 最多{SCORING_BATCH_SIZE}条/等待{SCORING_MAX_LATENCY_MS}ms）"
+                f"{COLORS['reset']}")
+    try:
+        create_app(engine).run(host=args.host, port=args.port, threaded=True)
+    finally:
+        engine.scheduler.stop()
+
+
+if __name__ == "__main__":
+    main()
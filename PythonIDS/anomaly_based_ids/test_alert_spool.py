@@ -0,0 +1,104 @@
+"""
+AlertSpool：追加、按序重放、重启续传、超限淘汰，以及重放进行中淘汰当前读分段
+
+用法：
+    python -m pytest -q test_alert_spool.py
+"""
+import threading
+import time
+
+from alert_spool import AlertSpool
+
+
+def _wait_for(condition, timeout=5.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return condition()
+
+
+def test_append_and_ordered_replay(tmp_path):
+    spool = AlertSpool(str(tmp_path), segment_mb=0.001)
+    for i in range(40):
+        spool.append({"id": i})
+    assert spool.pending_records == 40
+
+    received = []
+    spool.start(lambda payload: received.append(payload["id"]) or True)
+    assert _wait_for(lambda: spool.pending_records == 0)
+    spool.close()
+    assert received == list(range(40))
+    assert spool.stats()["pending_bytes"] == 0
+    assert spool.delivered == 40 and spool.corrupt == 0
+
+
+def test_restart_resumes_after_last_ack(tmp_path):
+    spool = AlertSpool(str(tmp_path))
+    for i in range(10):
+        spool.append({"id": i})
+    received = []
+
+    def send(payload):
+        if len(received) >= 4:
+            return False  # 网关"不可达"，剩余告警留在缓存
+        received.append(payload["id"])
+        return True
+
+    spool.start(send)
+    assert _wait_for(lambda: spool.pending_records == 6)
+    spool.close()
+
+    reopened = AlertSpool(str(tmp_path))
+    assert reopened.pending_records == 6
+    reopened.start(lambda payload: received.append(payload["id"]) or True)
+    assert _wait_for(lambda: reopened.pending_records == 0)
+    reopened.close()
+    assert received == list(range(10))
+
+
+def test_limit_evicts_oldest_segments(tmp_path):
+    spool = AlertSpool(str(tmp_path), max_mb=0.004, segment_mb=0.001)
+    for i in range(200):
+        spool.append({"id": i, "pad": "x" * 80})
+    assert spool.evicted > 0
+    assert spool.pending_records == 200 - spool.evicted
+
+    received = []
+    spool.start(lambda payload: received.append(payload["id"]) or True)
+    assert _wait_for(lambda: spool.pending_records == 0)
+    spool.close()
+    # 淘汰的是最旧的告警，剩余部分按顺序、不缺不重
+    assert received == list(range(spool.evicted, 200))
+    assert spool.corrupt == 0
+
+
+def test_eviction_of_segment_in_flight_drops_stale_ack(tmp_path):
+    spool = AlertSpool(str(tmp_path), max_mb=0.004, segment_mb=0.001)
+    spool.append({"id": 0, "pad": "x" * 80})
+    sending, release = threading.Event(), threading.Event()
+    received = []
+
+    def send(payload):
+        if payload["id"] == 0:
+            sending.set()
+            release.wait(5.0)
+        received.append(payload["id"])
+        return True
+
+    spool.start(send)
+    assert sending.wait(5.0)
+    # 第 0 条投递中：继续写入直到其所在分段被容量上限删除
+    for i in range(1, 58):
+        spool.append({"id": i, "pad": "x" * 80})
+    assert spool.evicted > 0
+    release.set()
+
+    assert _wait_for(lambda: spool.pending_records == 0)
+    spool.close()
+    stats = spool.stats()
+    assert spool.corrupt == 0
+    assert stats["pending_bytes"] == 0
+    assert received[0] == 0
+    assert received[1:] == list(range(spool.evicted, 58))
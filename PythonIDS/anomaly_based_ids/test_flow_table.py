@@ -0,0 +1,90 @@
+"""
+FlowTable / FlowStore 与 FlowStats 的一致性
+
+用法：
+    python -m pytest -q test_flow_table.py
+"""
+import copy
+
+import numpy as np
+
+from flow_table import FlowStore, FlowTable, _synthetic_packets, check_parity
+from ids_common import FlowStats, get_flow_key
+
+
+def _legacy_stats(packets):
+    stats = {}
+    for src, sport, dst, dport, proto, length, ts in packets:
+        key = get_flow_key(src, dst, sport, dport, proto)
+        if key not in stats:
+            stats[key] = FlowStats(src_ip=src, src_port=sport, dst_ip=dst, dst_port=dport, proto=proto,
+                                   start_time=ts, last_time=ts)
+        stats[key].update(src, sport, dst, dport, length, ts)
+    return stats
+
+
+def test_features_match_flowstats():
+    packets = list(_synthetic_packets(300, 6000, seed=3))
+    legacy = _legacy_stats(packets)
+    table = FlowTable(16)  # 从最小容量开始，覆盖多次扩容
+    for src, sport, dst, dport, proto, length, ts in packets:
+        table.update(src, sport, dst, dport, proto, length, ts)
+    assert table.size == len(legacy)
+
+    keys = list(legacy)
+    slots = [table.lookup(k[0], k[2], k[1], k[3], k[4]) for k in keys]
+    expected = np.stack([legacy[k].to_feature_vector() for k in keys])
+    np.testing.assert_allclose(table.to_feature_vectors(slots), expected, rtol=1e-5, atol=1e-3)
+    np.testing.assert_allclose(np.stack([table.feature_vector(s) for s in slots]), expected, rtol=1e-5, atol=1e-3)
+    for key, slot in zip(keys, slots):
+        assert FlowStats(**table.stats_fields(slot)) == legacy[key]
+
+
+def test_single_packet_flow_matches_flowstats():
+    table = FlowTable()
+    slot, is_new = table.update("10.0.0.1", 1234, "10.0.0.2", 80, 6, 60.0, 100.0)
+    stats = FlowStats(src_ip="10.0.0.1", src_port=1234, dst_ip="10.0.0.2", dst_port=80, proto=6,
+                      start_time=100.0, last_time=100.0)
+    stats.update("10.0.0.1", 1234, "10.0.0.2", 80, 60.0, 100.0)
+    assert is_new
+    np.testing.assert_allclose(table.feature_vector(slot), stats.to_feature_vector())
+
+
+def test_remove_reuses_slot():
+    table = FlowTable()
+    slot, _ = table.update("10.0.0.1", 1, "10.0.0.2", 2, 17, 100.0, 1.0)
+    table.remove(slot)
+    assert table.size == 0 and table.lookup("10.0.0.1", 1, "10.0.0.2", 2, 17) == -1
+    new_slot, is_new = table.update("10.0.0.3", 3, "10.0.0.4", 4, 17, 100.0, 2.0)
+    assert is_new and new_slot == slot
+    assert table.packets(new_slot) == 1
+
+
+def test_store_entry_and_detached_snapshot():
+    store = FlowStore(FlowStats)
+    key = get_flow_key("10.0.0.1", "10.0.0.2", 1234, 80, 6)
+    for i in range(5):
+        store.update(key, "10.0.0.1", 1234, "10.0.0.2", 80, 6, 100.0, 10.0 + i)
+    entry = store[key]
+    view = entry["stats"]
+    assert store[key] is entry and entry["stats"] is view
+    assert view.fwd_packets == 5 and view.src_ip == "10.0.0.1"
+    assert isinstance(copy.copy(view), FlowStats)
+
+    entry["next_score_at"] = 16
+    entry["last_scored"] = (view.to_feature_vector(), ("BENIGN", 0.99, 0.5))
+    flow = store.pop(key)
+    assert key not in store
+    assert flow["stats"].fwd_packets == 5 and flow["next_score_at"] == 16
+    assert flow["last_scored"][1][0] == "BENIGN"
+
+    # 槽位被新流复用后，旧条目的写入只落在自己的字典里
+    other = get_flow_key("10.0.0.3", "10.0.0.4", 1, 2, 17)
+    store.update(other, "10.0.0.3", 1, "10.0.0.4", 2, 17, 60.0, 20.0)
+    entry["is_anomaly"] = True
+    assert store[other].slot == entry.slot and store[other]["is_anomaly"] is False
+
+
+def test_builtin_parity_check():
+    ok, max_diff = check_parity(n_flows=500, n_packets=10000)
+    assert ok, max_diff
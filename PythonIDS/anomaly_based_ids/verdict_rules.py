@@ -0,0 +1,593 @@
+#!/usr/bin/env python3
+"""
+模型输出之后的启发式判定：声明式规则表 + 小型编译判定引擎
+
+判定按阶段进行，每个阶段是一张按顺序匹配的规则表（首条命中生效，与原来的 if/elif 链等价）：
+  demote            本地→外部的 PortScan/DoS 分类在包速率不高时降级为正常
+  model             按置信度 / 真实度(real_score) / 流量特征决定：保留模型分类、改为未知攻击或改为正常
+  infer             按源端口签名、协议+目标端口、速率特征推断具体攻击类型
+  adopt             推断出类型时决定是否覆盖当前分类
+  adopt_confidence  覆盖后的置信度
+  flood             未推断出类型、但流量特征明显异常且当前为正常时，改判未知攻击
+  filter            本地→外部且速率不足的攻击判定最终改回正常
+
+条件与置信度公式写成表达式字符串（特征名 + 比较 + & | ~ + `x in 集合` + min/max/abs），导入时编译两份：
+- 标量：整张表编译成一个 if 链函数，& | ~ 改写为 and/or/not 短路求值，供逐条判定
+- 批量：每条规则编译成 numpy 表达式，一批流按规则顺序求布尔掩码，首条命中生效
+每条规则的命中次数单独计数（rule_hit_counts），用于分析和删减规则。
+公式里的 jitter 是 random.uniform 抖动（与原实现相同的区间，批量时按行顺序抽取，调用顺序与逐条判定一致）。
+"""
+
+import ast
+import functools
+import os
+import random
+import threading
+from dataclasses import dataclass
+from typing import Optional
+
+import numpy as np
+
+# ========== 判定阈值与端口集合 ==========
+# 判定灵敏度（可通过环境变量调整）
+# 【调整】恢复阈值以解决unknown流量过多问题（参考backup版本）
+MIN_ATTACK_CONFIDENCE = float(os.environ.get("MIN_ATTACK_CONFIDENCE", "0.5"))
+# 【调整】恢复OOD检测敏感度（参考backup版本）
+REAL_SCORE_THRESHOLD = float(os.environ.get("REAL_SCORE_THRESHOLD", "-0.05"))
+# 批量判定的最小行数：numpy 每条规则有固定开销，行数较少时逐条判定更快
+VERDICT_BATCH_MIN_ROWS = int(os.environ.get("VERDICT_BATCH_MIN_ROWS", "128"))
+
+# 端口特征：哪些组合被视为“已知”攻击（其余高危流量可落入未知）
+KNOWN_ATTACK_SOURCE_PORTS = frozenset({
+    50000, 50001, 50002, 50010, 50011, 50012, 50013, 50014,
+    58000,  # 端口扫描
+    59000,  # Web攻击
+    60000,  # 暴力破解
+    61000,  # 渗透攻击
+    62000   # 僵尸网络
+})
+KNOWN_TCP_TARGET_PORTS = frozenset({
+    21, 22, 23, 25, 53, 80, 81, 110, 143, 443, 445, 3306, 3389, 5432, 8080, 8443
+})
+KNOWN_UDP_TARGET_PORTS = frozenset({53, 80, 81, 8080})
+# 已知攻击类型（与训练数据一致），模型标签包含其中任一子串即视为已知类型
+KNOWN_ATTACK_TYPES = ("DoS_Hulk", "DoS_GoldenEye", "PortScan", "DDoS", "BruteForce",
+                      "WebAttack", "Infiltration", "Bot")
+# 常见服务端口（real_score 正常时不做高速率兜底告警）
+COMMON_SERVICE_PORTS = frozenset({80, 443, 53, 22, 21, 25, 110, 143, 993, 995, 8080, 8443, 3389, 445, 3478})
+COMMON_SCAN_PORTS = frozenset({21, 22, 23, 25, 53, 80, 110, 143, 443, 445, 3306, 3389, 5432, 8080, 8443})
+BRUTE_FORCE_PORTS = frozenset({22, 23, 3306, 3389})
+
+UNKNOWN_ATTACK = "Unknown Attack (UA)"
+
+# 规则结果
+KEEP = "keep"  # 不改变当前分类
+KNOWN = "known"  # 保留当前分类并计为异常
+NORMAL = "normal"  # 改为正常
+UNKNOWN = "unknown"  # 改为未知攻击，置信度由规则的公式给出
+
+
+# 端口集合的布尔查找表，批量判定时 `port in 集合` 直接按端口号索引
+_PORT_MASKS = {}
+for _name, _ports in list(globals().items()):
+    if isinstance(_ports, frozenset):
+        _PORT_MASKS[_name] = np.zeros(65536, dtype=bool)
+        _PORT_MASKS[_name][list(_ports)] = True
+del _name, _ports
+
+# ========== 表达式编译 ==========
+_BUILTIN_NAMES = {"min", "max", "abs", "jitter", "True", "False"}
+_NUMPY_CALLS = {"min": "minimum", "max": "maximum", "abs": "abs"}
+
+
+class _ScalarRewriter(ast.NodeTransformer):
+    """标量形式：特征名 → f.<名>，& | ~ → and/or/not（短路求值），jitter → random.uniform(lo, hi)"""
+
+    def __init__(self, jitter=None):
+        self.jitter = jitter
+
+    def visit_Name(self, node):
+        if node.id == "jitter":
+            return ast.parse(f"random.uniform({self.jitter[0]!r}, {self.jitter[1]!r})", mode="eval").body
+        if node.id in _BUILTIN_NAMES or node.id.isupper():
+            return node
+        return ast.Attribute(value=ast.Name(id="f", ctx=ast.Load()), attr=node.id, ctx=ast.Load())
+
+    def visit_BinOp(self, node):
+        self.generic_visit(node)
+        if isinstance(node.op, (ast.BitAnd, ast.BitOr)):
+            op = ast.And() if isinstance(node.op, ast.BitAnd) else ast.Or()
+            values = []
+            for side in (node.left, node.right):
+                values.extend(side.values if isinstance(side, ast.BoolOp) and type(side.op) is type(op) else [side])
+            return ast.BoolOp(op=op, values=values)
+        return node
+
+    def visit_UnaryOp(self, node):
+        self.generic_visit(node)
+        if isinstance(node.op, ast.Invert):
+            return ast.UnaryOp(op=ast.Not(), operand=node.operand)
+        return node
+
+
+class _BatchRewriter(ast.NodeTransformer):
+    """numpy 形式：特征名 → f.<名>（数组），`端口 in 集合` → 查 65536 项布尔表，min/max/abs → np.minimum/maximum/abs"""
+
+    def visit_Name(self, node):
+        if node.id in _BUILTIN_NAMES or node.id.isupper():
+            return node
+        return ast.Attribute(value=ast.Name(id="f", ctx=ast.Load()), attr=node.id, ctx=ast.Load())
+
+    def visit_Compare(self, node):
+        self.generic_visit(node)
+        if len(node.ops) == 1 and isinstance(node.ops[0], (ast.In, ast.NotIn)):
+            lookup = ast.parse(f"_PORT_MASKS[{node.comparators[0].id!r}][x]", mode="eval").body
+            lookup.slice = node.left
+            return ast.UnaryOp(op=ast.Invert(), operand=lookup) if isinstance(node.ops[0], ast.NotIn) else lookup
+        return node
+
+    def visit_Call(self, node):
+        self.generic_visit(node)
+        if isinstance(node.func, ast.Name) and node.func.id in _NUMPY_CALLS:
+            node.func = ast.Attribute(value=ast.Name(id="np", ctx=ast.Load()), attr=_NUMPY_CALLS[node.func.id],
+                                      ctx=ast.Load())
+        return node
+
+
+def _rewrite(expr, rewriter):
+    return ast.unparse(ast.fix_missing_locations(rewriter.visit(ast.parse(expr, mode="eval").body)))
+
+
+def _compile(source, name):
+    scope = {}
+    exec(compile(source, f"<verdict_rules:{name}>", "exec"), globals(), scope)
+    return scope[name]
+
+
+def compile_scalar_expr(expr, jitter=None):
+    return _compile(f"def _expr(f):\n    return {_rewrite(expr, _ScalarRewriter(jitter))}\n", "_expr")
+
+
+def compile_batch_expr(expr):
+    return _compile(f"def _expr(f, jitter=0.0):\n    return {_rewrite(expr, _BatchRewriter())}\n", "_expr")
+
+
+# ========== 流特征 ==========
+class FlowFacts:
+    """规则表达式使用的流特征；单条流时为 Python 标量，批量时为等长 numpy 数组"""
+
+
+# 派生特征（按顺序计算，可引用前面的特征）；输入特征：has_stats fwd bwd fwd_bytes bwd_bytes duration
+# proto src_port dst_port src_local dst_local
+FLOW_FACTS = (
+    ("total", "fwd + bwd"),
+    ("pps", "total / duration"),
+    ("bps", "(fwd_bytes + bwd_bytes) / duration"),
+    ("one_way", "((fwd > 0) & (bwd == 0)) | ((fwd == 0) & (bwd > 0))"),
+    ("tcp", "has_stats & (proto == 6)"),
+    ("udp", "has_stats & (proto == 17)"),
+    ("l2e", "has_stats & src_local & ~dst_local"),  # 本地访问外部
+    ("e2l", "has_stats & ~src_local & dst_local"),  # 外部访问本地
+    ("src_attack_port", "has_stats & (src_port in KNOWN_ATTACK_SOURCE_PORTS)"),
+    ("tcp_signature", "src_attack_port | (dst_port in KNOWN_TCP_TARGET_PORTS)"),
+    ("udp_signature", "src_attack_port | (dst_port in KNOWN_UDP_TARGET_PORTS)"),
+    ("dst_scan_port", "dst_port in COMMON_SCAN_PORTS"),
+    ("dst_brute_force_port", "dst_port in BRUTE_FORCE_PORTS"),
+    ("common_port", "(dst_port in COMMON_SERVICE_PORTS) | (src_port in COMMON_SERVICE_PORTS)"),
+    # 端口扫描特征：单向流量，或双向但响应很少
+    ("likely_scan", "one_way | ((min(fwd, bwd) / max(total, 1) < 0.3) & (total > 50))"),
+    # model 阶段（低置信度分支）的速率门槛
+    ("flood_1000", "(pps > 1000) | (bps > 1000000)"),
+    ("flood_suspect", "(one_way & flood_1000) | (flood_1000 & (total > 2000))"),
+    # infer/adopt/flood 阶段的速率门槛
+    ("high_rate", "(pps > 500) | (bps > 500000)"),
+    ("high_volume", "total > 500"),
+    ("very_high_rate", "(pps > 300) | (bps > 300000)"),
+    ("burst", "very_high_rate | (one_way & high_rate)"),
+    ("anomalous", "burst | (high_rate & high_volume) | (one_way & (total > 200))"),
+)
+
+_scalar_facts = _compile(
+    "def _facts(f):\n" + "".join(f"    f.{name} = {_rewrite(expr, _ScalarRewriter())}\n" for name, expr in FLOW_FACTS),
+    "_facts"
+)
+_batch_facts = _compile(
+    "def _facts(f):\n" + "".join(f"    f.{name} = {_rewrite(expr, _BatchRewriter())}\n" for name, expr in FLOW_FACTS),
+    "_facts"
+)
+
+
+def flow_facts(flow_stats, is_private):
+    f = FlowFacts()
+    if flow_stats is None:
+        f.has_stats, f.fwd, f.bwd, f.fwd_bytes, f.bwd_bytes, f.duration = False, 0, 0, 0.0, 0.0, 1e-6
+        f.proto, f.src_port, f.dst_port, f.src_local, f.dst_local = 0, 0, 0, False, False
+    else:
+        f.has_stats = True
+        f.fwd, f.bwd = flow_stats.fwd_packets, flow_stats.bwd_packets
+        f.fwd_bytes, f.bwd_bytes = flow_stats.fwd_bytes, flow_stats.bwd_bytes
+        f.duration = max(flow_stats.last_time - flow_stats.start_time, 1e-6)
+        f.proto, f.src_port, f.dst_port = flow_stats.proto, flow_stats.src_port, flow_stats.dst_port
+        f.src_local, f.dst_local = bool(is_private(flow_stats.src_ip)), bool(is_private(flow_stats.dst_ip))
+    _scalar_facts(f)
+    return f
+
+
+def batch_flow_facts(stats_list, is_private):
+    """一批 FlowStats（不含 None）的流特征，字段为 numpy 数组"""
+    f = FlowFacts()
+    f.has_stats = np.ones(len(stats_list), dtype=bool)
+    f.fwd = np.array([s.fwd_packets for s in stats_list], dtype=np.int64)
+    f.bwd = np.array([s.bwd_packets for s in stats_list], dtype=np.int64)
+    f.fwd_bytes = np.array([s.fwd_bytes for s in stats_list], dtype=np.float64)
+    f.bwd_bytes = np.array([s.bwd_bytes for s in stats_list], dtype=np.float64)
+    f.duration = np.maximum(np.array([s.last_time - s.start_time for s in stats_list], dtype=np.float64), 1e-6)
+    f.proto = np.array([s.proto for s in stats_list], dtype=np.int64)
+    f.src_port = np.array([s.src_port for s in stats_list], dtype=np.int64)
+    f.dst_port = np.array([s.dst_port for s in stats_list], dtype=np.int64)
+    f.src_local = np.array([bool(is_private(s.src_ip)) for s in stats_list], dtype=bool)
+    f.dst_local = np.array([bool(is_private(s.dst_ip)) for s in stats_list], dtype=bool)
+    _batch_facts(f)
+    return f
+
+
+@functools.lru_cache(maxsize=256)
+def _label_facts(label, normal_label):
+    """(label_normal, known_type, label_portscan, label_dos, label_dos_hulk, label_ddos)"""
+    return (label == normal_label, any(t in label for t in KNOWN_ATTACK_TYPES), "PortScan" in label,
+            "DoS" in label, label == "DoS_Hulk", label == "DDoS")
+
+
+def _set_label_facts(f, labels, normal_label):
+    """与当前分类相关的特征（各阶段可能改写分类，进入阶段前重新计算）；labels 为 list 时按批量计算"""
+    if isinstance(labels, list):
+        columns = np.array([_label_facts(label, normal_label) for label in labels], dtype=bool).reshape(-1, 6).T
+    else:
+        columns = _label_facts(labels, normal_label)
+    f.label_normal, f.known_type, f.label_portscan, f.label_dos, f.label_dos_hulk, f.label_ddos = columns
+
+
+def _set_inferred_facts(f, inferred):
+    if isinstance(inferred, list):
+        f.inferred = np.array([label or "" for label in inferred], dtype=object)
+        f.inferred_known_type = np.array([label in KNOWN_ATTACK_TYPES for label in inferred], dtype=bool)
+    else:
+        f.inferred = inferred
+        f.inferred_known_type = inferred in KNOWN_ATTACK_TYPES
+
+
+# ========== 规则表 ==========
+@dataclass(frozen=True)
+class Rule:
+    name: str
+    when: str  # 条件表达式
+    outcome: object = None  # KEEP/KNOWN/NORMAL/UNKNOWN，或 infer 阶段推断出的攻击类型
+    confidence: Optional[str] = None  # 置信度公式（outcome 为 UNKNOWN 或置信度表）
+    jitter: Optional[tuple] = None  # 公式中 jitter 的 random.uniform 区间
+
+
+class RuleTable:
+    """按顺序匹配的规则表（首条命中生效），导入时编译为标量 if 链与逐条 numpy 条件"""
+
+    def __init__(self, stage, rules):
+        self.stage = stage
+        self.rules = tuple(rules)
+        self.hits = [0] * len(self.rules)
+        self._lock = threading.Lock()
+        body = "".join(f"    if {_rewrite(rule.when, _ScalarRewriter())}:\n        return {i}\n"
+                       for i, rule in enumerate(self.rules))
+        self._match = _compile(f"def _match(f):\n{body}    return -1\n", "_match")
+        self._batch_when = [compile_batch_expr(rule.when) for rule in self.rules]
+        self._confidence = [compile_scalar_expr(rule.confidence, rule.jitter) if rule.confidence else None
+                            for rule in self.rules]
+        self._batch_confidence = [compile_batch_expr(rule.confidence) if rule.confidence else None
+                                  for rule in self.rules]
+
+    def match(self, f):
+        """单条流：返回命中规则的下标，未命中为 -1"""
+        index = self._match(f)
+        if index >= 0:
+            with self._lock:
+                self.hits[index] += 1
+        return index
+
+    def match_batch(self, f, active):
+        """一批流：返回每行命中规则的下标，未命中或不在 active 中的行为 -1"""
+        choice = np.full(len(active), -1, dtype=np.int64)
+        remaining = active.copy()
+        counts = []
+        left = int(np.count_nonzero(remaining))
+        for i, when in enumerate(self._batch_when):
+            if not left:
+                break
+            hit = when(f) & remaining
+            hits = int(np.count_nonzero(hit))
+            if hits:
+                choice[hit] = i
+                remaining &= ~hit
+                left -= hits
+                counts.append((i, hits))
+        with self._lock:
+            for i, hits in counts:
+                self.hits[i] += hits
+        return choice
+
+    def confidence(self, index, f):
+        return self._confidence[index](f)
+
+    def batch_confidence(self, index, f, jitter):
+        values = self._batch_confidence[index](f, jitter)
+        return values if np.ndim(values) else np.full(jitter.shape, values)
+
+    def hit_counts(self):
+        with self._lock:
+            return {f"{self.stage}.{rule.name}": hits for rule, hits in zip(self.rules, self.hits)}
+
+
+DEMOTE_RULES = RuleTable("demote", [
+    # 本地->外部的PortScan分类可能是误判（正常访问外部服务），只有包速率非常高（>200包/秒）才保留
+    Rule("outbound_portscan_slow", "l2e & label_portscan & (pps < 200)", NORMAL),
+    # DoS攻击通常包速率很高，本地->外部速率不高（<500包/秒）可能是误判
+    Rule("outbound_dos_slow", "l2e & ~label_portscan & label_dos & (pps < 500)", NORMAL),
+])
+
+MODEL_RULES = RuleTable("model", [
+    Rule("confident", "conf >= MIN_ATTACK_CONFIDENCE", KNOWN),
+    # 模型分类为已知攻击类型时，置信度0.3以上也保留原始分类（显示具体类型而不是 Unknown Attack）
+    Rule("known_type", "known_type & (conf >= 0.3)", KNOWN),
+    # 低真实度得分（OOD）；本地→外部的正常流量 real_score 低可能只是训练数据缺少这类流量
+    Rule("ood_outbound_benign", "(real <= REAL_SCORE_THRESHOLD) & l2e & label_normal", KEEP),
+    Rule("ood_known_type", "(real <= REAL_SCORE_THRESHOLD) & known_type", KNOWN),
+    Rule("ood_unknown", "real <= REAL_SCORE_THRESHOLD", UNKNOWN, "max(1.0 - conf, 0.01)"),
+    # 中等置信度：可能是攻击但模型不确定（MIN_ATTACK_CONFIDENCE 调到 0.5 以上时才会走到）
+    Rule("mid_known_type", "(conf >= 0.5) & known_type", KNOWN),
+    Rule("mid_flood_outbound_benign", "(conf >= 0.5) & ((pps > 5000) | (bps > 10000000)) & l2e & label_normal", KEEP),
+    Rule("mid_flood_unknown", "(conf >= 0.5) & ((pps > 5000) | (bps > 10000000))", UNKNOWN,
+         "min(0.9, 0.4 + (pps / 5000.0) * 0.3)"),
+    Rule("mid_normal", "conf >= 0.5", NORMAL),
+    # 非常不真实的流量（real_score<=-0.2）才报未知异常；包很少（<5）且不是关键端口视为噪声
+    Rule("very_ood_outbound_benign", "(real <= -0.2) & l2e & label_normal", KEEP),
+    Rule("very_ood_known_type", "(real <= -0.2) & known_type", KNOWN),
+    Rule("very_ood_noise", "(real <= -0.2) & has_stats & (total < 5) & (dst_port not in KNOWN_TCP_TARGET_PORTS)",
+         NORMAL),
+    Rule("very_ood_unknown", "real <= -0.2", UNKNOWN, "min(0.85, 0.5 + abs(real) * 2.0)"),
+    # 置信度很低（<0.3）：已知类型保留，否则只有明显的攻击特征才视为未知攻击
+    Rule("low_known_type", "known_type", KNOWN),
+    Rule("low_flood_outbound_benign", "flood_suspect & l2e & label_normal", KEEP),
+    Rule("low_flood_one_way", "one_way & flood_1000", UNKNOWN,
+         "min(0.85, 0.5 + (pps / 2000.0) * 0.2 + (bps / 500000.0) * 0.1 + min(0.1, (total / 2000.0) * 0.1))"),
+    Rule("low_flood_volume", "flood_1000 & (total > 2000)", UNKNOWN,
+         "min(0.8, 0.5 + (pps / 1500.0) * 0.2 + min(0.15, (total / 2000.0) * 0.15))"),
+    # 无统计信息时 real_score<=-0.2 已由 very_ood_* 处理，这里只剩正常
+    Rule("low_normal", "True", NORMAL),
+])
+
+INFER_RULES = RuleTable("infer", [
+    # 第一步：攻击脚本使用固定源端口
+    Rule("sig_udp_flood", "(src_port == 50000) & udp & (dst_port == 80)", "DDoS"),
+    Rule("sig_udp_dns_flood", "(src_port == 50001) & udp & (dst_port == 53)", "DDoS"),
+    Rule("sig_udp_large_packet", "(src_port == 50002) & udp & (dst_port == 8080)", "DDoS"),
+    Rule("sig_syn_flood", "(src_port >= 50010) & (src_port <= 50014) & tcp & (dst_port == 80)", "DoS_Hulk"),
+    Rule("sig_portscan", "(src_port == 58000) & tcp", "PortScan"),
+    Rule("sig_web", "(src_port == 59000) & tcp & (dst_port == 80)", "WebAttack"),
+    Rule("sig_brute_force", "(src_port == 60000) & tcp & (dst_port == 22)", "BruteForce"),
+    Rule("sig_infiltration", "(src_port == 61000) & tcp & (dst_port == 443)", "Infiltration"),
+    Rule("sig_bot", "(src_port == 62000) & udp & (dst_port == 53)", "Bot"),
+    # 第二步：TCP，本地->外部只有极高包速率或单向高速率才判定为攻击（正常客户端访问不算端口扫描）
+    Rule("tcp_outbound_dos", "tcp & l2e & burst & tcp_signature", "DoS_Hulk"),
+    Rule("tcp_outbound_unknown", "tcp & l2e & burst", UNKNOWN_ATTACK),
+    # 外部->本地 或 本地->本地：常见扫描端口上单向/响应很少且速率中等
+    Rule("tcp_brute_force", "tcp & ~l2e & dst_brute_force_port & likely_scan & (pps >= 10) & (pps < 50) & (total > 100)",
+         "BruteForce"),
+    Rule("tcp_scan", "tcp & ~l2e & dst_scan_port & likely_scan & (pps >= 10) & (pps < 150) & (total > 100)",
+         "PortScan"),
+    Rule("tcp_slow_scan", "tcp & ~l2e & dst_scan_port & one_way & (total > 200) & (pps < 100)", "PortScan"),
+    Rule("tcp_dos", "tcp & ~l2e & burst & tcp_signature", "DoS_Hulk"),
+    Rule("tcp_unknown_burst", "tcp & ~l2e & burst", UNKNOWN_ATTACK),
+    Rule("tcp_uncommon_port_scan", "tcp & ~l2e & ~dst_scan_port & one_way & (pps >= 10) & (pps < 150) & (total > 100)",
+         "PortScan"),
+    # UDP：高速率 / 高速率+高包数 / 单向且包数较多
+    Rule("udp_ddos", "udp & anomalous & udp_signature", "DDoS"),
+    Rule("udp_unknown", "udp & anomalous", UNKNOWN_ATTACK),
+    # 第三步：仍未识别但特征明显异常的 TCP（外部->本地 或 本地->本地），按目标端口判断
+    # 本地->外部与 UDP 的第三步条件都被第二步覆盖，不再列出
+    Rule("tcp_anomalous_brute_force", "tcp & ~l2e & anomalous & dst_brute_force_port", "BruteForce"),
+    Rule("tcp_anomalous_scan", "tcp & ~l2e & anomalous & dst_scan_port", "PortScan"),
+    Rule("tcp_anomalous_dos", "tcp & ~l2e & anomalous & tcp_signature", "DoS_Hulk"),
+    Rule("tcp_anomalous_unknown", "tcp & ~l2e & anomalous", UNKNOWN_ATTACK),
+])
+
+ADOPT_RULES = RuleTable("adopt", [
+    # 源端口在已知攻击列表中：无条件使用推断结果（第一条，VerdictEngine 据此标记 forced）
+    Rule("source_port", "src_attack_port"),
+    Rule("inferred_unknown", f"inferred == {UNKNOWN_ATTACK!r}"),
+    # 模型分类为正常，但特征非常异常
+    Rule("benign_override", "label_normal & ((very_high_rate & (pps > 500)) | (one_way & high_rate & (pps > 200))"
+                            " | (l2e & very_high_rate & (pps > 1000)) | (e2l & burst))"),
+    # 模型分类为攻击但置信度很低（<0.4），推断为已知类型且特征明显异常
+    Rule("low_confidence_override",
+         "~label_normal & (conf < 0.4) & inferred_known_type & (very_high_rate | one_way | high_rate)"),
+    # 模型分类为攻击，推断类型更具体（PortScan/BruteForce）或协议更匹配（DDoS↔DoS_Hulk）
+    Rule("refine_portscan", "~label_normal & (conf >= 0.4) & (inferred == 'PortScan') & one_way"),
+    Rule("refine_brute_force", "~label_normal & (conf >= 0.4) & (inferred == 'BruteForce') & dst_brute_force_port"),
+    Rule("refine_ddos", "~label_normal & (conf >= 0.4) & (inferred == 'DDoS') & label_dos_hulk & udp"),
+    Rule("refine_dos_hulk", "~label_normal & (conf >= 0.4) & (inferred == 'DoS_Hulk') & label_ddos & tcp"),
+])
+
+ADOPT_CONFIDENCE = RuleTable("adopt_confidence", [
+    Rule("inferred_unknown", f"inferred == {UNKNOWN_ATTACK!r}",
+         confidence="min(0.9, 0.6 + min(0.25, pps / 600.0) + min(0.15, total / 600.0))"),
+    # 基于源端口识别是最可靠的识别方式，置信度 0.85-0.95（原实现的“单向高速率/高速率大流量”一档同样被 very_high_rate 覆盖）
+    Rule("source_port_burst", "src_attack_port & very_high_rate",
+         confidence="min(0.95, 0.85 + (pps / 1000.0) * 0.1 + jitter)", jitter=(-0.02, 0.03)),
+    Rule("source_port", "src_attack_port", confidence="0.85 + jitter", jitter=(-0.02, 0.03)),
+    Rule("very_high_rate", "very_high_rate",
+         confidence="min(0.95, 0.6 + (pps / 1000.0) * 0.2 + jitter)", jitter=(-0.03, 0.04)),
+    # 原实现此后还有 one_way&high_rate、high_rate&high_volume 两档，high_rate 蕴含 very_high_rate，永远走不到，已删除
+    Rule("default", "True", confidence="min(0.8, 0.5 + (total / 200.0) * 0.2 + jitter)", jitter=(-0.03, 0.03)),
+])
+
+FLOOD_RULES = RuleTable("flood", [
+    # 本地->外部：保持正常；real_score>0 且是常见端口说明模型认为流量结构正常
+    Rule("outbound", "anomalous & label_normal & l2e", KEEP),
+    Rule("structured_common_port", "anomalous & label_normal & (real > 0.0) & common_port", KEEP),
+    Rule("very_high_rate", "anomalous & label_normal & very_high_rate", UNKNOWN,
+         "min(0.95, 0.6 + (pps / 1000.0) * 0.2)"),
+    # anomalous 中含 high_rate 的两种情况都已被 very_high_rate 覆盖，剩下的只有“单向且包数>200”
+    Rule("one_way_volume", "anomalous & label_normal", UNKNOWN,
+         "min(0.8, 0.5 + (total / 200.0) * 0.2 + jitter)", (-0.03, 0.03)),
+])
+
+# 最终安全检查：本地->外部的攻击判定需要极高包速率（<500包/秒改回正常）；基于源端口的攻击不过滤
+FILTER_RULES = RuleTable("filter", [
+    Rule("outbound_slow", "~src_attack_port & l2e & ~label_normal & (pps < 500)", NORMAL),
+])
+
+RULE_TABLES = (DEMOTE_RULES, MODEL_RULES, INFER_RULES, ADOPT_RULES, ADOPT_CONFIDENCE, FLOOD_RULES, FILTER_RULES)
+
+
+def rule_hit_counts():
+    """所有规则的命中次数 {"<阶段>.<规则名>": 次数}（含 0 次，便于找出可删减的规则）"""
+    counts = {}
+    for table in RULE_TABLES:
+        counts.update(table.hit_counts())
+    return counts
+
+
+# ========== 判定引擎 ==========
+@dataclass
+class Decision:
+    attack_type: str
+    confidence: float
+    anomalous: bool  # model 阶段后是否判为异常（异常会话数/检测数的统计口径）
+    forced: bool = False  # 源端口签名强制采用推断结果
+    inferred: Optional[str] = None
+    filtered: bool = False  # 被最终安全检查改回正常
+    packets_per_s: float = 0.0
+
+
+class VerdictEngine:
+    """按规则表对模型输出做综合判定；decide 处理单条流，decide_batch 一次处理一批"""
+
+    def __init__(self, normal_label, is_private):
+        self.normal_label = normal_label
+        # 同一批主机反复出现，缓存内网判断结果（ipaddress 解析是逐条判定中最耗时的部分）
+        self.is_private = functools.lru_cache(maxsize=4096)(is_private)
+
+    def decide(self, attack_type, confidence, real_score, flow_stats):
+        f = flow_facts(flow_stats, self.is_private)
+        f.conf, f.real = confidence, real_score
+        anomalous = False
+
+        if attack_type != self.normal_label:
+            _set_label_facts(f, attack_type, self.normal_label)
+            if DEMOTE_RULES.match(f) >= 0:
+                attack_type = self.normal_label
+                _set_label_facts(f, attack_type, self.normal_label)
+            index = MODEL_RULES.match(f)
+            outcome = MODEL_RULES.rules[index].outcome
+            if outcome == NORMAL:
+                attack_type = self.normal_label
+            elif outcome == UNKNOWN:
+                attack_type, confidence = UNKNOWN_ATTACK, MODEL_RULES.confidence(index, f)
+            anomalous = outcome in (KNOWN, UNKNOWN)
+
+        forced, inferred = False, None
+        if f.has_stats:
+            f.conf = confidence
+            _set_label_facts(f, attack_type, self.normal_label)
+            index = INFER_RULES.match(f)
+            if index >= 0:
+                inferred = INFER_RULES.rules[index].outcome
+                _set_inferred_facts(f, inferred)
+                adopt = ADOPT_RULES.match(f)
+                if adopt >= 0:
+                    forced = adopt == 0
+                    attack_type = inferred
+                    confidence = ADOPT_CONFIDENCE.confidence(ADOPT_CONFIDENCE.match(f), f)
+            else:
+                index = FLOOD_RULES.match(f)
+                if index >= 0 and FLOOD_RULES.rules[index].outcome == UNKNOWN:
+                    attack_type, confidence = UNKNOWN_ATTACK, FLOOD_RULES.confidence(index, f)
+
+        _set_label_facts(f, attack_type, self.normal_label)
+        filtered = FILTER_RULES.match(f) >= 0
+        if filtered:
+            attack_type = self.normal_label
+        return Decision(attack_type, confidence, anomalous, forced, inferred, filtered, f.pps)
+
+    def decide_batch(self, rows):
+        """rows：[(attack_type, confidence, real_score, flow_stats), ...]，flow_stats 不能为 None"""
+        n = len(rows)
+        if n < VERDICT_BATCH_MIN_ROWS:
+            return [self.decide(*row) for row in rows]
+        f = batch_flow_facts([row[3] for row in rows], self.is_private)
+        labels = [row[0] for row in rows]
+        confidence = [row[1] for row in rows]
+        f.conf = np.array(confidence, dtype=np.float64)
+        f.real = np.array([row[2] for row in rows], dtype=np.float64)
+        anomalous = np.zeros(n, dtype=bool)
+        all_rows = np.ones(n, dtype=bool)
+        no_jitter = np.zeros(n)
+
+        model_attack = np.array([label != self.normal_label for label in labels], dtype=bool)
+        if model_attack.any():
+            _set_label_facts(f, labels, self.normal_label)
+            for i in np.flatnonzero(DEMOTE_RULES.match_batch(f, model_attack) >= 0):
+                labels[i] = self.normal_label
+            _set_label_facts(f, labels, self.normal_label)
+            choice = MODEL_RULES.match_batch(f, model_attack)
+            for index in np.unique(choice[choice >= 0]):
+                rows_hit = np.flatnonzero(choice == index)
+                outcome = MODEL_RULES.rules[index].outcome
+                if outcome == UNKNOWN:
+                    values = MODEL_RULES.batch_confidence(index, f, no_jitter)
+                    for i in rows_hit:
+                        labels[i], confidence[i] = UNKNOWN_ATTACK, float(values[i])
+                elif outcome == NORMAL:
+                    for i in rows_hit:
+                        labels[i] = self.normal_label
+                anomalous[rows_hit] = outcome in (KNOWN, UNKNOWN)
+
+        f.conf = np.array(confidence, dtype=np.float64)
+        _set_label_facts(f, labels, self.normal_label)
+        infer = INFER_RULES.match_batch(f, all_rows)
+        inferred = [INFER_RULES.rules[index].outcome if index >= 0 else None for index in infer]
+        adopt = np.full(n, -1, dtype=np.int64)
+        conf_choice = np.full(n, -1, dtype=np.int64)
+        if (infer >= 0).any():
+            _set_inferred_facts(f, inferred)
+            adopt = ADOPT_RULES.match_batch(f, infer >= 0)
+            conf_choice = ADOPT_CONFIDENCE.match_batch(f, adopt >= 0)
+        flood = FLOOD_RULES.match_batch(f, infer < 0)
+
+        # 每行要用的置信度公式（采用推断 / 高速率兜底）；jitter 按行顺序抽取，与逐条判定的 random 调用顺序一致
+        pending = []
+        jitter = np.zeros(n)
+        for i in range(n):
+            if conf_choice[i] >= 0:
+                table, index = ADOPT_CONFIDENCE, conf_choice[i]
+                labels[i] = inferred[i]
+            elif flood[i] >= 0 and FLOOD_RULES.rules[flood[i]].outcome == UNKNOWN:
+                table, index = FLOOD_RULES, flood[i]
+                labels[i] = UNKNOWN_ATTACK
+            else:
+                continue
+            jitter_range = table.rules[index].jitter
+            if jitter_range is not None:
+                jitter[i] = random.uniform(*jitter_range)
+            pending.append((i, table, index))
+        evaluated = {}
+        for i, table, index in pending:
+            key = (table.stage, index)
+            if key not in evaluated:
+                evaluated[key] = table.batch_confidence(index, f, jitter)
+            confidence[i] = float(evaluated[key][i])
+
+        _set_label_facts(f, labels, self.normal_label)
+        filtered = FILTER_RULES.match_batch(f, all_rows) >= 0
+        return [
+            Decision(self.normal_label if filtered[i] else labels[i], confidence[i], bool(anomalous[i]),
+                     bool(adopt[i] == 0), inferred[i], bool(filtered[i]), float(f.pps[i]))
+            for i in range(n)
+        ]
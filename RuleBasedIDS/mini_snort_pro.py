@@ -21,7 +21,9 @@ mini_snort_pro.py - 专业一点的微型入侵检测（签名式）Demo（优
 运行模式：
 - 实时抓包：   --mode live -i eth0 -R rules.json
 - 回放 pcap：  --mode pcap -r sample.pcap -R rules.json
+- 按流/时间回放大 pcap： --mode pcap -r big.pcap -R rules.json --filter-host 10.0.0.5 --time-range "START,END"
 - 仅开 REST：  --api --api-port 5001 （依赖 Flask）
+- 抓包同时暴露 /metrics： --mode live -i eth0 -R rules.json --metrics-port 5001
 
 注意：教学/演示用途，不替代 Snort/Suricata。
 """
@@ -33,9 +35,20 @@ import time
 import logging
 import ipaddress
 import os
+import queue
 import socket
+import threading
+from bisect import bisect_left
+from collections import OrderedDict
 from dataclasses import dataclass, field
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, Set, Tuple
+
+try:  # Python 3.11+ 把正则解析器挪到了 re 包内部
+    from re import _parser as sre_parse
+    from re import _constants as sre_constants
+except ImportError:  # pragma: no cover - 旧版本 Python
+    import sre_parse
+    import sre_constants
 
 import requests  # 用于调用对方的大模型 IDS HTTP 接口
 
@@ -46,6 +59,12 @@ from datetime import datetime
 # Backnode API Configuration
 # -------------------------
 BACKNODE_API_URL = "http://localhost:8081/api/analysis/alert"
+BACKNODE_QUEUE_SIZE = int(os.environ.get("BACKNODE_QUEUE_SIZE", "1000"))  # 待发送告警队列上限
+ALERT_AGG_WINDOW = float(os.environ.get("ALERT_AGG_WINDOW", "10"))  # 告警聚合窗口（秒），0 表示不聚合
+ALERT_AGG_MAX_KEYS = int(os.environ.get("ALERT_AGG_MAX_KEYS", "4096"))  # 同时跟踪的聚合键上限（LRU 淘汰）
+DEDUP_WINDOW_MS = float(os.environ.get("DEDUP_WINDOW_MS", "0"))  # 重复包去重窗口（毫秒），0 表示关闭
+DEDUP_MAX_ENTRIES = int(os.environ.get("DEDUP_MAX_ENTRIES", "65536"))  # 每一代去重集合的容量上限
+DEDUP_PAYLOAD_PREFIX = 64  # 参与去重哈希的载荷前缀长度
 BLOCKED_IPS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "../blocked_ips.json")
 TRUSTED_IPS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "../trusted_ips.json")
 
@@ -53,11 +72,16 @@ TRUSTED_IPS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "../
 # scapy 用于抓包/解析
 # -------------------------
 from scapy.sendrecv import sniff
-from scapy.utils import rdpcap
+from scapy.utils import PcapReader
 from scapy.layers.inet import IP, TCP, UDP
 from scapy.layers.inet6 import IPv6
 from scapy.packet import Raw
 
+# -------------------------
+# 本地模块
+# -------------------------
+import pcap_index
+
 # -------------------------
 # flask（可选）用于 REST API
 # -------------------------
@@ -101,6 +125,7 @@ class Rule:
 class Stats:
     total_packets: int = 0
     matched_packets: int = 0
+    duplicates_dropped: int = 0
     alerts_per_rule: Dict[int, int] = field(default_factory=dict)
 
     def record_hits(self, hits: List[Dict[str, Any]]):
@@ -112,6 +137,455 @@ class Stats:
             self.alerts_per_rule[sid] = self.alerts_per_rule.get(sid, 0) + 1
 
 
+# -------------------------
+# 运行指标（Prometheus 文本格式）
+# -------------------------
+# 单包处理耗时直方图的桶边界（秒）
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+
+
+class _MetricsShard:
+    """单个线程独占的一组计数器，只有所属线程会写。"""
+
+    def __init__(self):
+        self.counters: Dict[str, float] = {}
+        self.rule_hits: Dict[int, int] = {}
+        self.latency_buckets: List[int] = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.latency_sum = 0.0
+        self.latency_count = 0
+
+
+class SensorMetrics:
+    """
+    按线程分片的计数器：热路径只写本线程的 shard，不加锁；
+    /metrics 抓取时再把所有 shard 合并成 Prometheus 文本。
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        self._shards: List[_MetricsShard] = []
+        self._register_lock = threading.Lock()  # 仅在新线程首次写入时使用
+        self._gauges: Dict[str, Any] = {}
+        self._last_scrape = (time.time(), 0.0)
+
+    def _shard(self) -> _MetricsShard:
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = _MetricsShard()
+            with self._register_lock:
+                self._shards.append(shard)
+            self._local.shard = shard
+        return shard
+
+    def inc(self, name: str, value: float = 1):
+        counters = self._shard().counters
+        counters[name] = counters.get(name, 0) + value
+
+    def inc_rule(self, sid: int):
+        hits = self._shard().rule_hits
+        hits[sid] = hits.get(sid, 0) + 1
+
+    def observe_latency(self, seconds: float):
+        shard = self._shard()
+        shard.latency_buckets[bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        shard.latency_sum += seconds
+        shard.latency_count += 1
+
+    def register_gauge(self, name: str, help_text: str, provider):
+        """抓取时调用 provider() 取值，用于队列深度等瞬时量。"""
+        self._gauges[name] = (help_text, provider)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._register_lock:
+            shards = list(self._shards)
+        counters: Dict[str, float] = {}
+        rule_hits: Dict[int, int] = {}
+        buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        latency_sum = 0.0
+        latency_count = 0
+        for shard in shards:
+            for k, v in dict(shard.counters).items():
+                counters[k] = counters.get(k, 0) + v
+            for sid, v in dict(shard.rule_hits).items():
+                rule_hits[sid] = rule_hits.get(sid, 0) + v
+            for i, v in enumerate(list(shard.latency_buckets)):
+                buckets[i] += v
+            latency_sum += shard.latency_sum
+            latency_count += shard.latency_count
+        return {
+            "counters": counters,
+            "rule_hits": rule_hits,
+            "latency_buckets": buckets,
+            "latency_sum": latency_sum,
+            "latency_count": latency_count,
+        }
+
+    def render(self) -> str:
+        snap = self.snapshot()
+        counters = snap["counters"]
+        lines: List[str] = []
+
+        def emit(name, mtype, help_text, samples):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {mtype}")
+            for labels, value in samples:
+                lines.append(f"{name}{labels} {value}")
+
+        packets = counters.get("packets", 0)
+        now = time.time()
+        last_time, last_packets = self._last_scrape
+        pps = (packets - last_packets) / (now - last_time) if now > last_time else 0.0
+        self._last_scrape = (now, packets)
+
+        emit("mini_snort_packets_total", "counter", "Packets seen by the engine.", [("", int(packets))])
+        emit("mini_snort_bytes_total", "counter", "Bytes seen by the engine.", [("", int(counters.get("bytes", 0)))])
+        emit("mini_snort_packets_per_second", "gauge", "Packet rate since the previous scrape.", [("", f"{pps:.3f}")])
+        emit("mini_snort_packets_skipped_total", "counter", "Packets skipped by the blocked/trusted IP lists.", [
+            ('{reason="blocked"}', int(counters.get("skipped_blocked", 0))),
+            ('{reason="trusted"}', int(counters.get("skipped_trusted", 0))),
+        ])
+        emit("mini_snort_duplicates_dropped_total", "counter", "Mirrored duplicate packets dropped before matching.",
+             [("", int(counters.get("duplicates_dropped", 0)))])
+        emit("mini_snort_decode_failures_total", "counter", "Packets that could not be decoded.",
+             [("", int(counters.get("decode_failures", 0)))])
+        emit("mini_snort_rule_hits_total", "counter", "Rule matches per SID.",
+             [(f'{{sid="{sid}"}}', v) for sid, v in sorted(snap["rule_hits"].items())])
+        emit("mini_snort_alert_queue_dropped_total", "counter", "Alerts dropped because the shipping queue was full.",
+             [("", int(counters.get("alert_queue_dropped", 0)))])
+        emit("mini_snort_alerts_aggregated_total", "counter", "Alerts folded into a summary instead of sent individually.",
+             [("", int(counters.get("alerts_aggregated", 0)))])
+        emit("mini_snort_alert_summaries_total", "counter", "Summary alerts emitted by the aggregation window.",
+             [("", int(counters.get("alert_summaries", 0)))])
+        emit("mini_snort_alerts_shipped_total", "counter", "Alerts delivered to Backnode, by result.", [
+            ('{result="success"}', int(counters.get("alert_ship_success", 0))),
+            ('{result="failure"}', int(counters.get("alert_ship_failure", 0))),
+        ])
+        for name, (help_text, provider) in self._gauges.items():
+            try:
+                value = provider()
+            except Exception:
+                continue
+            emit(name, "gauge", help_text, [("", value)])
+
+        name = "mini_snort_packet_latency_seconds"
+        lines.append(f"# HELP {name} Per-packet processing latency.")
+        lines.append(f"# TYPE {name} histogram")
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS, snap["latency_buckets"]):
+            cumulative += count
+            lines.append(f'{name}_bucket{{le="{bound}"}} {cumulative}')
+        cumulative += snap["latency_buckets"][-1]
+        lines.append(f'{name}_bucket{{le="+Inf"}} {cumulative}')
+        lines.append(f"{name}_sum {snap['latency_sum']:.6f}")
+        lines.append(f"{name}_count {snap['latency_count']}")
+        return "\n".join(lines) + "\n"
+
+
+METRICS = SensorMetrics()
+
+
+# -------------------------
+# 告警异步发送（Backnode）
+# -------------------------
+class AlertShipper:
+    """
+    有界队列 + 后台线程发送告警，避免 requests.post 阻塞抓包回调。
+    队列满时直接丢弃并计数。
+    """
+
+    def __init__(self, url: str = BACKNODE_API_URL, maxsize: int = BACKNODE_QUEUE_SIZE, timeout: float = 2.0):
+        self.url = url
+        self.timeout = timeout
+        self.queue: "queue.Queue[Dict[str, Any]]" = queue.Queue(maxsize=maxsize)
+        self._thread: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="backnode-shipper", daemon=True)
+                self._thread.start()
+
+    def submit(self, payload: Dict[str, Any]) -> bool:
+        self._ensure_started()
+        try:
+            self.queue.put_nowait(payload)
+            return True
+        except queue.Full:
+            METRICS.inc("alert_queue_dropped")
+            return False
+
+    def _run(self):
+        session = requests.Session()
+        while True:
+            payload = self.queue.get()
+            try:
+                response = session.post(self.url, json=payload, timeout=self.timeout)
+                if response.status_code == 200:
+                    METRICS.inc("alert_ship_success")
+                    logger.info(f"Alert sent to Backnode successfully: {payload['threatId']}")
+                else:
+                    METRICS.inc("alert_ship_failure")
+                    logger.error(f"Failed to send alert to Backnode: {response.status_code} - {response.text}")
+            except Exception as e:
+                METRICS.inc("alert_ship_failure")
+                logger.error(f"Error sending alert to Backnode: {str(e)}")
+            finally:
+                self.queue.task_done()
+
+    def flush(self, timeout: float = 10.0):
+        """等待队列中的告警发完（pcap 回放结束时调用），最多等待 timeout 秒。"""
+        deadline = time.time() + timeout
+        while self.queue.unfinished_tasks and time.time() < deadline:
+            time.sleep(0.05)
+
+
+ALERT_SHIPPER = AlertShipper()
+METRICS.register_gauge("mini_snort_alert_queue_depth", "Alerts waiting to be shipped to Backnode.",
+                       lambda: ALERT_SHIPPER.queue.qsize())
+
+
+# -------------------------
+# 正则安全（ReDoS 防护）
+# -------------------------
+# 不安全正则的处理策略：reject（拒绝加载）/ warn（仅告警，照常加载）
+REGEX_UNSAFE_POLICY = os.environ.get("REGEX_UNSAFE_POLICY", "reject").lower()
+# 单次 search 的耗时预算（毫秒），超出记一次 strike
+REGEX_MATCH_BUDGET_MS = float(os.environ.get("REGEX_MATCH_BUDGET_MS", "50"))
+# 累计 strike 次数达到该值后自动停用规则
+REGEX_BUDGET_STRIKES = int(os.environ.get("REGEX_BUDGET_STRIKES", "3"))
+
+_ALL_BYTES = frozenset(range(256))
+_DIGIT_BYTES = frozenset(range(0x30, 0x3A))
+_WORD_BYTES = _DIGIT_BYTES | frozenset(range(0x41, 0x5B)) | frozenset(range(0x61, 0x7B)) | {0x5F}
+_SPACE_BYTES = frozenset({0x09, 0x0A, 0x0B, 0x0C, 0x0D, 0x20})
+_CATEGORY_BYTES = {"DIGIT": _DIGIT_BYTES, "WORD": _WORD_BYTES, "SPACE": _SPACE_BYTES, "LINEBREAK": frozenset({0x0A})}
+
+_REPEAT_OPS = {sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT}
+_POSSESSIVE_REPEAT = getattr(sre_constants, "POSSESSIVE_REPEAT", None)
+_ATOMIC_GROUP = getattr(sre_constants, "ATOMIC_GROUP", None)
+# 上界超过该值的量词视为"无界"
+_WIDE_REPEAT = 100
+
+
+def _category_bytes(category) -> frozenset:
+    name = str(category)  # 例如 CATEGORY_NOT_DIGIT / CATEGORY_UNI_WORD
+    chars = _CATEGORY_BYTES.get(name.rsplit("_", 1)[-1], _ALL_BYTES)
+    return _ALL_BYTES - chars if "_NOT_" in name else chars
+
+
+def _in_bytes(items) -> frozenset:
+    chars: Set[int] = set()
+    negate = False
+    for op, av in items:
+        if op == sre_constants.NEGATE:
+            negate = True
+        elif op == sre_constants.LITERAL:
+            chars.add(av)
+        elif op == sre_constants.RANGE:
+            chars.update(range(av[0], av[1] + 1))
+        elif op == sre_constants.CATEGORY:
+            chars.update(_category_bytes(av))
+        else:
+            return _ALL_BYTES
+    return _ALL_BYTES - chars if negate else frozenset(chars)
+
+
+def _first_set(items) -> Tuple[frozenset, bool]:
+    """返回 (可能出现的首字节集合, 是否可匹配空串)，用于判断分支是否有歧义。"""
+    first: Set[int] = set()
+    for op, av in items:
+        if op == sre_constants.LITERAL:
+            chars, nullable = frozenset({av}), False
+        elif op == sre_constants.NOT_LITERAL:
+            chars, nullable = _ALL_BYTES - {av}, False
+        elif op == sre_constants.ANY:
+            chars, nullable = _ALL_BYTES, False
+        elif op == sre_constants.IN:
+            chars, nullable = _in_bytes(av), False
+        elif op == sre_constants.SUBPATTERN:
+            chars, nullable = _first_set(av[-1])
+        elif op == _ATOMIC_GROUP:
+            chars, nullable = _first_set(av)
+        elif op == sre_constants.BRANCH:
+            chars, nullable = frozenset(), False
+            for alt in av[1]:
+                alt_chars, alt_nullable = _first_set(alt)
+                chars = chars | alt_chars
+                nullable = nullable or alt_nullable
+        elif op in _REPEAT_OPS or op == _POSSESSIVE_REPEAT:
+            chars, nullable = _first_set(av[2])
+            nullable = nullable or av[0] == 0
+        elif op in (sre_constants.AT, sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+            chars, nullable = frozenset(), True
+        else:  # GROUPREF 等无法静态判断的情况按"任意字节"保守处理
+            chars, nullable = _ALL_BYTES, True
+        first |= chars
+        if not nullable:
+            return frozenset(first), False
+    return frozenset(first), True
+
+
+def _fold_case(chars: frozenset) -> frozenset:
+    return frozenset(c + 0x20 if 0x41 <= c <= 0x5A else c for c in chars)
+
+
+def _branch_is_ambiguous(alternatives, ignore_case: bool) -> bool:
+    seen: Set[int] = set()
+    nullable_count = 0
+    has_consuming = False
+    for alt in alternatives:
+        chars, nullable = _first_set(alt)
+        if ignore_case:
+            chars = _fold_case(chars)
+        if seen & chars:
+            return True
+        seen |= chars
+        if nullable:
+            nullable_count += 1
+        else:
+            has_consuming = True
+    # 形如 (a|aa)+ 会被解析器提取公共前缀为 a(?:|a)，空分支与消耗分支同样会导致回溯爆炸；
+    # (a|a)* 会被折叠成 a(?:|)，多个空分支之间同样有歧义
+    return nullable_count > 1 or (nullable_count == 1 and has_consuming)
+
+
+def _follow_set(items, follow: Optional[Tuple[frozenset, bool]]) -> Optional[Tuple[frozenset, bool]]:
+    """items 之后紧跟的首字节集合；items 可匹配空串时并上外层的 follow（None 表示未知）"""
+    chars, nullable = _first_set(items)
+    if not nullable:
+        return chars, False
+    if follow is None:
+        return None
+    return chars | follow[0], follow[1]
+
+
+def _separated(body, follow: Optional[Tuple[frozenset, bool]], ignore_case: bool) -> bool:
+    """内层量词之后必须出现一个不在其首字节集合里的字节（如 (a+b)+、(\\w+\\.)+），量词体的拆分方式唯一，不会指数回溯"""
+    if follow is None or follow[1]:
+        return False
+    body_chars, follow_chars = _first_set(body)[0], follow[0]
+    if ignore_case:
+        body_chars, follow_chars = _fold_case(body_chars), _fold_case(follow_chars)
+    return not (body_chars & follow_chars)
+
+
+def _scan_regex(items, inside_wide: bool, inside_repeat: bool, ignore_case: bool, issues: List[str],
+                follow: Optional[Tuple[frozenset, bool]] = None):
+    """
+    inside_wide：处于无界量词体内；inside_repeat：处于上界大于 1 的量词体内（含 {12} 这类计数重复）
+    follow：外层量词体内紧跟在 items 之后的内容的 (首字节集合, 可空)，None 表示未知
+    """
+    items = list(items)
+    for i, (op, av) in enumerate(items):
+        if op in _REPEAT_OPS:
+            lo, hi, body = av
+            wide = hi == sre_constants.MAXREPEAT or hi > _WIDE_REPEAT
+            # 外层只要会重复（(.*a){12}）就足以让内层无界量词的拆分方式呈指数增长
+            if (wide and inside_repeat and _first_set(body)[0]
+                    and not _separated(body, _follow_set(items[i + 1:], follow), ignore_case)):
+                issues.append("nested quantifier (e.g. (a+)+) can backtrack exponentially")
+            # 进入新的量词体：体内末尾之后可能是下一轮重复，也可能是量词之后的内容，按未知处理
+            _scan_regex(body, inside_wide or wide, inside_repeat or hi > 1, ignore_case, issues)
+        elif op == _POSSESSIVE_REPEAT or op == _ATOMIC_GROUP:
+            # 占有量词/原子组不会回溯，内部不再受外层量词影响
+            _scan_regex(av[2] if op == _POSSESSIVE_REPEAT else av, False, False, ignore_case, issues)
+        elif op == sre_constants.SUBPATTERN:
+            _scan_regex(av[-1], inside_wide, inside_repeat, ignore_case, issues, _follow_set(items[i + 1:], follow))
+        elif op == sre_constants.BRANCH:
+            if inside_wide and _branch_is_ambiguous(av[1], ignore_case):
+                issues.append("ambiguous alternation inside a repeated group (e.g. (a|aa)+)")
+            rest = _follow_set(items[i + 1:], follow)
+            for alt in av[1]:
+                _scan_regex(alt, inside_wide, inside_repeat, ignore_case, issues, rest)
+        elif op in (sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+            _scan_regex(av[1], inside_wide, inside_repeat, ignore_case, issues)
+
+
+def analyze_regex_safety(pattern: bytes, flags: int = 0) -> List[str]:
+    """
+    静态检查正则是否存在灾难性回溯风险。
+    返回问题描述列表，空列表表示未发现风险。
+    """
+    try:
+        parsed = sre_parse.parse(pattern, flags)
+    except re.error as e:
+        return [f"invalid regex: {e}"]
+    issues: List[str] = []
+    _scan_regex(list(parsed), False, False, bool(flags & re.IGNORECASE), issues)
+    # 去重并保持顺序
+    return list(dict.fromkeys(issues))
+
+
+class RegexGuard:
+    """
+    运行时正则耗时守护：按 sid 统计 search 耗时，
+    单次超出预算累计 REGEX_BUDGET_STRIKES 次后停用该规则，并在 /debug 中报告。
+    """
+
+    def __init__(self, budget_ms: float = REGEX_MATCH_BUDGET_MS, strikes: int = REGEX_BUDGET_STRIKES):
+        self.budget_s = budget_ms / 1000.0
+        self.strikes = strikes
+        self.stats: Dict[int, Dict[str, float]] = {}
+        self.disabled: Dict[int, Dict[str, Any]] = {}
+        self.rejected: Dict[int, Dict[str, Any]] = {}
+
+    def record(self, rule: Rule, elapsed: float):
+        st = self.stats.get(rule.sid)
+        if st is None:
+            st = self.stats[rule.sid] = {"calls": 0, "total_s": 0.0, "max_s": 0.0, "strikes": 0}
+        st["calls"] += 1
+        st["total_s"] += elapsed
+        if elapsed > st["max_s"]:
+            st["max_s"] = elapsed
+        if elapsed <= self.budget_s:
+            return
+        st["strikes"] += 1
+        if st["strikes"] >= self.strikes and rule.enabled:
+            rule.enabled = False
+            self.disabled[rule.sid] = {
+                "sid": rule.sid,
+                "msg": rule.msg,
+                "strikes": st["strikes"],
+                "max_ms": round(st["max_s"] * 1000, 3),
+                "disabled_at": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime()),
+            }
+            logger.warning(
+                f"Rule sid={rule.sid} disabled: regex exceeded {self.budget_s * 1000:.1f}ms budget "
+                f"{st['strikes']} times (max {st['max_s'] * 1000:.1f}ms)"
+            )
+
+    def reject(self, sid: int, msg: str, issues: List[str]):
+        self.rejected[sid] = {"sid": sid, "msg": msg, "issues": issues}
+
+    def report(self) -> Dict[str, Any]:
+        slowest = sorted(self.stats.items(), key=lambda kv: kv[1]["max_s"], reverse=True)[:10]
+        return {
+            "policy": REGEX_UNSAFE_POLICY,
+            "budget_ms": self.budget_s * 1000,
+            "strikes_to_disable": self.strikes,
+            "disabled_rules": list(self.disabled.values()),
+            "rejected_rules": list(self.rejected.values()),
+            "slowest_rules": [
+                {
+                    "sid": sid,
+                    "calls": int(st["calls"]),
+                    "avg_us": round(st["total_s"] / st["calls"] * 1e6, 2) if st["calls"] else 0.0,
+                    "max_ms": round(st["max_s"] * 1000, 3),
+                    "strikes": int(st["strikes"]),
+                }
+                for sid, st in slowest
+            ],
+        }
+
+
+REGEX_GUARD = RegexGuard()
+METRICS.register_gauge("mini_snort_regex_disabled_rules", "Rules disabled by the regex time budget.",
+                       lambda: len(REGEX_GUARD.disabled))
+
+
 # -------------------------
 # 规则加载
 # -------------------------
@@ -129,10 +603,17 @@ def load_rules_from_json(path: str) -> List[Rule]:
         content = r.get("content")
         if content:
             # 统一按 bytes 正则处理
-            if isinstance(content, str):
-                cre = re.compile(content.encode(), re.DOTALL)
-            else:
-                cre = re.compile(content, re.DOTALL)
+            pattern = content.encode() if isinstance(content, str) else content
+            issues = analyze_regex_safety(pattern, re.DOTALL)
+            sid = int(r.get("sid", 0))
+            if issues:
+                invalid = any(i.startswith("invalid regex") for i in issues)
+                if invalid or REGEX_UNSAFE_POLICY == "reject":
+                    REGEX_GUARD.reject(sid, r.get("msg", ""), issues)
+                    logger.warning(f"Rule sid={sid} rejected: {'; '.join(issues)}")
+                    continue
+                logger.warning(f"Rule sid={sid} loaded with unsafe regex: {'; '.join(issues)}")
+            cre = re.compile(pattern, re.DOTALL)
 
         rule = Rule(
             sid=int(r.get("sid", 0)),
@@ -202,6 +683,7 @@ def extract_payload(packet) -> bytes:
             return str(raw).encode(errors="ignore")
         return b""
     except Exception:
+        METRICS.inc("decode_failures")
         return b""
 
 
@@ -244,6 +726,10 @@ def match_packet(packet, rules: List[Rule]) -> List[Dict[str, Any]]:
     payload = extract_payload(packet)
 
     for rule in rules:
+        # 被运行时正则守护停用的规则
+        if not rule.enabled:
+            continue
+
         # 协议匹配
         if rule.protocol != "any" and rule.protocol != proto and not (
                 rule.protocol == "ip" and proto in ("tcp", "udp", "ip")
@@ -262,8 +748,11 @@ def match_packet(packet, rules: List[Rule]) -> List[Dict[str, Any]]:
 
         # payload 内容匹配
         if rule.content_regex:
+            started = time.perf_counter()
             try:
-                if not rule.content_regex.search(payload):
+                found = rule.content_regex.search(payload)
+                REGEX_GUARD.record(rule, time.perf_counter() - started)
+                if not found:
                     continue
             except re.error:
                 # 正则异常时退回为普通字符串匹配
@@ -335,10 +824,14 @@ def record_alert(hit: Dict[str, Any], packet_time, logfile: str = ALERT_LOGFILE)
     # -------------------------
     # 发送到 Backnode
     # -------------------------
+    ship_alert_to_backnode(line)
+
+
+def ship_alert_to_backnode(line: Dict[str, Any], scope_suffix: str = ""):
     try:
         # 构造适配 Backnode 的 Payload
         # 注意：Backnode 需要 threatId, threatLevel, impactScope (session | attack_type), occurTime, createTime
-        impact_scope = f"{line['src']} -> {line['dst']} | {line['msg']}"
+        impact_scope = f"{line['src']} -> {line['dst']} | {line['msg']}{scope_suffix}"
         
         backnode_payload = {
             "threatId": str(uuid.uuid4()),
@@ -348,26 +841,215 @@ def record_alert(hit: Dict[str, Any], packet_time, logfile: str = ALERT_LOGFILE)
             "createTime": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         }
         
-        # 发送 POST 请求
-        # timeout 设置为 2 秒，避免阻塞主检测循环太久
-        response = requests.post(BACKNODE_API_URL, json=backnode_payload, timeout=2)
-        
-        if response.status_code == 200:
-            logger.info(f"Alert sent to Backnode successfully: {backnode_payload['threatId']}")
-        else:
-            logger.error(f"Failed to send alert to Backnode: {response.status_code} - {response.text}")
-            
+        # 交给后台线程发送，避免阻塞主检测循环
+        ALERT_SHIPPER.submit(backnode_payload)
+
     except Exception as e:
         logger.error(f"Error sending alert to Backnode: {str(e)}")
 
 
+# -------------------------
+# 告警聚合：同一 (sid, 会话) 在窗口内只发首条 + 周期汇总
+# -------------------------
+@dataclass
+class AlertAggregate:
+    hit: Dict[str, Any]                 # 首条命中，汇总告警沿用其规则/会话信息
+    window_start: float
+    last_seen: float
+    count: int = 0                      # 本窗口内被合并、未单独发送的告警数
+    bytes: int = 0
+    first_ts: Optional[float] = None    # 本窗口内首条/末条被合并告警的时间
+    last_ts: Optional[float] = None
+
+
+class AlertAggregator:
+    """
+    DoS 等场景下同一条规则会对同一会话重复命中成千上万次。
+    首次命中立即走 record_alert；窗口内的后续命中只计数，
+    窗口结束时输出一条带计数、字节数和首末时间的汇总告警。
+    聚合键数量受 max_keys 限制，按 LRU 淘汰（淘汰前先输出未发送的汇总）。
+    汇总由 flush_due 按时间输出：每个报文都会调用一次，实时抓包时另有定时线程在无流量时调用。
+    """
+
+    def __init__(self, logfile: str = ALERT_LOGFILE, window: float = ALERT_AGG_WINDOW,
+                 max_keys: int = ALERT_AGG_MAX_KEYS):
+        self.logfile = logfile
+        self.window = window
+        self.max_keys = max_keys
+        self.entries: "OrderedDict[tuple, AlertAggregate]" = OrderedDict()
+        self._next_check = 0.0
+        self._lock = threading.RLock()  # 抓包线程与定时刷新线程共用
+
+    def submit(self, hit: Dict[str, Any], packet_time, packet_len: int = 0):
+        if self.window <= 0:
+            record_alert(hit, packet_time, self.logfile)
+            return
+        try:
+            ts = float(packet_time)
+        except Exception:
+            ts = time.time()
+
+        key = (hit["sid"], hit["src_ip"], hit["dst_ip"], hit["dst_port"])
+        with self._lock:
+            agg = self.entries.get(key)
+            if agg is None:
+                record_alert(hit, ts, self.logfile)
+                self.entries[key] = AlertAggregate(hit=hit, window_start=ts, last_seen=ts)
+                while len(self.entries) > self.max_keys:
+                    _, evicted = self.entries.popitem(last=False)
+                    METRICS.inc("alert_agg_evicted")
+                    self._emit_summary(evicted)
+            else:
+                self.entries.move_to_end(key)
+                agg.count += 1
+                agg.bytes += packet_len
+                agg.last_seen = ts
+                if agg.first_ts is None:
+                    agg.first_ts = ts
+                agg.last_ts = ts
+                METRICS.inc("alerts_aggregated")
+            self.flush_due(ts)
+
+    def flush_due(self, now: float):
+        """按窗口输出到期的汇总；空闲满一个窗口的聚合直接丢弃，下次命中重新作为首条发送。"""
+        if self.window <= 0 or now < self._next_check:
+            return
+        with self._lock:
+            self._next_check = now + min(1.0, self.window)
+            for key, agg in list(self.entries.items()):
+                if now - agg.window_start < self.window:
+                    continue
+                if agg.count:
+                    self._emit_summary(agg)
+                    agg.window_start = now
+                elif now - agg.last_seen >= self.window:
+                    del self.entries[key]
+
+    def flush_all(self):
+        with self._lock:
+            for agg in self.entries.values():
+                self._emit_summary(agg)
+            self.entries.clear()
+
+    def start_timer(self, stop: threading.Event, interval: float = 1.0) -> threading.Thread:
+        """实时抓包：攻击停止后没有新报文时也按墙钟时间输出到期的汇总"""
+        def loop():
+            while not stop.wait(interval):
+                self.flush_due(time.time())
+
+        thread = threading.Thread(target=loop, name="alert-agg-flush", daemon=True)
+        thread.start()
+        return thread
+
+    def _emit_summary(self, agg: AlertAggregate):
+        if not agg.count:
+            return
+        hit = agg.hit
+        rule: Rule = hit["rule"]
+        fmt = lambda t: time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(t))
+        line = {
+            "timestamp": fmt(agg.first_ts),
+            "sid": hit["sid"],
+            "msg": hit["msg"],
+            "severity": rule.severity,
+            "tags": rule.tags,
+            "proto": hit["proto"],
+            "src": f"{hit['src_ip']}:{hit['src_port']}",
+            "dst": f"{hit['dst_ip']}:{hit['dst_port']}",
+            "summary": True,
+            "count": agg.count,
+            "bytes": agg.bytes,
+            "first_seen": fmt(agg.first_ts),
+            "last_seen": fmt(agg.last_ts),
+        }
+        with open(self.logfile, "a", encoding="utf-8") as f:
+            f.write(json.dumps(line, ensure_ascii=False) + "\n")
+        logger.warning(
+            f"[ALERT-SUMMARY][sev={line['severity']}][sid={line['sid']}] "
+            f"{line['msg']} | {line['src']} -> {line['dst']} | "
+            f"x{agg.count} ({agg.bytes} bytes) {line['first_seen']} ~ {line['last_seen']}"
+        )
+        METRICS.inc("alert_summaries")
+        ship_alert_to_backnode(
+            line, f" | x{agg.count} alerts, {agg.bytes} bytes, {line['first_seen']} ~ {line['last_seen']}"
+        )
+        agg.count = 0
+        agg.bytes = 0
+        agg.first_ts = agg.last_ts = None
+
+
+# -------------------------
+# 重复包去重（SPAN 口双向镜像会把同一个包送来两次）
+# -------------------------
+def _dedup_key(packet) -> Optional[int]:
+    """IP ID + 五元组 + TCP 序号 + 载荷前缀；TTL/校验和在镜像路径上可能不同，不参与。"""
+    if IP in packet:
+        ip_layer = packet[IP]
+        ident = ip_layer.id
+        proto = ip_layer.proto
+    elif IPv6 in packet:
+        ip_layer = packet[IPv6]
+        ident = ip_layer.plen
+        proto = ip_layer.nh
+    else:
+        return None
+
+    sport = dport = seq = 0
+    if TCP in packet:
+        l4 = packet[TCP]
+        sport, dport, seq = l4.sport, l4.dport, l4.seq
+    elif UDP in packet:
+        l4 = packet[UDP]
+        sport, dport = l4.sport, l4.dport
+    payload = packet[Raw].load[:DEDUP_PAYLOAD_PREFIX] if Raw in packet else b""
+    return hash((ident, ip_layer.src, ip_layer.dst, proto, sport, dport, seq, payload))
+
+
+class DuplicateFilter:
+    """
+    两代轮换的哈希集合：每隔 window 秒（或当前代写满 max_entries）轮换一次，
+    只保留当前代和上一代，因此判重窗口在 window ~ 2*window 之间，内存恒定。
+    时间取自包时间戳，pcap 回放与实时抓包行为一致。
+    """
+
+    def __init__(self, window_ms: float = DEDUP_WINDOW_MS, max_entries: int = DEDUP_MAX_ENTRIES):
+        self.window = window_ms / 1000.0
+        self.max_entries = max_entries
+        self.current: Set[int] = set()
+        self.previous: Set[int] = set()
+        self.rotated_at = 0.0
+
+    def is_duplicate(self, packet) -> bool:
+        key = _dedup_key(packet)
+        if key is None:
+            return False
+        try:
+            ts = float(packet.time)
+        except Exception:
+            ts = time.time()
+
+        elapsed = ts - self.rotated_at
+        if elapsed >= self.window or len(self.current) >= self.max_entries:
+            # 超过两个窗口没有轮换时，上一代也已过期
+            self.previous = self.current if elapsed < 2 * self.window else set()
+            self.current = set()
+            self.rotated_at = ts
+
+        if key in self.current or key in self.previous:
+            return True
+        self.current.add(key)
+        return False
+
+
 # -------------------------
 # 引擎类：封装 packet 回调 + 统计
 # -------------------------
 class MiniSnortEngine:
-    def __init__(self, rules: List[Rule], alert_logfile: str = ALERT_LOGFILE):
+    def __init__(self, rules: List[Rule], alert_logfile: str = ALERT_LOGFILE, dedup_window_ms: float = DEDUP_WINDOW_MS):
         self.rules = rules
         self.alert_logfile = alert_logfile
+        self.aggregator = AlertAggregator(alert_logfile)
+        self.dedup = DuplicateFilter(dedup_window_ms) if dedup_window_ms > 0 else None
         self.stats = Stats()
         self.blocked_ips = set()
         self.trusted_ips = set()
@@ -424,44 +1106,71 @@ class MiniSnortEngine:
             pass
 
     def process_packet(self, packet):
-        self.reload_ips()
-
-        # Check for blocked source IP
-        src_ip = None
-        if IP in packet:
-            src_ip = packet[IP].src
-        elif IPv6 in packet:
-            src_ip = packet[IPv6].src
-            
-        if src_ip:
-            if src_ip in self.blocked_ips:
-                # Ignore traffic from blocked IPs
+        started = time.perf_counter()
+        # 去重/封禁/信任/解码失败提前返回的包也计入单包耗时，直方图计数与 packets 计数一致
+        try:
+            try:
+                pkt_time = float(getattr(packet, "time", None) or time.time())
+            except Exception:
+                pkt_time = time.time()
+            # 按报文时间输出到期的汇总（pcap 回放没有墙钟定时器，命中停止后也要按时输出）
+            self.aggregator.flush_due(pkt_time)
+            METRICS.inc("packets")
+            METRICS.inc("bytes", len(packet))
+            if self.dedup is not None and self.dedup.is_duplicate(packet):
+                self.stats.duplicates_dropped += 1
+                METRICS.inc("duplicates_dropped")
                 return
-            if src_ip in self.trusted_ips:
-                # Ignore traffic from trusted IPs (Whitelist)
+            self.reload_ips()
+
+            # Check for blocked source IP
+            src_ip = None
+            if IP in packet:
+                src_ip = packet[IP].src
+            elif IPv6 in packet:
+                src_ip = packet[IPv6].src
+            
+            if src_ip:
+                if src_ip in self.blocked_ips:
+                    # Ignore traffic from blocked IPs
+                    METRICS.inc("skipped_blocked")
+                    return
+                if src_ip in self.trusted_ips:
+                    # Ignore traffic from trusted IPs (Whitelist)
+                    METRICS.inc("skipped_trusted")
+                    return
+
+            self.stats.total_packets += 1
+            try:
+                hits = match_packet(packet, self.rules)
+            except Exception as e:
+                METRICS.inc("decode_failures")
+                logger.debug(f"Packet decode failed: {e}")
                 return
-
-        self.stats.total_packets += 1
-        hits = match_packet(packet, self.rules)
-        if hits:
-            self.stats.record_hits(hits)
-            pkt_time = getattr(packet, "time", time.time())
-            for hit in hits:
-                record_alert(hit, pkt_time, self.alert_logfile)
+            if hits:
+                self.stats.record_hits(hits)
+                for hit in hits:
+                    METRICS.inc_rule(hit["sid"])
+                    self.aggregator.submit(hit, pkt_time, len(packet))
+        finally:
+            METRICS.observe_latency(time.perf_counter() - started)
 
 
 # -------------------------
 # 运行函数（live / pcap）
 # -------------------------
-def run_live(interface: str, rules_path: str, count: int = 0, bpf_filter: Optional[str] = None) -> Stats:
+def run_live(interface: str, rules_path: str, count: int = 0, bpf_filter: Optional[str] = None,
+             dedup_window_ms: float = DEDUP_WINDOW_MS) -> Stats:
     rules = load_rules_from_json(rules_path)
-    engine = MiniSnortEngine(rules)
+    engine = MiniSnortEngine(rules, dedup_window_ms=dedup_window_ms)
 
     logger.info(
         f"Starting live capture on {interface} "
         f"(count={count if count else 'infinite'}, filter={bpf_filter!r})"
     )
 
+    flush_stop = threading.Event()
+    engine.aggregator.start_timer(flush_stop)
     try:
         sniff(
             iface=interface,
@@ -472,26 +1181,46 @@ def run_live(interface: str, rules_path: str, count: int = 0, bpf_filter: Option
         )
     except KeyboardInterrupt:
         logger.info("Capture interrupted by user (Ctrl+C).")
+    finally:
+        flush_stop.set()
 
+    engine.aggregator.flush_all()
+    ALERT_SHIPPER.flush()
     return engine.stats
 
 
-def run_pcap(pcap_path: str, rules_path: str, replay_delay: float = 0.0) -> Stats:
+def run_pcap(pcap_path: str, rules_path: str, replay_delay: float = 0.0,
+             dedup_window_ms: float = DEDUP_WINDOW_MS, filter_host: Optional[str] = None,
+             filter_flow: Optional[str] = None, time_range: Optional[str] = None) -> Stats:
     rules = load_rules_from_json(rules_path)
-    engine = MiniSnortEngine(rules)
-
-    logger.info(f"Reading PCAP {pcap_path} ...")
-    packets = rdpcap(pcap_path)
-    logger.info(f"Total {len(packets)} packets in pcap")
+    engine = MiniSnortEngine(rules, dedup_window_ms=dedup_window_ms)
+
+    if filter_host or filter_flow or time_range:
+        # 有过滤条件时走旁路索引（首次会自动建索引），只读取命中的记录
+        index = pcap_index.load_or_build_index(pcap_path)
+        flow_key = pcap_index.parse_flow_filter(filter_flow) if filter_flow else None
+        t_range = pcap_index.parse_time_range(time_range) if time_range else None
+        logger.info(f"Reading PCAP {pcap_path} via index (host={filter_host}, flow={flow_key}, "
+                    f"time={time_range}) ...")
+        packets = pcap_index.iter_packets(pcap_path, index, filter_host=filter_host,
+                                          filter_flow=flow_key, time_range=t_range)
+    else:
+        logger.info(f"Reading PCAP {pcap_path} ...")
+        packets = PcapReader(pcap_path)  # 流式读取，避免大文件整包载入内存
 
+    processed = 0
     try:
         for p in packets:
             engine.process_packet(p)
+            processed += 1
             if replay_delay > 0:
                 time.sleep(replay_delay)
     except KeyboardInterrupt:
         logger.info("PCAP replay interrupted by user (Ctrl+C).")
+    logger.info(f"Total {processed} packets processed from pcap")
 
+    engine.aggregator.flush_all()
+    ALERT_SHIPPER.flush()
     return engine.stats
 
 
@@ -675,7 +1404,7 @@ def start_api(rules_path: str, host: str = "0.0.0.0", port: int = 5001):
       <span id="status-text" class="small">加载中...</span>
     </div>
     <div class="small">
-      API: <code>/rules</code>, <code>/alerts</code>, <code>/debug</code>, <code>/hybrid_score</code>
+      API: <code>/rules</code>, <code>/alerts</code>, <code>/debug</code>, <code>/metrics</code>, <code>/hybrid_score</code>
     </div>
   </header>
   <main>
@@ -959,6 +1688,8 @@ def start_api(rules_path: str, host: str = "0.0.0.0", port: int = 5001):
                     f"{rec.get('src', '')} -> {rec.get('dst', '')} | "
                     f"tags={','.join(rec.get('tags', []) or [])}"
                 )
+                if rec.get("summary"):
+                    line += f" | x{rec.get('count', 0)} ({rec.get('first_seen', '')} ~ {rec.get('last_seen', '')})"
             except Exception:
                 line = raw
             render_lines.append(line)
@@ -1017,6 +1748,12 @@ def start_api(rules_path: str, host: str = "0.0.0.0", port: int = 5001):
 
         return jsonify({"signature_ids": signature_result, "llm_ids": llm_result})
 
+    # ---------------- METRICS ----------------
+    @app.route("/metrics", methods=["GET"])
+    def metrics():
+        """Prometheus 文本格式指标（计数器按线程分片，抓取时合并）。"""
+        return Response(METRICS.render(), mimetype="text/plain; version=0.0.4")
+
     # ---------------- DEBUG ----------------
     @app.route("/debug", methods=["GET", "POST"])
     def debug():
@@ -1033,6 +1770,7 @@ def start_api(rules_path: str, host: str = "0.0.0.0", port: int = 5001):
                     "time": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime()),
                     "sample_sid": rules[0].sid if rules else None,
                     "sample_msg": rules[0].msg if rules else None,
+                    "regex_guard": REGEX_GUARD.report(),
                 }
             )
 
@@ -1086,6 +1824,8 @@ def print_stats(stats: Stats):
     logger.info("========= mini_snort_pro statistics =========")
     logger.info(f"Total packets captured: {stats.total_packets}")
     logger.info(f"Packets with alerts:    {stats.matched_packets}")
+    if stats.duplicates_dropped:
+        logger.info(f"Duplicate packets dropped: {stats.duplicates_dropped}")
     if not stats.alerts_per_rule:
         logger.info("No alerts generated.")
         return
@@ -1109,6 +1849,13 @@ def main():
     parser.add_argument("--bpf", help="BPF 抓包过滤表达式（如 'tcp port 80'）", default=None)
     parser.add_argument("--api", action="store_true", help="仅开启 REST API (需要 flask)")
     parser.add_argument("--api-port", type=int, default=5001, help="API 端口")
+    parser.add_argument("--dedup-window-ms", type=float, default=DEDUP_WINDOW_MS,
+                        help="丢弃该时间窗口内的重复镜像包（毫秒，SPAN 口建议 2~5），0 表示关闭")
+    parser.add_argument("--metrics-port", type=int, default=0,
+                        help="live/pcap 模式下同时在该端口开启 REST API（含 /metrics），0 表示不开启")
+    parser.add_argument("--filter-host", help="pcap 模式：只回放该 IP 参与的流（使用 <pcap>.idx 索引）")
+    parser.add_argument("--filter-flow", help="pcap 模式：只回放指定流 SRC_IP:SPORT,DST_IP:DPORT[,tcp|udp]（方向无关）")
+    parser.add_argument("--time-range", help="pcap 模式：只回放时间范围 START,END（epoch 秒或 'YYYY-mm-dd HH:MM:SS'，可留空一端）")
 
     args = parser.parse_args()
 
@@ -1119,14 +1866,22 @@ def main():
         start_api(args.rules, host="0.0.0.0", port=args.api_port)
         return
 
+    if args.metrics_port:
+        threading.Thread(
+            target=start_api, args=(args.rules, "0.0.0.0", args.metrics_port), daemon=True
+        ).start()
+
     if args.mode == "live":
         if not args.interface:
             parser.error("--interface is required for live mode")
-        stats = run_live(args.interface, args.rules, count=args.count, bpf_filter=args.bpf)
+        stats = run_live(args.interface, args.rules, count=args.count, bpf_filter=args.bpf,
+                         dedup_window_ms=args.dedup_window_ms)
     else:
         if not args.pcap:
             parser.error("--pcap is required for pcap mode")
-        stats = run_pcap(args.pcap, args.rules, replay_delay=args.replay_delay)
+        stats = run_pcap(args.pcap, args.rules, replay_delay=args.replay_delay,
+                         dedup_window_ms=args.dedup_window_ms, filter_host=args.filter_host,
+                         filter_flow=args.filter_flow, time_range=args.time_range)
 
     print_stats(stats)
 
@@ -0,0 +1,362 @@
+#!/usr/bin/env python3
+"""
+pcap_index.py - 大 pcap 的流/时间索引（供 mini_snort_pro 按需回放）
+
+对 pcap 做一次流式扫描，生成旁路索引文件 <pcap>.idx（gzip 压缩的 JSON）：
+- flows：     每条流（双向归一化的五元组）的报文文件偏移
+- buckets：   每个时间桶（默认 60 秒）第一个报文的偏移与报文数
+- hosts：     每个 IP 参与的流列表（倒排）
+
+查询时直接 seek 到命中的记录，只把这些报文交给引擎，不再整包 rdpcap。
+
+用法：
+- 建索引：  python pcap_index.py build capture.pcap [--bucket-seconds 60]
+- 查看概况：python pcap_index.py info capture.pcap
+- 回放查询：python mini_snort_pro.py --mode pcap -r capture.pcap -R rules.json --filter-host 10.0.0.5
+
+仅支持经典 pcap 格式（pcapng 请先用 `editcap -F pcap` 转换）。
+"""
+
+import argparse
+import gzip
+import json
+import logging
+import os
+import socket
+import struct
+import time
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger("pcap_index")
+
+INDEX_VERSION = 1
+INDEX_SUFFIX = ".idx"
+DEFAULT_BUCKET_SECONDS = 60
+
+# 链路层类型
+DLT_EN10MB = 1
+DLT_RAW = 101
+DLT_LINUX_SLL = 113
+_RAW_ALIASES = {12, 14, DLT_RAW}
+
+_PCAP_MAGIC = {
+    b"\xd4\xc3\xb2\xa1": ("<", 1e-6),
+    b"\xa1\xb2\xc3\xd4": (">", 1e-6),
+    b"\x4d\x3c\xb2\xa1": ("<", 1e-9),
+    b"\xa1\xb2\x3c\x4d": (">", 1e-9),
+}
+_PCAPNG_MAGIC = b"\x0a\x0d\x0d\x0a"
+
+
+# -------------------------
+# 经典 pcap 流式读取
+# -------------------------
+class PcapFile:
+    """最小化的 pcap 读取器：按记录返回 (偏移, 时间戳, 原始字节)，支持按偏移随机读取。"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.f = open(path, "rb")
+        header = self.f.read(24)
+        if len(header) < 24:
+            raise ValueError(f"{path}: file too short to be a pcap")
+        magic = header[:4]
+        if magic == _PCAPNG_MAGIC:
+            raise ValueError(f"{path}: pcapng is not supported, convert with `editcap -F pcap`")
+        if magic not in _PCAP_MAGIC:
+            raise ValueError(f"{path}: unknown pcap magic {magic.hex()}")
+        self.endian, self.ts_scale = _PCAP_MAGIC[magic]
+        _, _, _, _, self.snaplen, self.linktype = struct.unpack(self.endian + "HHiIII", header[4:])
+        self._rec = struct.Struct(self.endian + "IIII")
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _read_record(self) -> Optional[Tuple[float, bytes]]:
+        hdr = self.f.read(16)
+        if len(hdr) < 16:
+            return None
+        ts_sec, ts_frac, caplen, _ = self._rec.unpack(hdr)
+        data = self.f.read(caplen)
+        if len(data) < caplen:
+            return None  # 截断的尾部记录
+        return ts_sec + ts_frac * self.ts_scale, data
+
+    def __iter__(self) -> Iterator[Tuple[int, float, bytes]]:
+        self.f.seek(24)
+        while True:
+            offset = self.f.tell()
+            rec = self._read_record()
+            if rec is None:
+                return
+            yield offset, rec[0], rec[1]
+
+    def read_at(self, offset: int) -> Optional[Tuple[float, bytes]]:
+        self.f.seek(offset)
+        return self._read_record()
+
+
+def _parse_5tuple(linktype: int, data: bytes) -> Optional[Tuple[str, int, str, int, int]]:
+    """从原始帧中解析 (src_ip, sport, dst_ip, dport, proto)，非 IP 报文返回 None。"""
+    try:
+        if linktype == DLT_EN10MB:
+            off, ethertype = 14, struct.unpack_from("!H", data, 12)[0]
+            while ethertype in (0x8100, 0x88A8):  # VLAN / QinQ
+                ethertype = struct.unpack_from("!H", data, off + 2)[0]
+                off += 4
+        elif linktype == DLT_LINUX_SLL:
+            off, ethertype = 16, struct.unpack_from("!H", data, 14)[0]
+        elif linktype in _RAW_ALIASES:
+            off = 0
+            ethertype = 0x0800 if data[0] >> 4 == 4 else 0x86DD
+        else:
+            return None
+
+        if ethertype == 0x0800:
+            ihl = (data[off] & 0x0F) * 4
+            proto = data[off + 9]
+            src = socket.inet_ntoa(data[off + 12:off + 16])
+            dst = socket.inet_ntoa(data[off + 16:off + 20])
+            l4 = off + ihl
+        elif ethertype == 0x86DD:
+            proto = data[off + 6]
+            src = socket.inet_ntop(socket.AF_INET6, data[off + 8:off + 24])
+            dst = socket.inet_ntop(socket.AF_INET6, data[off + 24:off + 40])
+            l4 = off + 40
+        else:
+            return None
+
+        sport = dport = 0
+        if proto in (6, 17) and len(data) >= l4 + 4:
+            sport, dport = struct.unpack_from("!HH", data, l4)
+        return src, sport, dst, dport, proto
+    except (IndexError, struct.error, OSError, ValueError):
+        return None
+
+
+def flow_id(src: str, sport: int, dst: str, dport: int, proto: int) -> str:
+    """双向归一化的流标识，例如 10.0.0.1:1234-10.0.0.2:80/6。"""
+    a, b = (src, sport), (dst, dport)
+    if a > b:
+        a, b = b, a
+    return f"{a[0]}:{a[1]}-{b[0]}:{b[1]}/{proto}"
+
+
+# -------------------------
+# 建索引
+# -------------------------
+def index_path_for(pcap_path: str) -> str:
+    return pcap_path + INDEX_SUFFIX
+
+
+def build_index(pcap_path: str, bucket_seconds: int = DEFAULT_BUCKET_SECONDS,
+                out_path: Optional[str] = None) -> Dict[str, Any]:
+    started = time.time()
+    flows: Dict[str, Dict[str, Any]] = {}
+    buckets: Dict[int, List[int]] = {}
+    hosts: Dict[str, set] = {}
+    packets = non_ip = 0
+
+    with PcapFile(pcap_path) as pcap:
+        linktype = pcap.linktype
+        for offset, ts, data in pcap:
+            packets += 1
+            bucket = int(ts // bucket_seconds) * bucket_seconds
+            entry = buckets.get(bucket)
+            if entry is None:
+                buckets[bucket] = [offset, 1]
+            else:
+                entry[1] += 1
+
+            tup = _parse_5tuple(linktype, data)
+            if tup is None:
+                non_ip += 1
+                continue
+            src, sport, dst, dport, proto = tup
+            fid = flow_id(src, sport, dst, dport, proto)
+            flow = flows.get(fid)
+            if flow is None:
+                flow = flows[fid] = {"first_ts": ts, "last_ts": ts, "offsets": []}
+                hosts.setdefault(src, set()).add(fid)
+                hosts.setdefault(dst, set()).add(fid)
+            flow["offsets"].append(offset)
+            flow["last_ts"] = max(flow["last_ts"], ts)
+            flow["first_ts"] = min(flow["first_ts"], ts)
+
+    st = os.stat(pcap_path)
+    index = {
+        "version": INDEX_VERSION,
+        "pcap_size": st.st_size,
+        "pcap_mtime": st.st_mtime,
+        "linktype": linktype,
+        "bucket_seconds": bucket_seconds,
+        "packets": packets,
+        "non_ip_packets": non_ip,
+        "flows": flows,
+        "buckets": {str(k): v for k, v in sorted(buckets.items())},
+        "hosts": {ip: sorted(fids) for ip, fids in hosts.items()},
+    }
+    out_path = out_path or index_path_for(pcap_path)
+    with gzip.open(out_path, "wt", encoding="utf-8") as f:
+        json.dump(index, f, separators=(",", ":"))
+    logger.info(f"Indexed {packets} packets / {len(flows)} flows / {len(hosts)} hosts "
+                f"from {pcap_path} in {time.time() - started:.1f}s -> {out_path}")
+    return index
+
+
+def load_index(pcap_path: str) -> Optional[Dict[str, Any]]:
+    """读取旁路索引；索引不存在或与 pcap 大小/修改时间不一致时返回 None。"""
+    path = index_path_for(pcap_path)
+    if not os.path.exists(path):
+        return None
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        index = json.load(f)
+    st = os.stat(pcap_path)
+    if (index.get("version") != INDEX_VERSION or index.get("pcap_size") != st.st_size
+            or abs(index.get("pcap_mtime", 0) - st.st_mtime) > 1e-3):
+        return None
+    return index
+
+
+def load_or_build_index(pcap_path: str, bucket_seconds: int = DEFAULT_BUCKET_SECONDS) -> Dict[str, Any]:
+    return load_index(pcap_path) or build_index(pcap_path, bucket_seconds)
+
+
+# -------------------------
+# 查询
+# -------------------------
+def parse_time(value: str) -> float:
+    """支持 epoch 秒或 'YYYY-mm-dd HH:MM:SS'（本地时间）。"""
+    value = value.strip()
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.strptime(value, "%Y-%m-%d %H:%M:%S").timestamp()
+
+
+def parse_time_range(value: str) -> Tuple[float, float]:
+    start, _, end = value.partition(",")
+    return (parse_time(start) if start.strip() else float("-inf"),
+            parse_time(end) if end.strip() else float("inf"))
+
+
+def parse_flow_filter(value: str) -> str:
+    """'SRC_IP:SPORT,DST_IP:DPORT[,PROTO]' -> flow_id（方向无关，PROTO 支持 tcp/udp/数字，默认 tcp）。"""
+    parts = [p.strip() for p in value.split(",")]
+    if len(parts) not in (2, 3):
+        raise ValueError("--filter-flow expects SRC_IP:SPORT,DST_IP:DPORT[,PROTO]")
+    proto_str = parts[2].lower() if len(parts) == 3 else "tcp"
+    proto = {"tcp": 6, "udp": 17}.get(proto_str) or int(proto_str)
+    (src, sport), (dst, dport) = (p.rsplit(":", 1) for p in parts[:2])
+    return flow_id(src.strip("[]"), int(sport), dst.strip("[]"), int(dport), proto)
+
+
+def select_offsets(index: Dict[str, Any], filter_host: Optional[str] = None, filter_flow: Optional[str] = None,
+                   time_range: Optional[Tuple[float, float]] = None) -> Optional[List[int]]:
+    """
+    返回需要读取的记录偏移（已排序）；仅有时间过滤时返回 None，由调用方按时间桶顺序扫描。
+    """
+    fids: Optional[set] = None
+    if filter_flow:
+        fids = {filter_flow} if filter_flow in index["flows"] else set()
+    if filter_host:
+        host_fids = set(index["hosts"].get(filter_host, []))
+        fids = host_fids if fids is None else fids & host_fids
+    if fids is None:
+        return None
+
+    offsets: List[int] = []
+    for fid in fids:
+        flow = index["flows"][fid]
+        if time_range and (flow["last_ts"] < time_range[0] or flow["first_ts"] > time_range[1]):
+            continue
+        offsets.extend(flow["offsets"])
+    offsets.sort()
+    return offsets
+
+
+def iter_packets(pcap_path: str, index: Dict[str, Any], filter_host: Optional[str] = None,
+                 filter_flow: Optional[str] = None,
+                 time_range: Optional[Tuple[float, float]] = None) -> Iterator[Any]:
+    """按过滤条件 seek 读取报文，返回带 .time 的 scapy 报文。"""
+    from scapy.config import conf
+    # 导入 scapy.layers.l2 同时注册 SLL 等链路层类型；未导入时 conf.l2types 查不到，报文会被解成 Raw
+    from scapy.layers.l2 import Ether
+
+    l2_cls = Ether if index["linktype"] == DLT_EN10MB else conf.l2types.get(index["linktype"])
+    if l2_cls is None:
+        from scapy.packet import Raw as l2_cls
+
+    offsets = select_offsets(index, filter_host, filter_flow, time_range)
+    with PcapFile(pcap_path) as pcap:
+        if offsets is None:
+            records = _scan_time_range(pcap, index, time_range)
+        else:
+            records = ((pcap.read_at(off)) for off in offsets)
+        for rec in records:
+            if rec is None:
+                continue
+            ts, data = rec
+            if time_range and not (time_range[0] <= ts <= time_range[1]):
+                continue
+            pkt = l2_cls(data)
+            pkt.time = ts
+            yield pkt
+
+
+def _scan_time_range(pcap: PcapFile, index: Dict[str, Any], time_range: Optional[Tuple[float, float]]):
+    """从起始时间桶的第一个偏移开始顺序读，越过结束时间所在桶后停止（容忍桶内乱序）。"""
+    start, end = time_range or (float("-inf"), float("inf"))
+    bucket_seconds = index["bucket_seconds"]
+    first_offset = None
+    for bucket, (offset, _) in index["buckets"].items():
+        if int(bucket) + bucket_seconds > start:
+            first_offset = offset if first_offset is None else min(first_offset, offset)
+    if first_offset is None:
+        return
+    pcap.f.seek(first_offset)
+    while True:
+        rec = pcap._read_record()
+        if rec is None:
+            return
+        if rec[0] >= end + bucket_seconds:
+            return
+        yield rec
+
+
+def main():
+    parser = argparse.ArgumentParser(description="pcap flow/time index for mini_snort_pro")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p_build = sub.add_parser("build", help="扫描 pcap 并写入 <pcap>.idx")
+    p_build.add_argument("pcap")
+    p_build.add_argument("--bucket-seconds", type=int, default=DEFAULT_BUCKET_SECONDS, help="时间桶粒度（秒）")
+    p_info = sub.add_parser("info", help="打印索引概况")
+    p_info.add_argument("pcap")
+    args = parser.parse_args()
+
+    if args.cmd == "build":
+        started = time.time()
+        index = build_index(args.pcap, args.bucket_seconds)
+        print(f"Indexed {index['packets']} packets / {len(index['flows'])} flows / {len(index['hosts'])} hosts "
+              f"from {args.pcap} in {time.time() - started:.1f}s -> {index_path_for(args.pcap)}")
+        return
+
+    index = load_index(args.pcap)
+    if index is None:
+        parser.error(f"no up-to-date index for {args.pcap}, run `build` first")
+    top = sorted(index["flows"].items(), key=lambda kv: len(kv[1]["offsets"]), reverse=True)[:10]
+    print(f"packets={index['packets']} non_ip={index['non_ip_packets']} flows={len(index['flows'])} "
+          f"hosts={len(index['hosts'])} buckets={len(index['buckets'])} (bucket={index['bucket_seconds']}s)")
+    for fid, flow in top:
+        print(f"  {fid}: {len(flow['offsets'])} packets")
+
+
+if __name__ == "__main__":
+    main()
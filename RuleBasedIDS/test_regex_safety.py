@@ -0,0 +1,62 @@
+"""
+analyze_regex_safety 的已知危险/安全正则对照表
+
+用法：
+    python -m pytest -q test_regex_safety.py
+"""
+import re
+
+import pytest
+
+from mini_snort_pro import analyze_regex_safety
+
+# 会灾难性回溯的正则
+UNSAFE_PATTERNS = [
+    rb"(a+)+b",
+    rb"(a*)*b",
+    rb"(a+a)+b",
+    rb"(\w+\d)+x",
+    rb"(?:a+|b)+c",
+    rb"(a|aa)+",
+    rb"(a|a)*b",  # 解析器折叠为 a(?:|)，两个空分支
+    rb"(ab|ab)*c",  # 折叠为 ab(?:|)
+    rb"(a|ab)*c",
+    rb"(.*a){12}b",  # 计数重复同样会让内层无界量词指数回溯
+    rb"(.*,){12}X",
+    rb"(.*a){20}",
+    rb"(a+){2,5}b",
+]
+
+# 线性回溯、不应被拒绝的正则
+SAFE_PATTERNS = [
+    rb"(a+b)+c",
+    rb"(\w+\.)+com",
+    rb"((\w+)\.)+com",
+    rb"\d+\.\d+",
+    rb"(?:GET|POST) /[^ ]* HTTP",
+    rb"union\s+select",
+    rb"(a|b)+c",
+    rb"(\w+\.){3}com",
+    rb"\d{1,3}(\.\d{1,3}){3}",
+    rb"(a+){1}b",
+]
+
+
+@pytest.mark.parametrize("pattern", UNSAFE_PATTERNS)
+def test_unsafe_patterns_are_flagged(pattern):
+    assert analyze_regex_safety(pattern), pattern
+
+
+@pytest.mark.parametrize("pattern", SAFE_PATTERNS)
+def test_safe_patterns_pass(pattern):
+    assert analyze_regex_safety(pattern) == [], pattern
+
+
+def test_ignore_case_folds_separator():
+    # 忽略大小写时 A 属于 a+ 的首字节集合，不能作为分隔符
+    assert analyze_regex_safety(rb"(a+A)+b", re.IGNORECASE)
+    assert analyze_regex_safety(rb"(a+B)+c", re.IGNORECASE) == []
+
+
+def test_invalid_pattern_is_reported():
+    assert analyze_regex_safety(rb"(a+")[0].startswith("invalid regex")